@@ -1,38 +1,42 @@
 from nwb_conversion_tools.basedatainterface import BaseDataInterface
-from nwb_conversion_tools.utils import get_schema_from_hdmf_class
 from nwb_conversion_tools.json_schema_utils import get_base_schema
 import pynwb
 from pynwb import NWBFile
+from typing import Optional
 from pathlib import Path
-import importlib.resources as pkg_resources
 import numpy as np
-import h5py
-import json
-from . import schema
-from .utils import get_basic_metadata
+from .utils import (get_basic_metadata, load_source_schema, get_hdmf_class_schema, get_time_window, get_sample_range,
+                    add_trace_pyramid)
+from .hdf5_utils import get_trace_data, find_nonzero_samples, H5FileCache
+from .profiling import ConversionProfiler
 
 
 class AllenEcephysInterface(BaseDataInterface):
 
+    def __init__(self, **source_data):
+        super().__init__(**source_data)
+        # Source file handles, shared with the other interfaces when run from AllenOephysNWBConverter
+        self.h5_files = H5FileCache()
+        # Disabled unless set by AllenOephysNWBConverter.run_conversion with a profile_path
+        self.profiler = ConversionProfiler(enabled=False)
+
     @classmethod
     def get_source_schema(cls):
-        with pkg_resources.open_text(schema, 'source_schema_ecephys.json') as f:
-            source_schema = json.load(f)
-        return source_schema
+        return load_source_schema('source_schema_ecephys.json')
 
     def get_metadata_schema(self):
         metadata_schema = super().get_metadata_schema()
         metadata_schema['properties']['Ecephys'] = get_base_schema(tag='Ecephys')
-        metadata_schema['properties']['Ecephys']['properties']['Device'] = get_schema_from_hdmf_class(pynwb.device.Device)
-        metadata_schema['properties']['Ecephys']['properties']['ElectrodeGroup'] = get_schema_from_hdmf_class(pynwb.ecephys.ElectrodeGroup)
-        metadata_schema['properties']['Ecephys']['properties']['ElectricalSeries_raw'] = get_schema_from_hdmf_class(pynwb.ecephys.ElectricalSeries)
-        metadata_schema['properties']['Ecephys']['properties']['ElectricalSeries_processed'] = get_schema_from_hdmf_class(pynwb.ecephys.ElectricalSeries)
+        metadata_schema['properties']['Ecephys']['properties']['Device'] = get_hdmf_class_schema(pynwb.device.Device)
+        metadata_schema['properties']['Ecephys']['properties']['ElectrodeGroup'] = get_hdmf_class_schema(pynwb.ecephys.ElectrodeGroup)
+        metadata_schema['properties']['Ecephys']['properties']['ElectricalSeries_raw'] = get_hdmf_class_schema(pynwb.ecephys.ElectricalSeries)
+        metadata_schema['properties']['Ecephys']['properties']['ElectricalSeries_processed'] = get_hdmf_class_schema(pynwb.ecephys.ElectricalSeries)
         return metadata_schema
 
     def get_metadata(self):
         """Auto-fill as much of the metadata as possible."""
 
-        metadata = get_basic_metadata(source_data=self.source_data)
+        metadata = get_basic_metadata(source_data=self.source_data, h5_files=self.h5_files)
         metadata['Ecephys'] = dict(
             Device=dict(name='MultiClamp 700B'),
             ElectrodeGroup=dict(
@@ -52,54 +56,95 @@ class AllenEcephysInterface(BaseDataInterface):
         )
 
         # Raw electrical series metadata
-        path_raw = Path(self.source_data["path_ecephys_raw"])
-        if path_raw.is_file():
-            with h5py.File(path_raw, 'r') as f:
-                metadata['Ecephys']['ElectricalSeries_raw']['rate'] = 1 / np.array(f['dte'][0])
+        path_raw = self.source_data.get("path_ecephys_raw")
+        if path_raw is not None and Path(path_raw).is_file():
+            metadata['Ecephys']['ElectricalSeries_raw']['rate'] = 1 / self.h5_files.get_scalar(path_raw, 'dte')
 
         return metadata
 
     def run_conversion(self, nwbfile: NWBFile, metadata: dict,
                        stub_test: bool = False, add_ecephys_raw: bool = False,
-                       add_ecephys_processed: bool = False, add_ecephys_spiking: bool = False):
+                       add_ecephys_processed: bool = False, add_ecephys_spiking: bool = False,
+                       stream_data: bool = True, chunk_size: int = 100_000,
+                       compression: str = 'gzip', compression_opts: int = 4,
+                       passthrough_chunks: bool = False, t_start: Optional[float] = None,
+                       t_stop: Optional[float] = None, add_trace_pyramids: bool = False):
         """
         Options:
+        stub_test : boolean
+            Convert only the first seconds of the session, from t_start if given.
         add_ecephys_raw : boolean
         add_ecephys_processed : boolean
         add_ecephys_spiking : boolean
+        stream_data : boolean
+            Read voltage traces from source chunk by chunk while writing, instead of loading them whole.
+        chunk_size : int
+            Number of samples per chunk of the written voltage traces.
+        compression : str
+            Compression filter of the written voltage traces ('gzip', 'lzf' or None).
+        compression_opts : int
+            Compression level, used only with 'gzip'.
+        passthrough_chunks : boolean
+            Copy compressed source chunks of voltage traces unchanged, when their layout allows it.
+            The chunks are only copied when the file is written by AllenOephysNWBConverter.run_conversion.
+        t_start, t_stop : float
+            Convert only the samples and spikes within [t_start, t_stop), in seconds. Only that part is read from source.
+        add_trace_pyramids : boolean
+            Also store min/max envelopes of the voltage traces at power-of-two resolutions, see utils.add_trace_pyramid.
         """
-        if add_ecephys_raw or add_ecephys_processed:
-            # Device
-            nwbfile.create_device(**metadata['Ecephys']['Device'])
+        time_window = get_time_window(stub_test=stub_test, t_start=t_start, t_stop=t_stop)
+        trace_options = dict(
+            stream_data=stream_data,
+            chunk_size=chunk_size,
+            compression=compression,
+            compression_opts=compression_opts,
+            passthrough_chunks=passthrough_chunks,
+            h5_files=self.h5_files,
+            profiler=self.profiler
+        )
+        with self.h5_files.session(), self.profiler.stage('AllenEcephysInterface'):
+            if add_ecephys_raw or add_ecephys_processed:
+                # Device
+                nwbfile.create_device(**metadata['Ecephys']['Device'])
 
-            # ElectrodeGroups
-            self._create_electrode_groups(
-                nwbfile=nwbfile,
-                metadata_ecephys=metadata['Ecephys']
-            )
-            # Electrodes
-            self._create_electrodes(nwbfile=nwbfile)
+                # ElectrodeGroups
+                self._create_electrode_groups(
+                    nwbfile=nwbfile,
+                    metadata_ecephys=metadata['Ecephys']
+                )
+                # Electrodes
+                self._create_electrodes(nwbfile=nwbfile)
 
-        if add_ecephys_raw:
-            # Raw ecephys
-            self._create_ecephys_raw(
-                nwbfile=nwbfile,
-                metadata_ecephys=metadata['Ecephys']
-            )
+            if add_ecephys_raw:
+                # Raw ecephys
+                with self.profiler.stage('ecephys_raw'):
+                    self._create_ecephys_raw(
+                        nwbfile=nwbfile,
+                        metadata_ecephys=metadata['Ecephys'],
+                        trace_options=trace_options,
+                        time_window=time_window,
+                        add_pyramid=add_trace_pyramids
+                    )
 
-        if add_ecephys_processed:
-            # Processed ecephys
-            self._create_ecephys_processed(
-                nwbfile=nwbfile,
-                metadata_ecephys=metadata['Ecephys']
-            )
+            if add_ecephys_processed:
+                # Processed ecephys
+                with self.profiler.stage('ecephys_processed'):
+                    self._create_ecephys_processed(
+                        nwbfile=nwbfile,
+                        metadata_ecephys=metadata['Ecephys'],
+                        trace_options=trace_options,
+                        time_window=time_window,
+                        add_pyramid=add_trace_pyramids
+                    )
 
-        if add_ecephys_spiking:
-            # Spiking data ecephys
-            self._create_ecephys_spiking(
-                nwbfile=nwbfile,
-                metadata_ecephys=metadata['Ecephys']
-            )
+            if add_ecephys_spiking:
+                # Spiking data ecephys
+                with self.profiler.stage('ecephys_spiking'):
+                    self._create_ecephys_spiking(
+                        nwbfile=nwbfile,
+                        metadata_ecephys=metadata['Ecephys'],
+                        time_window=time_window
+                    )
 
     def _create_electrode_groups(self, nwbfile: NWBFile, metadata_ecephys: dict):
         """
@@ -150,61 +195,119 @@ class AllenEcephysInterface(BaseDataInterface):
             group=electrode_group
         )
 
-    def _create_ecephys_raw(self, nwbfile: NWBFile, metadata_ecephys: dict):
+    def _create_ecephys_raw(self, nwbfile: NWBFile, metadata_ecephys: dict, trace_options: dict = None,
+                            time_window: tuple = None, add_pyramid: bool = False):
         """Add raw membrane voltage data"""
         print('Converting raw ecephys data...')
         path_raw = self.source_data["path_ecephys_raw"]
-        with h5py.File(path_raw, 'r') as f:
-            electrode_table_region = nwbfile.create_electrode_table_region(
-                region=[0],
-                description='electrode'
-            )
+        electrode_table_region = nwbfile.create_electrode_table_region(
+            region=[0],
+            description='electrode'
+        )
 
-            trace_data = np.squeeze(f['Voltage'])
-            trace_name = metadata_ecephys['ElectricalSeries_raw']['name']
-            description = metadata_ecephys['ElectricalSeries_raw']['description']
-            ecephys_rate = metadata_ecephys['ElectricalSeries_raw']['rate']
-            electrical_series = pynwb.ecephys.ElectricalSeries(
-                name=trace_name,
-                description=description,
-                data=trace_data,
-                electrodes=electrode_table_region,
-                starting_time=0.,
-                rate=float(ecephys_rate),
+        trace_name = metadata_ecephys['ElectricalSeries_raw']['name']
+        description = metadata_ecephys['ElectricalSeries_raw']['description']
+        ecephys_rate = float(metadata_ecephys['ElectricalSeries_raw']['rate'])
+        start, stop = get_sample_range(
+            time_window=time_window,
+            rate=ecephys_rate,
+            n_samples=self.h5_files.get_n_samples(path_raw, 'Voltage')
+        )
+        trace_data = get_trace_data(
+            file_path=path_raw,
+            dataset_name='Voltage',
+            start=start,
+            stop=stop,
+            **(trace_options or dict())
+        )
+        electrical_series = pynwb.ecephys.ElectricalSeries(
+            name=trace_name,
+            description=description,
+            data=trace_data,
+            electrodes=electrode_table_region,
+            starting_time=start / ecephys_rate,
+            rate=ecephys_rate,
+        )
+        nwbfile.add_acquisition(electrical_series)
+        if add_pyramid:
+            add_trace_pyramid(
+                nwbfile=nwbfile,
+                series=electrical_series,
+                file_path=path_raw,
+                dataset_name='Voltage',
+                start=start,
+                stop=stop,
+                h5_files=self.h5_files,
+                profiler=self.profiler
             )
-            nwbfile.add_acquisition(electrical_series)
 
-    def _create_ecephys_processed(self, nwbfile: NWBFile, metadata_ecephys: dict):
+    def _create_ecephys_processed(self, nwbfile: NWBFile, metadata_ecephys: dict, trace_options: dict = None,
+                                  time_window: tuple = None, add_pyramid: bool = False):
         """Add processed membrane voltage data"""
         print('Converting processed ecephys data...')
-        with h5py.File(self.source_data['path_ecephys_processed'], 'r') as f:
-            electrode_table_region = nwbfile.create_electrode_table_region(
-                region=[0],
-                description='electrode'
-            )
-            ecephys_rate = 1 / np.array(f['dte'][0])
-
-            # trace_data = np.squeeze(f['ephys_baseline_subtracted'])
-            trace_data = np.squeeze(f['Vmfd'])
-            electrical_series = pynwb.ecephys.ElectricalSeries(
-                name=metadata_ecephys['ElectricalSeries_processed']['name'],
-                description=metadata_ecephys['ElectricalSeries_processed']['description'],
-                data=trace_data,
-                electrodes=electrode_table_region,
-                starting_time=0.,
-                rate=ecephys_rate,
-            )
+        path_processed = self.source_data['path_ecephys_processed']
+        electrode_table_region = nwbfile.create_electrode_table_region(
+            region=[0],
+            description='electrode'
+        )
+        ecephys_rate = 1 / self.h5_files.get_scalar(path_processed, 'dte')
+
+        # trace_data = np.squeeze(f['ephys_baseline_subtracted'])
+        start, stop = get_sample_range(
+            time_window=time_window,
+            rate=ecephys_rate,
+            n_samples=self.h5_files.get_n_samples(path_processed, 'Vmfd')
+        )
+        trace_data = get_trace_data(
+            file_path=path_processed,
+            dataset_name='Vmfd',
+            start=start,
+            stop=stop,
+            **(trace_options or dict())
+        )
+        electrical_series = pynwb.ecephys.ElectricalSeries(
+            name=metadata_ecephys['ElectricalSeries_processed']['name'],
+            description=metadata_ecephys['ElectricalSeries_processed']['description'],
+            data=trace_data,
+            electrodes=electrode_table_region,
+            starting_time=start / ecephys_rate,
+            rate=ecephys_rate,
+        )
 
-            # Stores processed data
-            ecephys_module = nwbfile.create_processing_module(
-                name='ecephys',
-                description='contains extracellular electrophysiology processed data'
+        # Stores processed data
+        ecephys_module = nwbfile.create_processing_module(
+            name='ecephys',
+            description='contains extracellular electrophysiology processed data'
+        )
+        ecephys_module.add(electrical_series)
+        if add_pyramid:
+            add_trace_pyramid(
+                nwbfile=nwbfile,
+                series=electrical_series,
+                file_path=path_processed,
+                dataset_name='Vmfd',
+                start=start,
+                stop=stop,
+                h5_files=self.h5_files,
+                profiler=self.profiler
             )
-            ecephys_module.add(electrical_series)
 
-    def _create_ecephys_spiking(self, nwbfile: NWBFile, metadata_ecephys: dict):
+    def _create_ecephys_spiking(self, nwbfile: NWBFile, metadata_ecephys: dict, time_window: tuple = None):
         """Add spiking data"""
         print('Converting spiking data...')
-        with h5py.File(self.source_data['path_ecephys_processed'], 'r') as f:
-            spike_times = np.where(f['spk'][0])[0] * f['dte'][0]
-            nwbfile.add_unit(spike_times=spike_times)
+        path_processed = self.source_data['path_ecephys_processed']
+        dte = self.h5_files.get_scalar(path_processed, 'dte')
+        start, stop = get_sample_range(
+            time_window=time_window,
+            rate=1 / dte,
+            n_samples=self.h5_files.get_n_samples(path_processed, 'spk')
+        )
+        spike_samples = find_nonzero_samples(
+            file_path=path_processed,
+            dataset_name='spk',
+            start=start,
+            stop=stop,
+            h5_files=self.h5_files,
+            profiler=self.profiler
+        )
+        nwbfile.add_unit(spike_times=spike_samples * dte)
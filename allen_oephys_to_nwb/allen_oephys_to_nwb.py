@@ -1,10 +1,19 @@
 from nwb_conversion_tools import NWBConverter
+from pynwb import NWBFile, NWBHDF5IO
+from pynwb.epoch import TimeIntervals
+from hdmf.common import VectorData
+from contextlib import contextmanager
+from typing import Optional
+from pathlib import Path
+from copy import deepcopy
 
 from .allen_ophys_interface import AllenOphysInterface
 from .allen_ecephys_interface import AllenEcephysInterface
+from .hdf5_utils import get_passthrough_datasets, write_passthrough_chunks, H5FileCache
+from .utils import get_time_window, close_data_chunk_iterators
+from .profiling import ConversionProfiler
 
 import numpy as np
-import h5py
 
 
 class AllenOephysNWBConverter(NWBConverter):
@@ -15,32 +24,156 @@ class AllenOephysNWBConverter(NWBConverter):
         'AllenOphysInterface': AllenOphysInterface,
     }
 
-    def add_trials(self):
-        """Add trials data"""
-        with h5py.File(self.source_paths['path_processed'], 'r') as f:
+    def __init__(self, source_data):
+        super().__init__(source_data=source_data)
+        # One cache of source file handles for the whole session, shared by all data interfaces
+        self.h5_files = H5FileCache()
+        for data_interface in self.data_interface_objects.values():
+            data_interface.h5_files = self.h5_files
+        self.set_profiler(ConversionProfiler(enabled=False))
+
+    def set_profiler(self, profiler: ConversionProfiler):
+        """Record the stages of the converter and of all data interfaces with profiler"""
+        self.profiler = profiler
+        for data_interface in self.data_interface_objects.values():
+            data_interface.profiler = profiler
+
+    @contextmanager
+    def _profile(self, profile_path):
+        """Profile the enclosed conversion with a new profiler and save its report at profile_path"""
+        if profile_path is None:
+            yield
+            return
+        self.set_profiler(ConversionProfiler())
+        try:
+            with self.profiler.stage('run_conversion'):
+                yield
+        finally:
+            self.profiler.save_report(profile_path)
+            print(f'Profile report saved at {profile_path}')
+
+    def get_metadata(self):
+        """Auto-fill as much of the metadata as possible, opening each source file once"""
+        with self.h5_files.session():
+            return super().get_metadata()
+
+    def run_conversion(self, metadata: dict, save_to_file: bool = True, nwbfile_path: Optional[str] = None,
+                       overwrite: bool = False, nwbfile: Optional[NWBFile] = None,
+                       conversion_options: Optional[dict] = None, include_trials: bool = False,
+                       stub_test: bool = False, t_start: Optional[float] = None, t_stop: Optional[float] = None,
+                       profile_path: Optional[str] = None):
+        """
+        Build nwbfile object and, if save_to_file, write it to nwbfile_path.
+
+        When writing a new file, datasets copied unchanged from source (voltage traces and
+        fluorescence) are filled with their raw compressed source chunks after the NWB file
+        is written, unless 'passthrough_chunks' is set to False in conversion_options.
+        If include_trials, the drifting grating sweeps are added as the trials table; this
+        is not supported when appending to an existing file.
+        stub_test, t_start and t_stop restrict every stream and the trials to the same time
+        window, see utils.get_time_window. They are the defaults of the matching conversion
+        options of each data interface.
+        If profile_path is given, the wall time, CPU time, I/O and peak memory of each
+        stage of the conversion are saved there as a JSON report, see profiling.ConversionProfiler.
+        """
+        with self.h5_files.session(), self._profile(profile_path):
+            conversion_options = deepcopy(conversion_options) if conversion_options is not None else dict()
+            write_new_file = save_to_file and nwbfile is None and nwbfile_path is not None \
+                and (overwrite or not Path(nwbfile_path).is_file())
+            time_window = get_time_window(stub_test=stub_test, t_start=t_start, t_stop=t_stop)
+            for interface_name in self.data_interface_objects:
+                interface_options = conversion_options.setdefault(interface_name, dict())
+                window_options = dict(stub_test=stub_test, t_start=t_start, t_stop=t_stop)
+                for key, value in window_options.items():
+                    if time_window is not None and value is not None:
+                        interface_options.setdefault(key, value)
+                if write_new_file:
+                    interface_options.setdefault('passthrough_chunks', True)
+                else:
+                    interface_options['passthrough_chunks'] = False
+
+            if save_to_file and not write_new_file:
+                if include_trials:
+                    print('Trials can only be added to new files. Skipping them...')
+                return super().run_conversion(
+                    metadata=metadata,
+                    save_to_file=save_to_file,
+                    nwbfile_path=nwbfile_path,
+                    overwrite=overwrite,
+                    nwbfile=nwbfile,
+                    conversion_options=conversion_options
+                )
+
+            with self.profiler.stage('build'):
+                nwbfile = super().run_conversion(
+                    metadata=metadata,
+                    save_to_file=False,
+                    nwbfile=nwbfile,
+                    conversion_options=conversion_options
+                )
+            if include_trials:
+                with self.profiler.stage('add_trials'):
+                    self.add_trials(nwbfile=nwbfile, time_window=time_window)
+            if not save_to_file:
+                return nwbfile
+
+            try:
+                with self.profiler.stage('write'), NWBHDF5IO(nwbfile_path, mode='w') as io:
+                    # Write chunks of all iterated datasets round-robin, so that e.g. TIFF channels are ingested in one pass
+                    io.write(nwbfile, exhaust_dci=False)
+                    passthrough_datasets = get_passthrough_datasets(io=io, nwbfile=nwbfile)
+            finally:
+                # Stop the threads and decoding workers of iterators left unfinished if writing failed
+                close_data_chunk_iterators(nwbfile)
+            if len(passthrough_datasets) > 0:
+                print('Copying source chunks...')
+                with self.profiler.stage('copy_source_chunks'):
+                    write_passthrough_chunks(nwbfile_path=nwbfile_path, passthrough_datasets=passthrough_datasets)
+            print(f"NWB file saved at {nwbfile_path}!")
+
+    def get_path_processed(self):
+        """Return the processed source file given to any of the data interfaces"""
+        for interface_name, path_key in [('AllenEcephysInterface', 'path_ecephys_processed'),
+                                         ('AllenOphysInterface', 'path_ophys_processed')]:
+            if interface_name in self.data_interface_objects:
+                source_data = self.data_interface_objects[interface_name].source_data
+                if path_key in source_data:
+                    return source_data[path_key]
+        return None
+
+    def add_trials(self, nwbfile: NWBFile, time_window: tuple = None):
+        """Add trials data, only the trials starting within time_window if given"""
+        print('Adding trials...')
+        path_processed = self.get_path_processed()
+        if path_processed is None:
+            print('No processed file given, skipping trials...')
+            return
+        with self.h5_files.open(path_processed) as f:
             if ('iStimOn' in f) and ('iStimOff' in f):
-                stim_on = f['iStimOn'][:][0]
-                stim_off = f['iStimOff'][:][0]
-                trial_times = np.hstack((stim_on.reshape(-1, 1), stim_off.reshape((-1, 1)))).reshape(-1) * f['dte'][0]
-                trial_times = np.append(trial_times, trial_times[-1] + 0.25)
-                sweep_order = np.squeeze(f['sweep_order'][:])
+                dte = self.h5_files.get_scalar(path_processed, 'dte')
+                sweep_order = np.squeeze(f['sweep_order'][:]).reshape(-1)
+                n_trials = len(sweep_order)
+                start_time = f['iStimOn'][0][:n_trials] * dte
+                stop_time = f['iStimOff'][0][:n_trials] * dte
+                # sweep_order is -1 for blank sweeps, which index the all-NaN first row
                 sweep_table = f['sweep_table'][:].T.reshape((-1, 4))
-                sweep_table = np.vstack((np.array([[np.nan, np.nan, np.nan, np.nan]]), sweep_table))
-
-                self.nwbfile.add_trial_column(name='orientation', description='description')
-                self.nwbfile.add_trial_column(name='phase', description='description')
-                self.nwbfile.add_trial_column(name='spatial_frequency', description='description')
-                self.nwbfile.add_trial_column(name='contrast', description='description')
-
-                for i, stim in enumerate(sweep_order):
-                    stim = int(stim + 1)
-                    self.nwbfile.add_trial(
-                        start_time=trial_times[i],
-                        stop_time=trial_times[i + 1],
-                        orientation=sweep_table[stim, 0],
-                        phase=sweep_table[stim, 1],
-                        spatial_frequency=sweep_table[stim, 2],
-                        contrast=sweep_table[stim, 3]
-                    )
+                sweep_table = np.vstack((np.full((1, 4), np.nan), sweep_table))
+                trial_params = sweep_table[(sweep_order + 1).astype(int)]
+                if time_window is not None:
+                    in_window = (start_time >= time_window[0]) & (start_time < time_window[1])
+                    start_time, stop_time, trial_params = start_time[in_window], stop_time[in_window], \
+                        trial_params[in_window]
+
+                columns = [
+                    VectorData(name='start_time', description='Start time of epoch, in seconds', data=start_time),
+                    VectorData(name='stop_time', description='Stop time of epoch, in seconds', data=stop_time),
+                ]
+                for i, column_name in enumerate(['orientation', 'phase', 'spatial_frequency', 'contrast']):
+                    columns.append(VectorData(name=column_name, description='description', data=trial_params[:, i]))
+                nwbfile.trials = TimeIntervals(
+                    name='trials',
+                    description='experimental trials',
+                    columns=columns
+                )
             else:
                 print('This file does not have stimulation data!')
@@ -1,43 +1,46 @@
 from nwb_conversion_tools.basedatainterface import BaseDataInterface
-from nwb_conversion_tools.utils import get_schema_from_hdmf_class
 from nwb_conversion_tools.json_schema_utils import get_base_schema
 from pynwb import NWBFile
 import pynwb
-from hdmf.data_utils import DataChunkIterator
 
-import importlib.resources as pkg_resources
-from libtiff import TIFF
-from PIL import Image as pImage
-import numpy as np
-import json
-import h5py
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 
-from . import schema
-from .utils import get_basic_metadata
+from .utils import (get_basic_metadata, load_source_schema, get_hdmf_class_schema, get_pixel_mask,
+                    get_image_mask, get_roi_outline, get_time_window, get_sample_range, add_trace_pyramid)
+from .hdf5_utils import get_trace_data, H5FileCache
+from .profiling import ConversionProfiler
+from .tiff_utils import TiffFrameDataChunkIterator, PrefetchDataChunkIterator, get_frame_index
 
 
 class AllenOphysInterface(BaseDataInterface):
 
+    def __init__(self, **source_data):
+        super().__init__(**source_data)
+        # Source file handles, shared with the other interfaces when run from AllenOephysNWBConverter
+        self.h5_files = H5FileCache()
+        # Disabled unless set by AllenOephysNWBConverter.run_conversion with a profile_path
+        self.profiler = ConversionProfiler(enabled=False)
+
     @classmethod
     def get_source_schema(cls):
-        with pkg_resources.open_text(schema, 'source_schema_ophys.json') as f:
-            source_schema = json.load(f)
-        return source_schema
+        return load_source_schema('source_schema_ophys.json')
 
     def get_metadata_schema(self):
         metadata_schema = super().get_metadata_schema()
         metadata_schema['properties']['Ophys'] = get_base_schema(tag='Ophys')
-        metadata_schema['properties']['Ophys']['properties']['Device'] = get_schema_from_hdmf_class(pynwb.device.Device)
-        metadata_schema['properties']['Ophys']['properties']['ImagingPlane'] = get_schema_from_hdmf_class(pynwb.ophys.ImagingPlane)
-        metadata_schema['properties']['Ophys']['properties']['TwoPhotonSeries_green'] = get_schema_from_hdmf_class(pynwb.ophys.TwoPhotonSeries)
-        metadata_schema['properties']['Ophys']['properties']['Fluorescence'] = get_schema_from_hdmf_class(pynwb.ophys.Fluorescence)
+        metadata_schema['properties']['Ophys']['properties']['Device'] = get_hdmf_class_schema(pynwb.device.Device)
+        metadata_schema['properties']['Ophys']['properties']['ImagingPlane'] = get_hdmf_class_schema(pynwb.ophys.ImagingPlane)
+        metadata_schema['properties']['Ophys']['properties']['TwoPhotonSeries_green'] = get_hdmf_class_schema(pynwb.ophys.TwoPhotonSeries)
+        metadata_schema['properties']['Ophys']['properties']['TwoPhotonSeries_red'] = get_hdmf_class_schema(pynwb.ophys.TwoPhotonSeries)
+        metadata_schema['properties']['Ophys']['properties']['Fluorescence'] = get_hdmf_class_schema(pynwb.ophys.Fluorescence)
 
         return metadata_schema
 
     def get_metadata(self):
         """Auto-fill as much of the metadata as possible."""
 
-        metadata = get_basic_metadata(source_data=self.source_data)
+        metadata = get_basic_metadata(source_data=self.source_data, h5_files=self.h5_files)
         metadata['Ophys'] = dict(
             Device=dict(name='Bruker 2-p microscope'),
             Fluorescence=dict(
@@ -67,36 +70,85 @@ class AllenOphysInterface(BaseDataInterface):
                 imaging_plane='ImagingPlane'
             )
         )
+        if 'path_tiff_red_channel' in self.source_data:
+            metadata['Ophys']['TwoPhotonSeries_red'] = dict(
+                name='TwoPhotonSeries_red',
+                imaging_plane='ImagingPlane'
+            )
 
         return metadata
 
     def run_conversion(self, nwbfile: NWBFile, metadata: dict,
                        stub_test: bool = False, add_ophys_processed: bool = False,
-                       add_ophys_raw: bool = False, link_ophys_raw: bool = False):
+                       add_ophys_raw: bool = False, link_ophys_raw: bool = False,
+                       stream_data: bool = True, chunk_size: int = 10_000,
+                       compression: str = 'gzip', compression_opts: int = 4,
+                       passthrough_chunks: bool = False, n_decode_workers: int = 1,
+                       t_start: Optional[float] = None, t_stop: Optional[float] = None,
+                       add_trace_pyramids: bool = False):
         """
         Options:
+        stub_test : boolean
+            Convert only the first seconds of the session, from t_start if given.
         add_ophys_raw : boolean
         add_ophys_processed : boolean
         link_ophys_raw : boolean
+        stream_data : boolean
+            Read the fluorescence trace from source chunk by chunk while writing, instead of loading it whole.
+        chunk_size : int
+            Number of samples per chunk of the written fluorescence trace.
+        compression : str
+            Compression filter of the written fluorescence trace ('gzip', 'lzf' or None).
+        compression_opts : int
+            Compression level, used only with 'gzip'.
+        passthrough_chunks : boolean
+            Copy compressed source chunks of the fluorescence trace unchanged, when their layout allows it.
+            The chunks are only copied when the file is written by AllenOephysNWBConverter.run_conversion.
+        n_decode_workers : int
+            Number of worker processes decoding compressed raw TIFF pages. Uncompressed pages are memory-mapped instead.
+        t_start, t_stop : float
+            Convert only the frames and fluorescence samples within [t_start, t_stop), in seconds.
+            Only that part is read from source. Linked TIFF files are always linked whole.
+        add_trace_pyramids : boolean
+            Also store min/max envelopes of the fluorescence trace at power-of-two resolutions,
+            see utils.add_trace_pyramid.
         """
-        if add_ophys_raw or add_ophys_processed:
-            # Device
-            nwbfile.create_device(**metadata['Ophys']['Device'])
-
-        # Processed ophys series
-        if add_ophys_processed:
-            self._create_ophys_processed(
-                nwbfile=nwbfile,
-                metadata=metadata
-            )
+        time_window = get_time_window(stub_test=stub_test, t_start=t_start, t_stop=t_stop)
+        trace_options = dict(
+            stream_data=stream_data,
+            chunk_size=chunk_size,
+            compression=compression,
+            compression_opts=compression_opts,
+            passthrough_chunks=passthrough_chunks,
+            h5_files=self.h5_files,
+            profiler=self.profiler
+        )
+        with self.h5_files.session(), self.profiler.stage('AllenOphysInterface'):
+            if add_ophys_raw or add_ophys_processed:
+                # Device
+                nwbfile.create_device(**metadata['Ophys']['Device'])
 
-        # Raw ophys series
-        if add_ophys_raw:
-            self._create_ophys_raw(
-                nwbfile=nwbfile,
-                metadata=metadata,
-                link_ophys_raw=link_ophys_raw
-            )
+            # Processed ophys series
+            if add_ophys_processed:
+                with self.profiler.stage('ophys_processed'):
+                    self._create_ophys_processed(
+                        nwbfile=nwbfile,
+                        metadata=metadata,
+                        trace_options=trace_options,
+                        time_window=time_window,
+                        add_pyramid=add_trace_pyramids
+                    )
+
+            # Raw ophys series
+            if add_ophys_raw:
+                with self.profiler.stage('ophys_raw'):
+                    self._create_ophys_raw(
+                        nwbfile=nwbfile,
+                        metadata=metadata,
+                        link_ophys_raw=link_ophys_raw,
+                        n_decode_workers=n_decode_workers,
+                        time_window=time_window
+                    )
 
     def _get_imaging_plane(self, nwbfile: NWBFile, metadata_imgplane: dict):
         """Add new / return existing Imaging Plane"""
@@ -135,14 +187,16 @@ class AllenOphysInterface(BaseDataInterface):
 
         return imaging_plane
 
-    def _create_ophys_processed(self, nwbfile: NWBFile, metadata: dict):
+    def _create_ophys_processed(self, nwbfile: NWBFile, metadata: dict, trace_options: dict = None,
+                                time_window: tuple = None, add_pyramid: bool = False):
         """Add Fluorescence data"""
         print('Converting processed ophys data...')
         imaging_plane = self._get_imaging_plane(
             nwbfile=nwbfile,
             metadata_imgplane=metadata['Ophys']['ImagingPlane']
         )
-        with h5py.File(self.source_data['path_ophys_processed'], 'r') as f:
+        path_processed = self.source_data['path_ophys_processed']
+        with self.h5_files.open(path_processed) as f:
             # Stores segmented data
             ophys_module = nwbfile.create_processing_module(
                 name='ophys',
@@ -160,55 +214,76 @@ class AllenOphysInterface(BaseDataInterface):
                 imaging_plane=imaging_plane,
             )
 
-            # ROIs
-            n_rows = int(f['linesPerFrame'][0])
-            n_cols = int(f['pixelsPerLine'][0][0])
-            pixel_mask = []
-            for pi in np.squeeze(f['pixel_list'][:]):
-                row = int(pi // n_rows)
-                col = int(pi % n_rows)
-                pixel_mask.append([col, row, 1])
-            plane_segmentation.add_roi(pixel_mask=pixel_mask)
+            # ROIs, with their dense image mask and outline so that viewers do not have to compute them
+            with self.profiler.stage('pixel_mask'):
+                n_rows = int(self.h5_files.get_scalar(path_processed, 'linesPerFrame'))
+                n_cols = int(self.h5_files.get_scalar(path_processed, 'pixelsPerLine'))
+                pixel_mask = get_pixel_mask(pixel_list=f['pixel_list'][:], n_rows=n_rows)
+                image_mask = get_image_mask(pixel_mask=pixel_mask, image_shape=(n_rows, n_cols)).astype('uint8')
+                plane_segmentation.add_column(
+                    name='outline',
+                    description='outline of the ROI pixels drawn over a frame: column and row of each '
+                                'vertex, in pixels; closed loops are separated by rows of NaN',
+                    index=True
+                )
+                # add_roi only accepts (n, 3) lists, so the structured pixel mask goes through add_row
+                plane_segmentation.add_row(
+                    pixel_mask=pixel_mask,
+                    image_mask=image_mask,
+                    outline=get_roi_outline(image_mask)
+                )
 
             # Fluorescene data
             meta_fluorescence = metadata['Ophys']['Fluorescence']
             fl = pynwb.ophys.Fluorescence(name=meta_fluorescence['name'])
             ophys_module.add(fl)
 
-            with h5py.File(self.source_data['path_ophys_processed'], 'r') as fc:
-                # fluorescence_mean_trace = np.squeeze(fc['dff'])
-                fluorescence_mean_trace = np.squeeze(fc['f_cell'])
-                rt_region = plane_segmentation.create_roi_table_region(
-                    description='unique cell ROI',
-                    region=[0]
-                )
+            # fluorescence_mean_trace = np.squeeze(f['dff'])
+            imaging_rate = 1 / self.h5_files.get_scalar(path_processed, 'dto')
+            start, stop = get_sample_range(
+                time_window=time_window,
+                rate=imaging_rate,
+                n_samples=self.h5_files.get_n_samples(path_processed, 'f_cell')
+            )
+            fluorescence_mean_trace = get_trace_data(
+                file_path=path_processed,
+                dataset_name='f_cell',
+                start=start,
+                stop=stop,
+                **(trace_options or dict())
+            )
+            rt_region = plane_segmentation.create_roi_table_region(
+                description='unique cell ROI',
+                region=[0]
+            )
 
-                imaging_rate = 1 / fc['dto'][0]
-                fl.create_roi_response_series(
-                    name=meta_fluorescence['roi_response_series'][0]['name'],
-                    data=fluorescence_mean_trace,
-                    rois=rt_region,
-                    rate=imaging_rate,
-                    starting_time=0.,
-                    unit='no unit'
+            roi_response_series = fl.create_roi_response_series(
+                name=meta_fluorescence['roi_response_series'][0]['name'],
+                data=fluorescence_mean_trace,
+                rois=rt_region,
+                rate=imaging_rate,
+                starting_time=start / imaging_rate,
+                unit='no unit'
+            )
+            if add_pyramid:
+                add_trace_pyramid(
+                    nwbfile=nwbfile,
+                    series=roi_response_series,
+                    file_path=path_processed,
+                    dataset_name='f_cell',
+                    start=start,
+                    stop=stop,
+                    h5_files=self.h5_files,
+                    profiler=self.profiler
                 )
 
     def _create_ophys_raw(self, nwbfile: NWBFile, metadata: dict,
-                          link_ophys_raw: bool):
-        """Add raw ophys data from tiff files"""
+                          link_ophys_raw: bool, n_decode_workers: int = 1, time_window: tuple = None):
+        """Add raw ophys data from the green and, if given, red channel tiff files"""
         print('Converting raw ophys data...')
 
-        # Iteratively read tiff ophys data
-        def tiff_iterator(paths_tiff):
-            for tf in paths_tiff:
-                tif = TIFF.open(tf)
-                for image in tif.iter_images():
-                    yield image
-                tif.close()
-
         # Get imaging rate
-        with h5py.File(self.source_data['path_ophys_processed'], 'r') as f:
-            imaging_rate = 1 / f['dto'][0]
+        imaging_rate = 1 / self.h5_files.get_scalar(self.source_data['path_ophys_processed'], 'dto')
 
         # Imaging Plane
         imaging_plane = self._get_imaging_plane(
@@ -216,35 +291,63 @@ class AllenOphysInterface(BaseDataInterface):
             metadata_imgplane=metadata['Ophys']['ImagingPlane']
         )
 
-        metadata_twops = metadata['Ophys']['TwoPhotonSeries_green']
+        channels = [
+            (key, self.source_data[path_key])
+            for key, path_key in [('TwoPhotonSeries_green', 'path_tiff_green_channel'),
+                                  ('TwoPhotonSeries_red', 'path_tiff_red_channel')]
+            if path_key in self.source_data
+        ]
 
-        # Link to raw data files
+        # Index the channels concurrently, the readers below reuse the indexes. Linked files are not read:
+        # their number of frames is that of the fluorescence trace
         if link_ophys_raw:
-            starting_frames = [0]
-            for i, tf in enumerate(self.source_data['path_tiff_green_channel'][0:-1]):
-                n_frames = pImage.open(tf).n_frames
-                starting_frames.append(n_frames + starting_frames[i])
-            two_photon_series = pynwb.ophys.TwoPhotonSeries(
-                name=metadata_twops['name'],
-                imaging_plane=imaging_plane,
-                format='tiff',
-                external_file=self.source_data['paths_tiff'],
-                starting_frame=starting_frames,
-                starting_time=0.,
-                rate=imaging_rate,
-                unit='no unit'
-            )
-        # Store raw data
+            n_frames = self.h5_files.get_n_samples(self.source_data['path_ophys_processed'], 'f_cell')
         else:
-            raw_data_iterator = DataChunkIterator(
-                data=tiff_iterator([self.source_data['path_tiff_green_channel']])
-            )
-            two_photon_series = pynwb.ophys.TwoPhotonSeries(
-                name=metadata_twops['name'],
-                imaging_plane=imaging_plane,
-                data=raw_data_iterator,
-                starting_time=0.,
-                rate=imaging_rate,
-                unit='no unit'
-            )
-        nwbfile.add_acquisition(two_photon_series)
+            with ThreadPoolExecutor(max_workers=max(1, len(channels))) as executor:
+                frame_indexes = list(executor.map(get_frame_index, [path for _, path in channels]))
+            if len(set(frame_index['n_frames'] for frame_index in frame_indexes)) > 1:
+                print('TIFF channels do not have the same number of frames.')
+
+        for i, (key, path_tiff) in enumerate(channels):
+            metadata_twops = metadata['Ophys'].get(key, dict(name=key))
+
+            # Link to raw data files
+            if link_ophys_raw:
+                two_photon_series = pynwb.ophys.TwoPhotonSeries(
+                    name=metadata_twops['name'],
+                    imaging_plane=imaging_plane,
+                    format='external',
+                    external_file=[path_tiff],
+                    starting_frame=[0],
+                    num_samples=n_frames,
+                    starting_time=0.,
+                    rate=imaging_rate,
+                    unit='no unit'
+                )
+            # Store raw data
+            else:
+                # Iteratively read tiff ophys data. Frames that must be decoded are read ahead of the writer,
+                # so that channels are read concurrently; memory-mapped frames are handed over as they are
+                start, stop = get_sample_range(
+                    time_window=time_window,
+                    rate=imaging_rate,
+                    n_samples=frame_indexes[i]['n_frames']
+                )
+                raw_data_iterator = TiffFrameDataChunkIterator(
+                    file_paths=[path_tiff],
+                    n_workers=n_decode_workers,
+                    start=start,
+                    stop=stop,
+                    profiler=self.profiler
+                )
+                if not raw_data_iterator.is_memmapped:
+                    raw_data_iterator = PrefetchDataChunkIterator(raw_data_iterator, profiler=self.profiler)
+                two_photon_series = pynwb.ophys.TwoPhotonSeries(
+                    name=metadata_twops['name'],
+                    imaging_plane=imaging_plane,
+                    data=raw_data_iterator,
+                    starting_time=start / imaging_rate,
+                    rate=imaging_rate,
+                    unit='no unit'
+                )
+            nwbfile.add_acquisition(two_photon_series)
@@ -0,0 +1,481 @@
+from nwb_conversion_tools.json_schema_utils import dict_deep_update
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from copy import deepcopy
+import traceback
+import hashlib
+import json
+import time
+import os
+import yaml
+
+from .allen_oephys_to_nwb import AllenOephysNWBConverter
+from .profiling import aggregate_reports, get_profile_path
+
+
+def load_dict_file(file_path):
+    """Load a dictionary from a JSON or YAML file"""
+    file_path = Path(file_path)
+    with open(file_path, 'r') as f:
+        if file_path.suffix in ['.yml', '.yaml']:
+            return yaml.safe_load(f)
+        return json.load(f)
+
+
+def load_manifest(path_manifest):
+    """
+    Load a batch conversion manifest from a JSON or YAML file.
+
+    The manifest holds a list of sessions, either at its root or under 'sessions',
+    and optionally default 'conversion_options' and 'metadata' shared by all sessions.
+    Each session is a dict with keys:
+        session_id : str
+        source_data : dict, source data for AllenOephysNWBConverter
+        conversion_options : dict, optional, updates the default conversion options
+        metadata : dict, optional, updates the default metadata
+        nwbfile_path : str, optional, defaults to <path_output>/<session_id>.nwb
+    """
+    manifest = load_dict_file(path_manifest)
+    if isinstance(manifest, list):
+        manifest = dict(sessions=manifest)
+    return manifest
+
+
+JOURNAL_VERSION = 1
+
+
+def get_source_files(source_data: dict):
+    """Return the paths of all existing source files of a session, from every interface"""
+    files = set()
+    for interface_source_data in source_data.values():
+        for key, value in interface_source_data.items():
+            if key.startswith('path_') and isinstance(value, str) and Path(value).is_file():
+                files.add(str(Path(value).resolve()))
+    return sorted(files)
+
+
+def get_file_fingerprint(file_path, use_hash: bool = False):
+    """Return size and mtime of a file, or its size and SHA-1 if use_hash"""
+    stat = os.stat(file_path)
+    if not use_hash:
+        return dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 24), b''):
+            sha1.update(block)
+    return dict(size=stat.st_size, sha1=sha1.hexdigest())
+
+
+def get_session_fingerprint(session: dict, settings: dict, use_hash: bool = False):
+    """
+    Fingerprint the inputs of a session conversion: its source files, and the session
+    entry and batch settings (metadata, conversion options...) it is converted with.
+    """
+    settings_json = json.dumps(dict(session=session, settings=settings), sort_keys=True, default=str)
+    return dict(
+        files={f: get_file_fingerprint(f, use_hash=use_hash) for f in get_source_files(session['source_data'])},
+        settings=hashlib.sha1(settings_json.encode()).hexdigest()
+    )
+
+
+def load_journal(path_journal):
+    """Load a batch conversion journal, or return an empty one if it does not exist or is unreadable"""
+    try:
+        with open(path_journal, 'r') as f:
+            journal = json.load(f)
+        if journal.get('version') == JOURNAL_VERSION:
+            return journal
+    except (OSError, ValueError):
+        pass
+    return dict(version=JOURNAL_VERSION, sessions=dict())
+
+
+def get_nwbfile_path(session: dict, path_output):
+    """Return the NWB file path of a session entry, defaulting to <path_output>/<session_id>.nwb"""
+    return Path(session.get('nwbfile_path', str(Path(path_output) / f"{session['session_id']}.nwb")))
+
+
+def get_part_path(nwbfile_path):
+    """Return the path '<stem>.part.nwb' a NWB file is written to before being renamed to nwbfile_path"""
+    nwbfile_path = Path(nwbfile_path)
+    return nwbfile_path.with_name(nwbfile_path.stem + '.part.nwb')
+
+
+def owns_nwbfile(entry: dict, nwbfile_path):
+    """
+    Whether the journal entry of a session shows that any file at nwbfile_path was written by
+    this batch, and so may be replaced. Journals written before this was recorded only tell it
+    for converted sessions.
+    """
+    if entry is None or entry['nwbfile_path'] != str(nwbfile_path):
+        return False
+    return entry.get('owns_nwbfile', entry['status'] == 'success')
+
+
+def save_journal(journal: dict, path_journal):
+    """Write the journal atomically, so that it is intact even if the process dies while writing"""
+    path_journal = Path(path_journal)
+    tmp_path = path_journal.with_name(path_journal.name + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(journal, f, indent=4)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path_journal)
+
+
+def convert_session(session: dict, path_output, metadata: dict = None, conversion_options: dict = None,
+                    include_trials: bool = False, overwrite: bool = False, stub_test: bool = False,
+                    profile: bool = False):
+    """
+    Convert a single session, returning a summary of the result instead of raising.
+
+    The NWB file is written to '<nwbfile_path stem>.part.nwb' and renamed to nwbfile_path
+    once complete, so nwbfile_path never holds a partially written file.
+
+    Parameters
+    ----------
+    session : dict
+        Session entry of the manifest, see load_manifest.
+    path_output : str, Path
+        Directory where the NWB file is written, unless the session sets nwbfile_path.
+    metadata : dict
+        Metadata applied on top of the metadata fetched from the source files.
+    conversion_options : dict
+        Conversion options for AllenOephysNWBConverter.run_conversion.
+    include_trials : bool
+        Add the trials table.
+    overwrite : bool
+        Overwrite an existing NWB file. If False, the session fails if nwbfile_path exists.
+    stub_test : bool
+        Convert only the first seconds of the session, e.g. to validate metadata.
+    profile : bool
+        Save a profile report of the conversion as '<session nwb file stem>.profile.json'.
+
+    Returns
+    -------
+    dict
+        session_id, nwbfile_path, status ('success' or 'failed'), error, duration in seconds
+        and profile_path.
+    """
+    session_id = str(session['session_id'])
+    nwbfile_path = get_nwbfile_path(session, path_output)
+    tmp_path = get_part_path(nwbfile_path)
+    result = dict(
+        session_id=session_id,
+        nwbfile_path=str(nwbfile_path),
+        status='success',
+        error=None,
+        duration=None,
+        profile_path=str(get_profile_path(nwbfile_path)) if profile else None,
+    )
+    t0 = time.perf_counter()
+    try:
+        if nwbfile_path.is_file() and not overwrite:
+            raise FileExistsError(f'{nwbfile_path} already exists')
+        nwbfile_path.parent.mkdir(parents=True, exist_ok=True)
+        converter = AllenOephysNWBConverter(source_data=session['source_data'])
+        session_metadata = converter.get_metadata()
+        session_metadata = dict_deep_update(session_metadata, deepcopy(metadata or dict()), append_list=False)
+        session_metadata = dict_deep_update(
+            session_metadata, deepcopy(session.get('metadata', dict())), append_list=False
+        )
+        session_options = dict_deep_update(
+            deepcopy(conversion_options or dict()),
+            deepcopy(session.get('conversion_options', dict())),
+            append_list=False
+        )
+        converter.run_conversion(
+            metadata=session_metadata,
+            nwbfile_path=str(tmp_path),
+            save_to_file=True,
+            overwrite=True,
+            conversion_options=session_options,
+            include_trials=include_trials,
+            stub_test=stub_test,
+            profile_path=result['profile_path']
+        )
+        with open(tmp_path, 'rb') as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_path, nwbfile_path)
+    except Exception:
+        result['status'] = 'failed'
+        result['error'] = traceback.format_exc()
+        if tmp_path.is_file():
+            tmp_path.unlink()
+    result['duration'] = time.perf_counter() - t0
+    return result
+
+
+def run_batch_conversion(sessions: list, path_output, metadata: dict = None, conversion_options: dict = None,
+                         include_trials: bool = False, overwrite: bool = False, n_workers: int = None,
+                         path_summary=None, stub_test: bool = False, resume: bool = True,
+                         path_journal=None, hash_sources: bool = False, profile: bool = False):
+    """
+    Convert many sessions in parallel over a pool of worker processes.
+
+    A failure in one session is recorded in the summary and does not stop the others.
+    The status of every session is recorded in a journal, rewritten atomically as each
+    session finishes. When resuming, sessions the journal records as converted are
+    skipped, as long as their NWB file exists and neither their source files nor the
+    settings they are converted with have changed.
+
+    Parameters
+    ----------
+    sessions : list of dict
+        Session entries, see load_manifest.
+    path_output : str, Path
+        Directory where NWB files are written.
+    metadata : dict
+        Metadata applied to all sessions, on top of the metadata fetched from the source files.
+    conversion_options : dict
+        Conversion options applied to all sessions.
+    include_trials : bool
+        Add the trials table.
+    overwrite : bool
+        Convert again sessions recorded as converted, and overwrite NWB files not written by this batch.
+    n_workers : int
+        Number of worker processes. Defaults to the number of CPUs.
+    path_summary : str, Path
+        Where to write the JSON results summary. Defaults to <path_output>/conversion_summary.json.
+    stub_test : bool
+        Convert only the first seconds of each session, e.g. to validate metadata.
+    resume : bool
+        Skip sessions already converted according to the journal.
+    path_journal : str, Path
+        Where to keep the journal. Defaults to <path_output>/conversion_journal.json.
+    hash_sources : bool
+        Compare source files by content hash instead of size and mtime when resuming.
+    profile : bool
+        Profile each conversion, see convert_session, and aggregate the reports of
+        all sessions converted in this run into <path_output>/profile_report.json.
+
+    Returns
+    -------
+    list of dict
+        Result of each session, in the order of sessions. Skipped sessions have status 'skipped'.
+    """
+    path_output = Path(path_output)
+    path_output.mkdir(parents=True, exist_ok=True)
+    if path_summary is None:
+        path_summary = path_output / 'conversion_summary.json'
+    if path_journal is None:
+        path_journal = path_output / 'conversion_journal.json'
+
+    t0 = time.perf_counter()
+    journal = load_journal(path_journal)
+    settings = dict(
+        metadata=metadata,
+        conversion_options=conversion_options,
+        include_trials=include_trials,
+        stub_test=stub_test
+    )
+    results = [None] * len(sessions)
+    fingerprints = dict()
+    to_convert = []
+    for i, session in enumerate(sessions):
+        session_id = str(session['session_id'])
+        fingerprints[session_id] = get_session_fingerprint(session, settings, use_hash=hash_sources)
+        nwbfile_path = get_nwbfile_path(session, path_output)
+        entry = journal['sessions'].get(session_id)
+        if resume and not overwrite and entry is not None and entry['status'] == 'success' \
+                and entry['fingerprint'] == fingerprints[session_id] and Path(entry['nwbfile_path']).is_file():
+            results[i] = dict(
+                session_id=session_id,
+                nwbfile_path=entry['nwbfile_path'],
+                status='skipped',
+                error=None,
+                duration=0.,
+                profile_path=None,
+            )
+        else:
+            to_convert.append(i)
+            # A file at nwbfile_path was written by this batch if the journal says so, or if there is
+            # none yet: whatever is found there after an interrupted run was then written by this batch
+            journal['sessions'][session_id] = dict(
+                status='running',
+                nwbfile_path=str(nwbfile_path),
+                owns_nwbfile=owns_nwbfile(entry, nwbfile_path) or not nwbfile_path.is_file(),
+                fingerprint=fingerprints[session_id],
+                error=None,
+                duration=None,
+            )
+    save_journal(journal, path_journal)
+
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    n_workers = max(1, min(n_workers, len(to_convert)))
+    print(f'Converting {len(to_convert)} sessions with {n_workers} workers, '
+          f'{len(sessions) - len(to_convert)} already converted...')
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = {
+            executor.submit(
+                convert_session,
+                session=sessions[i],
+                path_output=path_output,
+                metadata=metadata,
+                conversion_options=conversion_options,
+                include_trials=include_trials,
+                # NWB files written by an earlier run of this batch are replaced
+                overwrite=overwrite or journal['sessions'][str(sessions[i]['session_id'])]['owns_nwbfile'],
+                stub_test=stub_test,
+                profile=profile
+            ): i
+            for i in to_convert
+        }
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                results[i] = future.result()
+            except Exception:
+                # The worker process itself died, e.g. killed for running out of memory
+                results[i] = dict(
+                    session_id=str(sessions[i]['session_id']),
+                    nwbfile_path=None,
+                    status='failed',
+                    error=traceback.format_exc(),
+                    duration=None,
+                    profile_path=None,
+                )
+            session_id = str(sessions[i]['session_id'])
+            entry = journal['sessions'][session_id]
+            journal['sessions'][session_id] = dict(
+                status=results[i]['status'],
+                nwbfile_path=entry['nwbfile_path'],
+                # A failed conversion leaves nwbfile_path as it was
+                owns_nwbfile=results[i]['status'] == 'success' or entry['owns_nwbfile'],
+                fingerprint=fingerprints[session_id],
+                error=results[i]['error'],
+                duration=results[i]['duration'],
+            )
+            save_journal(journal, path_journal)
+            print(f"Session {session_id}: {results[i]['status']}")
+
+    n_failed = sum(r['status'] == 'failed' for r in results)
+    n_skipped = sum(r['status'] == 'skipped' for r in results)
+    summary = dict(
+        n_sessions=len(sessions),
+        n_success=len(sessions) - n_failed - n_skipped,
+        n_skipped=n_skipped,
+        n_failed=n_failed,
+        n_workers=n_workers,
+        duration=time.perf_counter() - t0,
+        sessions=results,
+    )
+    with open(path_summary, 'w') as f:
+        json.dump(summary, f, indent=4)
+    print(f'{summary["n_success"]} sessions converted, {n_skipped} skipped, {n_failed} failed. '
+          f'Summary saved at {path_summary}')
+
+    if profile:
+        reports = []
+        for r in results:
+            if r['status'] == 'success' and r['profile_path'] is not None and Path(r['profile_path']).is_file():
+                with open(r['profile_path'], 'r') as f:
+                    reports.append(json.load(f))
+        path_profile_report = path_output / 'profile_report.json'
+        with open(path_profile_report, 'w') as f:
+            json.dump(aggregate_reports(reports), f, indent=4)
+        print(f'Profile report saved at {path_profile_report}')
+
+    return results
+
+
+def parse_arguments():
+    """
+    Command line shortcut to convert all sessions listed in a manifest.
+    Usage:
+    $ nwb-oephys-batch manifest path_output [--metafile] [--n_workers] [--include_trials] [--overwrite]
+                                            [--stub_test] [--no_resume] [--hash_sources] [--profile]
+
+    manifest : str
+        Path to JSON or YAML manifest of sessions.
+    path_output : str
+        Directory where NWB files are written.
+    metafile : str
+        Optional. YAML or JSON file with metadata applied to all sessions.
+    n_workers : int
+        Optional. Number of worker processes. Defaults to the number of CPUs.
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Convert Allen oephys sessions to NWB in parallel.',
+    )
+
+    parser.add_argument(
+        "manifest",
+        help="Path to JSON or YAML manifest of sessions."
+    )
+    parser.add_argument(
+        "path_output",
+        help="Directory where NWB files are written."
+    )
+    parser.add_argument(
+        "--metafile",
+        default=None,
+        help="YAML or JSON file with metadata applied to all sessions."
+    )
+    parser.add_argument(
+        "--n_workers",
+        type=int,
+        default=None,
+        help="Number of worker processes. Defaults to the number of CPUs."
+    )
+    parser.add_argument(
+        "--include_trials",
+        action='store_true',
+        help="Add trials table."
+    )
+    parser.add_argument(
+        "--overwrite",
+        action='store_true',
+        help="Convert again sessions already converted, and overwrite existing NWB files."
+    )
+    parser.add_argument(
+        "--no_resume",
+        action='store_true',
+        help="Convert all sessions, ignoring the journal of earlier runs."
+    )
+    parser.add_argument(
+        "--hash_sources",
+        action='store_true',
+        help="Compare source files by content hash instead of size and mtime when resuming."
+    )
+    parser.add_argument(
+        "--profile",
+        action='store_true',
+        help="Save a profile report of each session and an aggregated report of the batch."
+    )
+    parser.add_argument(
+        "--stub_test",
+        action='store_true',
+        help="Convert only the first seconds of each session."
+    )
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    return args
+
+
+def cmd_line_shortcut():
+    run_args = parse_arguments()
+
+    manifest = load_manifest(run_args.manifest)
+    metadata = manifest.get('metadata', dict())
+    if run_args.metafile is not None:
+        metadata = dict_deep_update(metadata, load_dict_file(run_args.metafile), append_list=False)
+
+    run_batch_conversion(
+        sessions=manifest['sessions'],
+        path_output=run_args.path_output,
+        metadata=metadata,
+        conversion_options=manifest.get('conversion_options', dict()),
+        include_trials=run_args.include_trials,
+        overwrite=run_args.overwrite,
+        n_workers=run_args.n_workers,
+        stub_test=run_args.stub_test,
+        resume=not run_args.no_resume,
+        hash_sources=run_args.hash_sources,
+        profile=run_args.profile
+    )
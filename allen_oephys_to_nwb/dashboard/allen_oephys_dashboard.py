@@ -12,18 +12,40 @@ from dash.dependencies import Input, Output, State, ALL
 import dash
 from pathlib import Path
 import pynwb
+import uuid
 from json_schema_to_dash_forms.utils import FileBrowserComponent
 from .components.time_controller import TimeControllerComponent
 from .components.tiff_component import TiffImageSeriesComponent
+from .session_state import DashboardSession, SessionCache
+from .clientside import DRAW_TRACES_WINDOW
+from ..decimation import decimate_trace, get_pyramid_level
+from ..utils import (get_pyramid_levels, read_pyramid_window, get_processed_voltage_series,
+                     get_fluorescence_series, get_two_photon_series, get_plane_segmentation)
 
 
 class AllenDashboard(html.Div):
-    """Dashboard built with Dash version of NWB widgets"""
-    def __init__(self, parent_app, path_nwb=None):
+    """
+    Dashboard built with Dash version of NWB widgets
+
+    Traces are decimated to trace_resolution horizontal pixels before being sent to the
+    browser, with the 'minmax' envelope of each pixel or 'lttb', so the size of every
+    update is bounded whatever the length of the time window. If the NWB file holds
+    min/max pyramids of a trace (see utils.add_trace_pyramid), zoomed out windows are
+    read from the coarsest level that still has trace_resolution bins.
+
+    The open file and figures of each browser session are kept server-side in a
+    DashboardSession, identified by a session id stored in the browser. At most
+    max_sessions sessions are kept, and sessions unused for session_ttl seconds are
+    closed. path_nwb is opened if the file browser is submitted without a file.
+    """
+    def __init__(self, parent_app, path_nwb=None, trace_resolution: int = 1000, decimation: str = 'minmax',
+                 max_sessions: int = 8, session_ttl: float = 3600.):
         super().__init__([])
         self.parent_app = parent_app
         self.path_nwb = path_nwb
-        self.photon_series = []
+        self.trace_resolution = trace_resolution
+        self.decimation = decimation
+        self.sessions = SessionCache(max_sessions=max_sessions, ttl=session_ttl)
 
         # Controllers
         self.controller_time = TimeControllerComponent(
@@ -34,12 +56,13 @@ class AllenDashboard(html.Div):
 
         self.filebrowser = FileBrowserComponent(parent_app=parent_app, id_suffix='allen-dash')
 
-        if self.path_nwb is not None:
-            self.render_dashboard()
-
         # Dashboard main layout
         self.children = [
             dbc.Container([
+                dcc.Store(id='allen-dash-session-id', storage_type='session'),
+                # Base traces figure of the loaded file, and data of the current window drawn on it in the browser
+                dcc.Store(id='allen-dash-traces-base'),
+                dcc.Store(id='allen-dash-traces-window'),
                 html.Br(),
                 self.filebrowser,
                 html.Br(),
@@ -85,74 +108,39 @@ class AllenDashboard(html.Div):
         self.style = {'background-color': '#f0f0f0', 'min-height': '100vh'}
 
         @self.parent_app.callback(
-            [Output(component_id='div-figure-traces', component_property='style'), Output('figure_traces', 'figure')],
+            [
+                Output(component_id='div-figure-traces', component_property='style'),
+                Output('allen-dash-traces-window', 'data')
+            ],
             [
                 Input(component_id='slider_start_time', component_property='value'),
                 Input(component_id='input_duration', component_property='value')
-            ]
+            ],
+            [State('allen-dash-session-id', 'data')]
         )
-        def update_traces(select_start_time, select_duration):
+        def update_traces(select_start_time, select_duration, session_id):
 
             ctx = dash.callback_context
             trigger_source = ctx.triggered[0]['prop_id'].split('.')[1]
 
-            if not trigger_source:
+            session = self.sessions.get(session_id)
+            if not trigger_source or session is None:
                 raise dash.exceptions.PreventUpdate
 
-            time_window = [select_start_time, select_start_time + select_duration]
-
-            # Update electrophys trace
-            timeseries = self.ecephys_trace
-            istart = timeseries_time_to_ind(timeseries, time_window[0])
-            istop = timeseries_time_to_ind(timeseries, time_window[1])
-            yy, units = get_timeseries_in_units(timeseries, istart, istop)
-            xx = get_timeseries_tt(timeseries, istart, istop)
-            xrange0, xrange1 = min(xx), max(xx)
-            self.traces.data[0].x = xx
-            self.traces.data[0].y = list(yy)
-            self.traces.update_layout(
-                yaxis={"range": [min(yy), max(yy)], "autorange": False},
-                xaxis={"range": [xrange0, xrange1], "autorange": False}
-            )
-
-            # Update ophys trace
-            timeseries = self.ophys_trace
-            istart = timeseries_time_to_ind(timeseries, time_window[0])
-            istop = timeseries_time_to_ind(timeseries, time_window[1])
-            yy, units = get_timeseries_in_units(timeseries, istart, istop)
-            xx = get_timeseries_tt(timeseries, istart, istop)
-            self.traces.data[1].x = xx
-            self.traces.data[1].y = list(yy)
-            self.traces.update_layout(
-                yaxis3={"range": [min(yy), max(yy)], "autorange": False},
-                xaxis3={"range": [xrange0, xrange1], "autorange": False}
-            )
-
-            # Update spikes traces
-            self.update_spike_traces(time_window=time_window)
-            self.traces.update_layout(
-                xaxis2={"range": [xrange0, xrange1], "autorange": False}
-            )
-
-            # Update frame trace
-            self.start_frame_x = (xrange1 + xrange0) / 2
-            self.traces.update_layout(
-                shapes=[{
-                    'type': 'line',
-                    'x0': (xrange1 + xrange0) / 2,
-                    'x1': (xrange1 + xrange0) / 2,
-                    'xref': 'x',
-                    'y0': -1000,
-                    'y1': 1000,
-                    'yref': 'paper',
-                    'line': {
-                        'width': 4,
-                        'color': 'rgb(30, 30, 30)'
-                    }
-                }]
-            )
-
-            return {'display': "inline-block"}, self.traces
+            with session.lock:
+                return {'display': "inline-block"}, self.get_traces_window(
+                    session=session,
+                    select_start_time=select_start_time,
+                    select_duration=select_duration
+                )
+
+        # Only the data of the window comes from the server, the figure is updated in the browser
+        self.parent_app.clientside_callback(
+            DRAW_TRACES_WINDOW,
+            Output('figure_traces', 'figure'),
+            [Input('allen-dash-traces-window', 'data')],
+            [State('allen-dash-traces-base', 'data')]
+        )
 
         @self.parent_app.callback(
             [
@@ -160,21 +148,30 @@ class AllenDashboard(html.Div):
                 Output('slider_start_time', 'value'),
                 Output('div-controller', 'style'),
                 Output('div-photon-series', 'children'),
-                Output('external-update-max-time-trigger', 'children')
+                Output('external-update-max-time-trigger', 'children'),
+                Output('allen-dash-session-id', 'data'),
+                Output('allen-dash-traces-base', 'data')
             ],
             [Input('submit-filebrowser-allen-dash', component_property='n_clicks')],
-            [State('chosen-filebrowser-allen-dash', 'value')]
+            [State('chosen-filebrowser-allen-dash', 'value'), State('allen-dash-session-id', 'data')]
         )
-        def load_nwb_file(click, path):
+        def load_nwb_file(click, path, session_id):
             if click:
-                if Path(Path(self.parent_app.server.config['DATA_PATH']).parent / path).is_file() and path.endswith('.nwb'):
-                    self.path_nwb = str(Path(self.parent_app.server.config['DATA_PATH']).parent / path)
-                    self.render_dashboard()
+                if path:
+                    path_nwb = Path(self.parent_app.server.config['DATA_PATH']).parent / path
+                else:
+                    path_nwb = Path(self.path_nwb) if self.path_nwb is not None else None
+                if path_nwb is not None and path_nwb.is_file() and path_nwb.suffix == '.nwb':
+                    session = DashboardSession(path_nwb=str(path_nwb))
+                    self.render_dashboard(session)
+                    session_id = session_id if session_id is not None else uuid.uuid4().hex
+                    # Replaces, and closes, the file previously opened in this browser session
+                    self.sessions.put(session_id, session)
 
                     display = {'display': 'block'}
-                    self.controller_time.tmax = self.controller_tmax
 
-                    return 1, self.controller_tmin, display, self.photon_series, str(np.random.rand())
+                    return 1, session.controller_tmin, display, session.photon_series, str(session.controller_tmax), \
+                        session_id, session.traces
             else:
                 raise dash.exceptions.PreventUpdate()
 
@@ -184,9 +181,10 @@ class AllenDashboard(html.Div):
                 Input(component_id='figure_traces', component_property='relayoutData'),
                 Input('figure_traces', 'figure'),
                 Input({'type': 'pixelmask_button', 'index': ALL}, 'n_clicks')
-            ]
+            ],
+            [State('allen-dash-session-id', 'data')]
         )
-        def change_frame(relayoutData, figure, click):
+        def change_frame(relayoutData, figure, click, session_id):
             """
             Update tiff frame with change on:
               - Figure data
@@ -196,32 +194,68 @@ class AllenDashboard(html.Div):
             ctx = dash.callback_context
             trigger_source = ctx.triggered[0]['prop_id'].split('.')[1]
 
-            if trigger_source == 'n_clicks' and click and click[0] is not None:
-                self.photon_series.graph.update_pixelmask()
-                return [self.photon_series.graph.out_fig]
-
-            if relayoutData is not None and "shapes[0].x0" in relayoutData and trigger_source == 'relayoutData':
-                pos = relayoutData["shapes[0].x0"]
-            else:
-                pos = self.start_frame_x
-
-            self.photon_series.graph.update_image(pos, self.nwb, self.path_nwb)
+            session = self.sessions.get(session_id)
+            if session is None:
+                raise dash.exceptions.PreventUpdate
 
-            return [self.photon_series.graph.out_fig]
+            with session.lock:
+                if trigger_source == 'n_clicks' and click and click[0] is not None:
+                    session.photon_series.graph.update_pixelmask()
+                    return [session.photon_series.graph.out_fig]
+
+                if relayoutData is not None and "shapes[0].x0" in relayoutData and trigger_source == 'relayoutData':
+                    pos = relayoutData["shapes[0].x0"]
+                else:
+                    pos = session.start_frame_x
+
+                session.photon_series.graph.update_image(pos, session.nwb, session.path_nwb)
+
+                return [session.photon_series.graph.out_fig]
+
+    def get_traces_window(self, session: DashboardSession, select_start_time, select_duration):
+        """
+        Return the data of the traces of session within the selected time window, to be drawn
+        on the base traces figure by DRAW_TRACES_WINDOW: the x and y of each trace, the x range
+        and the y ranges of the ecephys and ophys traces.
+        """
+        time_window = [select_start_time, select_start_time + select_duration]
+
+        ecephys_xx, ecephys_yy = self.get_trace_window(session, session.ecephys_trace, time_window)
+        ophys_xx, ophys_yy = self.get_trace_window(session, session.ophys_trace, time_window)
+        spikes_xx, spikes_yy = self.get_spike_raster(session, time_window)
+        xrange0, xrange1 = ecephys_xx[0], ecephys_xx[-1]
+
+        # Frame cursor, drawn by the browser at the middle of the window
+        session.start_frame_x = (xrange1 + xrange0) / 2
+
+        return dict(
+            traces=[
+                dict(x=ecephys_xx, y=ecephys_yy),
+                dict(x=ophys_xx, y=ophys_yy),
+                dict(x=spikes_xx, y=spikes_yy),
+            ],
+            xrange=[xrange0, xrange1],
+            yranges=[
+                [np.nanmin(ecephys_yy), np.nanmax(ecephys_yy)],
+                [np.nanmin(ophys_yy), np.nanmax(ophys_yy)],
+            ]
+        )
 
-    def render_dashboard(self):
-        io = pynwb.NWBHDF5IO(self.path_nwb, 'r')
-        self.nwb = io.read()
-        self.controller_tmax = get_timeseries_maxt(self.nwb.processing['ophys'].data_interfaces['fluorescence'].roi_response_series['roi_response_series'])
-        self.controller_tmin = get_timeseries_mint(self.nwb.processing['ophys'].data_interfaces['fluorescence'].roi_response_series['roi_response_series'])
+    def render_dashboard(self, session: DashboardSession):
+        """Open the NWB file of session and build its figures"""
+        session.io = pynwb.NWBHDF5IO(session.path_nwb, 'r')
+        session.nwb = session.io.read()
+        session.ecephys_trace = get_processed_voltage_series(session.nwb)
+        session.ophys_trace = get_fluorescence_series(session.nwb)
+        session.controller_tmax = get_timeseries_maxt(session.ophys_trace)
+        session.controller_tmin = get_timeseries_mint(session.ophys_trace)
 
         # Create traces figure
-        self.traces = make_subplots(rows=3, cols=1, row_heights=[0.4, 0.2, 0.4],
+        session.traces = make_subplots(rows=3, cols=1, row_heights=[0.4, 0.2, 0.4],
                                     shared_xaxes=False, vertical_spacing=0.02)
 
         # Electrophysiology
-        self.ecephys_trace = self.nwb.processing['ecephys'].data_interfaces['filtered_membrane_voltage']
-        self.traces.add_trace(
+        session.traces.add_trace(
             go.Scattergl(
                 x=[0],
                 y=[0],
@@ -232,8 +266,7 @@ class AllenDashboard(html.Div):
         )
 
         # Optophysiology
-        self.ophys_trace = self.nwb.processing['ophys'].data_interfaces['fluorescence'].roi_response_series['roi_response_series']
-        self.traces.add_trace(
+        session.traces.add_trace(
             go.Scattergl(
                 x=[0],
                 y=[0],
@@ -242,8 +275,20 @@ class AllenDashboard(html.Div):
             row=3, col=1
         )
 
+        # Spikes, sorted once so that windows are found by binary search
+        session.spike_times = np.sort(np.asarray(session.nwb.units['spike_times'][0]))
+        session.traces.add_trace(
+            go.Scattergl(
+                x=[],
+                y=[],
+                line={"color": "gray", "width": .5},
+                mode='lines',
+                connectgaps=False),
+            row=2, col=1
+        )
+
         # Layout
-        self.traces.update_layout(
+        session.traces.update_layout(
             height=400, showlegend=False, title=None,
             paper_bgcolor='rgba(0, 0, 0, 0)', plot_bgcolor='rgba(0, 0, 0, 0)',
             margin=dict(l=60, r=20, t=8, b=20),
@@ -261,36 +306,36 @@ class AllenDashboard(html.Div):
                 }
             }]
         )
-        self.traces.update_xaxes(patch={
+        session.traces.update_xaxes(patch={
             'showgrid': False,
             'visible': False,
         })
-        self.traces.update_xaxes(patch={
+        session.traces.update_xaxes(patch={
             'visible': True,
             'showline': True,
             'linecolor': 'rgb(0, 0, 0)',
             'title_text': 'time [s]'},
             row=3, col=1
         )
-        self.traces.update_yaxes(patch={
+        session.traces.update_yaxes(patch={
             'showgrid': False,
             'visible': True,
             'showline': True,
             'linecolor': 'rgb(0, 0, 0)'
         })
-        self.traces.update_yaxes(
+        session.traces.update_yaxes(
             patch={
                 "title": {"text": "Ephys [V]", "font": {"color": "#151733", "size": 16}}
             },
             row=1, col=1
         )
-        self.traces.update_yaxes(
+        session.traces.update_yaxes(
             patch={
                 "title": {"text": "dF/F", "font": {"color": "#151733", "size": 16}}
             },
             row=3, col=1
         )
-        self.traces.update_yaxes(
+        session.traces.update_yaxes(
             patch={
                 "title": {"text": "Spikes", "font": {"color": "#151733", 'size': 16}},
                 "showticklabels": True,
@@ -302,35 +347,42 @@ class AllenDashboard(html.Div):
         )
 
         # Two photon imaging
-        self.photon_series = TiffImageSeriesComponent(
+        session.photon_series = TiffImageSeriesComponent(
             id='figure_photon_series',
             parent_app=self.parent_app,
-            imageseries=self.nwb.acquisition['raw_ophys'],
+            imageseries=get_two_photon_series(session.nwb),
             path_external_file=None,
-            pixel_mask=self.nwb.processing['ophys'].data_interfaces['image_segmentation'].plane_segmentations['plane_segmentation'].pixel_mask[:],
+            pixel_mask=get_plane_segmentation(session.nwb).pixel_mask[:],
             foreign_time_window_controller=self.controller_time,
         )
 
-        self.photon_series.graph.out_fig.update_layout(
+        session.photon_series.graph.out_fig.update_layout(
             showlegend=False,
             margin=dict(l=10, r=10, t=70, b=70),
             # width=300, height=300,
         )
 
-    def update_spike_traces(self, time_window):
-        """Updates list of go.Scatter objects at spike times"""
-        self.spike_traces = []
-        t_start = time_window[0]
-        t_end = time_window[1]
-        all_spikes = self.nwb.units['spike_times'][0]
-        mask = (all_spikes > t_start) & (all_spikes < t_end)
-        selected_spikes = all_spikes[mask]
-        # Makes a go.Scatter object for each spike in chosen interval
-        for spkt in selected_spikes:
-            self.traces.add_trace(go.Scattergl(
-                x=[spkt, spkt],
-                y=[-1000, 1000],
-                line={"color": "gray", "width": .5},
-                mode='lines'),
-                row=2, col=1
-            )
+    def get_trace_window(self, session: DashboardSession, timeseries, time_window):
+        """Return times and values of timeseries within time_window, decimated to the trace resolution"""
+        istart = timeseries_time_to_ind(timeseries, time_window[0])
+        istop = timeseries_time_to_ind(timeseries, time_window[1])
+        levels = get_pyramid_levels(session.nwb, timeseries)
+        bin_size = get_pyramid_level(bin_sizes=levels.keys(), n_samples=istop - istart, n_pixels=self.trace_resolution)
+        if bin_size is not None:
+            return read_pyramid_window(levels[bin_size], start=istart, stop=istop, bin_size=bin_size)
+        yy, units = get_timeseries_in_units(timeseries, istart, istop)
+        xx = np.asarray(get_timeseries_tt(timeseries, istart, istop))
+        yy = np.asarray(yy)
+        indices = decimate_trace(yy, n_pixels=self.trace_resolution, method=self.decimation, x=xx)
+        return xx[indices], yy[indices]
+
+    def get_spike_raster(self, session: DashboardSession, time_window):
+        """Return x and y of the spike raster trace within time_window"""
+        istart = np.searchsorted(session.spike_times, time_window[0], side='right')
+        istop = np.searchsorted(session.spike_times, time_window[1], side='left')
+        selected_spikes = session.spike_times[istart:istop]
+        # One vertical segment per spike, separated by NaN
+        xx = np.repeat(selected_spikes, 3)
+        xx[2::3] = np.nan
+        yy = np.tile([-1000., 1000., np.nan], len(selected_spikes))
+        return xx, yy
@@ -0,0 +1,39 @@
+"""JavaScript functions of the dashboard's clientside callbacks, run in the browser without a server round trip"""
+
+# Draw the traces window sent by the server on the base traces figure: trace data,
+# shared x range, y ranges of the ecephys and ophys axes and frame cursor position
+DRAW_TRACES_WINDOW = """
+function(traces_window, base) {
+    if (!traces_window || !base) {
+        return window.dash_clientside.no_update;
+    }
+    var data = base.data.map(function(trace, i) {
+        return Object.assign({}, trace, {x: traces_window.traces[i].x, y: traces_window.traces[i].y});
+    });
+    var layout = Object.assign({}, base.layout);
+    ['xaxis', 'xaxis2', 'xaxis3'].forEach(function(axis) {
+        layout[axis] = Object.assign({}, layout[axis], {range: traces_window.xrange, autorange: false});
+    });
+    layout.yaxis = Object.assign({}, layout.yaxis, {range: traces_window.yranges[0], autorange: false});
+    layout.yaxis3 = Object.assign({}, layout.yaxis3, {range: traces_window.yranges[1], autorange: false});
+    var cursor = (traces_window.xrange[0] + traces_window.xrange[1]) / 2;
+    layout.shapes = [Object.assign({}, layout.shapes[0], {x0: cursor, x1: cursor})];
+    return {data: data, layout: layout};
+}
+"""
+
+# Label of the start time slider
+UPDATE_SLIDER_START_LABEL = """
+function(select_start_time) {
+    return 'start (s): ' + select_start_time;
+}
+"""
+
+# Maximum duration and start time, from the tmax of the file given as trigger (or the
+# default tmax, formatted into the function) and the selected duration
+UPDATE_MAX_TIMES = """
+function(trigger, trigger_duration, duration) {{
+    var tmax = trigger ? parseFloat(trigger) : {tmax};
+    return [tmax, tmax - duration];
+}}
+"""
@@ -3,11 +3,10 @@ import dash_core_components as dcc
 import dash_html_components as html
 from pathlib import Path
 from nwbwidgets.utils.timeseries import (get_timeseries_maxt, get_timeseries_mint)
-from nwbwidgets.ophys import compute_outline
-from tifffile import imread, TiffFile
 import plotly.graph_objects as go
-from .utils import get_fix_path
-import numpy as np
+from .utils import get_fix_path, get_contrast_limits, get_bin_factor, encode_frame, get_image_placement
+from ...utils import get_plane_segmentation, get_plane_segmentation_outline
+from ...tiff_utils import TiffFrameReader, CachedFrameReader
 
 
 class TiffImageSeriesComponent(html.Div):
@@ -33,13 +32,28 @@ class TiffImageSeriesComponent(html.Div):
 
 
 class TiffImageSeriesGraphComponent(dcc.Graph):
-    """Component that renders specific frame of a Tiff file"""
+    """
+    Component that renders specific frame of a Tiff file
+
+    The Tiff file is kept open, and frames are read through a CachedFrameReader of
+    frame_cache_size frames, which prefetches prefetch_radius frames around the cursor.
+    Frames are sent to the browser as compressed 8-bit images ('png' or 'webp'), binned
+    to at most max_image_size pixels per axis and scaled between the contrast limits of
+    the first frame shown. They keep the pixel coordinates of the full frame, so the pixel
+    mask outline lines up at any binning.
+    """
     def __init__(self, parent_app, imageseries, path_external_file=None, pixel_mask=None,
-                 foreign_time_window_controller=None, id='tiff_image_series'):
+                 foreign_time_window_controller=None, id='tiff_image_series', frame_cache_size: int = 64,
+                 prefetch_radius: int = 8, image_format: str = 'png', max_image_size: int = 380):
         super().__init__(id=id, figure={}, config={'displayModeBar': False})
         self.parent_app = parent_app
         self.imageseries = imageseries
         self.pixel_mask = pixel_mask
+        self.frame_cache_size = frame_cache_size
+        self.prefetch_radius = prefetch_radius
+        self.image_format = image_format
+        self.max_image_size = max_image_size
+        self.contrast_limits = None
         self.parent_files_path = Path(self.parent_app.server.config['DATA_PATH']).parent
 
         if foreign_time_window_controller is not None:
@@ -57,24 +71,21 @@ class TiffImageSeriesGraphComponent(dcc.Graph):
 
         # Make figure component
         if path_external_file is not None:
-            self.tiff = TiffFile(path_external_file)
-            self.n_samples = len(self.tiff.pages)
-            self.page = self.tiff.pages[0]
-            self.n_y, self.n_x = page.shape
+            self.tiff = self.open_tiff(path_external_file)
+            self.n_samples = self.tiff.n_frames
+            self.n_y, self.n_x = self.tiff.frame_shape[:2]
 
             # Read first frame
-            self.image = imread(path_external_file, key=0)
+            self.image = self.tiff.get_frame(0)
         else:
             self.image = []
             self.tiff = None
 
         self.out_fig = go.Figure(
-            data=go.Heatmap(
-                z=self.image,
-                colorscale='gray',
-                showscale=False,
-            ), 
+            data=go.Image(),
         )
+        if self.tiff is not None:
+            self.set_image(self.image)
         self.out_fig.update_layout(
             xaxis=go.layout.XAxis(showticklabels=False, ticks=""),
             yaxis=go.layout.YAxis(showticklabels=False, ticks=""),
@@ -90,29 +101,33 @@ class TiffImageSeriesGraphComponent(dcc.Graph):
 
         self.figure = self.out_fig
 
+    def open_tiff(self, path_tiff):
+        """Open the Tiff file once, for all frames to be shown"""
+        return CachedFrameReader(
+            reader=TiffFrameReader(path_tiff),
+            cache_size=self.frame_cache_size,
+            prefetch_radius=self.prefetch_radius
+        )
 
     def update_image(self, pos, nwb, relative_path):
         """Update tiff image frame"""
 
-        frame_number = int(pos * nwb.acquisition['raw_ophys'].rate)
-        path_external = str(Path(relative_path).parent / Path(nwb.acquisition['raw_ophys'].external_file[0]))
-        path_external_file = get_fix_path(path_external)
-
         if self.tiff is None:
-            self.tiff = TiffFile(path_external_file)
-            self.n_samples = len(self.tiff.pages)
-            self.page = self.tiff.pages[0]
-            n_y, n_x = self.page.shape
-            self.pixel_mask = nwb.processing['ophys'].data_interfaces['image_segmentation'].plane_segmentations['plane_segmentation'].pixel_mask[:]
-
-            mask_matrix = np.zeros((n_y, n_x))
-            for px in self.pixel_mask:
-                mask_matrix[px[1], px[0]] = 1
-
-            self.mask_x_coords, self.mask_y_coords = compute_outline(image_mask=mask_matrix, threshold=0.9)
+            path_external = str(Path(relative_path).parent / Path(self.imageseries.external_file[0]))
+            path_external_file = get_fix_path(path_external)
+            self.tiff = self.open_tiff(path_external_file)
+            self.n_samples = self.tiff.n_frames
+            # Outline stored at conversion time, or traced from the pixel mask
+            outline = get_plane_segmentation_outline(
+                plane_segmentation=get_plane_segmentation(nwb),
+                image_shape=self.tiff.frame_shape[:2]
+            )
+            self.mask_x_coords, self.mask_y_coords = outline[:, 0].tolist(), outline[:, 1].tolist()
 
-        self.image = imread(path_external_file, key=frame_number)
-        self.out_fig.data[0].z = self.image
+        frame_number = int(pos * self.imageseries.rate)
+        frame_number = min(max(frame_number, 0), self.n_samples - 1)
+        self.image = self.tiff.get_frame(frame_number)
+        self.set_image(self.image)
 
         self.out_fig.update_layout(
             autosize=False,
@@ -126,6 +141,21 @@ class TiffImageSeriesGraphComponent(dcc.Graph):
             height=380,
         )
 
+    def set_image(self, image):
+        """Show image as the encoded source of the figure's go.Image"""
+        if self.contrast_limits is None:
+            self.contrast_limits = get_contrast_limits(image)
+        bin_factor = get_bin_factor(image.shape, self.max_image_size)
+        self.out_fig.data[0].update(
+            source=encode_frame(
+                image=image,
+                contrast_limits=self.contrast_limits,
+                bin_factor=bin_factor,
+                image_format=self.image_format
+            ),
+            **get_image_placement(bin_factor)
+        )
+
     def update_pixelmask(self):
         """ Update pixel mask on self figure """
 
@@ -139,9 +169,4 @@ class TiffImageSeriesGraphComponent(dcc.Graph):
             )
             self.out_fig.add_trace(trace)
         else:
-            if self.out_fig.data[1].x == self.mask_x_coords and self.out_fig.data[1].y == self.mask_y_coords:
-                self.out_fig.data[1].x = []
-                self.out_fig.data[1].y = []
-            else:
-                self.out_fig.data[1].x = self.mask_x_coords
-                self.out_fig.data[1].y = self.mask_y_coords
\ No newline at end of file
+            self.out_fig.data[1].visible = self.out_fig.data[1].visible is False
@@ -2,6 +2,7 @@ import dash_html_components as html
 import dash_bootstrap_components as dbc
 import dash_core_components as dcc
 from dash.dependencies import Input, Output, State
+from ..clientside import UPDATE_SLIDER_START_LABEL, UPDATE_MAX_TIMES
 
 
 class TimeControllerComponent(html.Div):
@@ -37,13 +38,12 @@ class TimeControllerComponent(html.Div):
                 ],
             )
 
-            @self.parent_app.callback(
+            # Updates Start slider controller label, in the browser
+            self.parent_app.clientside_callback(
+                UPDATE_SLIDER_START_LABEL,
                 Output(component_id='slider_start_label', component_property='children'),
                 [Input(component_id='slider_start_time', component_property='value')]
             )
-            def update_slider_start_label(select_start_time):
-                """Updates Start slider controller label"""
-                return 'start (s): ' + str(select_start_time)
 
         # Duration controller
         if duration:
@@ -82,17 +82,13 @@ class TimeControllerComponent(html.Div):
             html.Div(id='external-update-max-time-trigger', style={'display': 'none'})
         ])
 
-        @self.parent_app.callback(
+        # Update max slider value when duration change
+        # Update max duration and max slider value when new nwb tmax are defined
+        # The tmax of the file shown in the browser session is given as trigger, so that
+        # sessions showing different files do not share it. Runs in the browser.
+        self.parent_app.clientside_callback(
+            UPDATE_MAX_TIMES.format(tmax=float(self.tmax)),
             [Output('input_duration', 'max'), Output('slider_start_time', 'max')],
             [Input('external-update-max-time-trigger', 'children'), Input('input_duration', 'value')],
             [State('input_duration', 'value')]
         )
-        def update_max_times(trigger, trigger_duration, duration):
-            """
-            Update max slider value when duration change
-            Update max duration and max slider value when new nwb tmax are defined
-            """
-            duration_tmax = self.tmax
-            slider_tmax = self.tmax - duration
-
-            return duration_tmax, slider_tmax
\ No newline at end of file
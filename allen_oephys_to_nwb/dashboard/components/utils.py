@@ -1,4 +1,8 @@
 from pathlib import Path, PureWindowsPath
+from PIL import Image
+import numpy as np
+import base64
+import io
 
 
 def get_fix_path(path):
@@ -10,4 +14,47 @@ def get_fix_path(path):
             path = Path(path)
         return path
     else:
-        return Path(path)
\ No newline at end of file
+        return Path(path)
+
+
+def get_contrast_limits(image, percentiles: tuple = (0.5, 99.5)):
+    """Return the (vmin, vmax) intensities mapped to black and white, from percentiles of image"""
+    vmin, vmax = np.percentile(image, percentiles)
+    return float(vmin), float(max(vmax, vmin + 1e-12))
+
+
+def get_bin_factor(image_shape: tuple, max_size: int = None):
+    """Smallest integer factor binning image_shape to at most max_size pixels along each axis"""
+    if max_size is None:
+        return 1
+    return max(1, int(np.ceil(max(image_shape[:2]) / max_size)))
+
+
+def encode_frame(image, contrast_limits: tuple, bin_factor: int = 1, image_format: str = 'png'):
+    """
+    Encode a frame as a grayscale image data URI, to be shown as the source of a go.Image.
+
+    The frame is binned by bin_factor along both axes, averaging each block of pixels, then
+    scaled to 8 bits between contrast_limits and compressed as 'png' or lossless 'webp'.
+    Pixel (i, j) of the encoded image covers pixels [i * bin_factor, (i + 1) * bin_factor)
+    of the frame; get_image_placement places it over the frame coordinates.
+    """
+    image = np.asarray(image, dtype=np.float32)
+    if bin_factor > 1:
+        n_y, n_x = image.shape[0] // bin_factor, image.shape[1] // bin_factor
+        image = image[:n_y * bin_factor, :n_x * bin_factor]
+        image = image.reshape(n_y, bin_factor, n_x, bin_factor).mean(axis=(1, 3))
+    vmin, vmax = contrast_limits
+    image = np.clip((image - vmin) / (vmax - vmin) * 255, 0, 255).astype(np.uint8)
+    buffer = io.BytesIO()
+    if image_format == 'webp':
+        Image.fromarray(image).save(buffer, format='WEBP', lossless=True)
+    else:
+        Image.fromarray(image).save(buffer, format='PNG', optimize=False, compress_level=6)
+    return f'data:image/{image_format};base64,' + base64.b64encode(buffer.getvalue()).decode()
+
+
+def get_image_placement(bin_factor: int = 1):
+    """go.Image x0, y0, dx and dy keeping a binned frame in the pixel coordinates of the full frame"""
+    offset = (bin_factor - 1) / 2
+    return dict(x0=offset, y0=offset, dx=bin_factor, dy=bin_factor)
@@ -0,0 +1,96 @@
+from collections import OrderedDict
+import threading
+import time
+
+
+class DashboardSession:
+    """
+    Server-side state of the dashboard for one browser session: the open NWB file,
+    the traces figure and the photon series component.
+
+    Callbacks must hold lock while reading or changing the state.
+    """
+
+    def __init__(self, path_nwb):
+        self.path_nwb = path_nwb
+        self.lock = threading.RLock()
+        self.io = None
+        self.nwb = None
+        self.traces = None
+        self.ecephys_trace = None
+        self.ophys_trace = None
+        self.spike_times = None
+        self.photon_series = []
+        self.start_frame_x = 0.
+        self.controller_tmin = 0.
+        self.controller_tmax = 1.
+
+    def close(self):
+        """Close the NWB file and the TIFF file of the session"""
+        with self.lock:
+            graph = getattr(self.photon_series, 'graph', None)
+            if graph is not None and graph.tiff is not None:
+                graph.tiff.close()
+                graph.tiff = None
+            if self.io is not None:
+                self.io.close()
+                self.io = None
+            self.nwb = None
+            self.traces = None
+
+
+class SessionCache:
+    """
+    Bounded cache of DashboardSession, keyed on browser session id.
+
+    Holds at most max_sessions sessions, evicting the least recently used one, and
+    evicts sessions not used for ttl seconds. Evicted sessions are closed.
+    """
+
+    def __init__(self, max_sessions: int = 8, ttl: float = 3600.):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._sessions = OrderedDict()
+        self._last_used = dict()
+        self._lock = threading.Lock()
+
+    def _pop_expired(self):
+        now = time.monotonic()
+        expired = [k for k, t in self._last_used.items() if now - t > self.ttl]
+        return [self._pop(k) for k in expired]
+
+    def _pop(self, session_id):
+        self._last_used.pop(session_id)
+        return self._sessions.pop(session_id)
+
+    def get(self, session_id):
+        """Return the session of session_id, or None if there is none"""
+        with self._lock:
+            evicted = self._pop_expired()
+            session = self._sessions.get(session_id)
+            if session is not None:
+                self._sessions.move_to_end(session_id)
+                self._last_used[session_id] = time.monotonic()
+        for s in evicted:
+            s.close()
+        return session
+
+    def put(self, session_id, session: DashboardSession):
+        """Store session under session_id, closing the session it replaces"""
+        with self._lock:
+            evicted = self._pop_expired()
+            if session_id in self._sessions:
+                evicted.append(self._pop(session_id))
+            self._sessions[session_id] = session
+            self._last_used[session_id] = time.monotonic()
+            while len(self._sessions) > self.max_sessions:
+                evicted.append(self._pop(next(iter(self._sessions))))
+        for s in evicted:
+            s.close()
+
+    def clear(self):
+        """Close all sessions"""
+        with self._lock:
+            evicted = [self._pop(k) for k in list(self._sessions)]
+        for s in evicted:
+            s.close()
@@ -0,0 +1,155 @@
+import numpy as np
+
+
+def get_minmax_indices(data, n_bins: int):
+    """
+    Return the indices of the minimum and maximum sample of each of n_bins equal bins of data.
+
+    The two indices of a bin are in time order, so plotting data at the returned
+    indices draws the min/max envelope of the trace: every spike and extreme stays
+    visible, whatever the decimation factor. If data has no more than 2 * n_bins
+    samples, all indices are returned.
+
+    Returns
+    -------
+    np.ndarray
+        Sorted indices into data.
+    """
+    data = np.asarray(data)
+    n_samples = data.shape[0]
+    n_bins = max(1, int(n_bins))
+    if n_samples <= 2 * n_bins:
+        return np.arange(n_samples)
+    bin_size = int(np.ceil(n_samples / n_bins))
+    n_full = n_samples // bin_size * bin_size
+    bins = data[:n_full].reshape(-1, bin_size)
+    offsets = np.arange(bins.shape[0]) * bin_size
+    indices = [np.argmin(bins, axis=1) + offsets, np.argmax(bins, axis=1) + offsets]
+    if n_full < n_samples:
+        tail = data[n_full:]
+        indices[0] = np.append(indices[0], np.argmin(tail) + n_full)
+        indices[1] = np.append(indices[1], np.argmax(tail) + n_full)
+    return np.sort(np.stack(indices, axis=1), axis=1).ravel()
+
+
+def get_lttb_indices(data, n_out: int, x=None):
+    """
+    Return the indices of n_out samples of data chosen by Largest-Triangle-Three-Buckets.
+
+    LTTB keeps the first and last samples and, from each bucket in between, the sample
+    forming the largest triangle with the sample kept from the previous bucket and
+    the mean of the next bucket. It preserves the visual shape of smooth traces
+    better than min/max, but a narrow extreme may be dropped.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Samples of the trace.
+    n_out : int
+        Number of samples to keep.
+    x : np.ndarray
+        Optional. Sample times; defaults to the sample indices.
+    """
+    data = np.asarray(data, dtype=float)
+    n_samples = data.shape[0]
+    n_out = int(n_out)
+    if n_samples <= n_out or n_out < 3:
+        return np.arange(n_samples)
+    x = np.arange(n_samples, dtype=float) if x is None else np.asarray(x, dtype=float)
+    edges = np.linspace(1, n_samples - 1, n_out - 1).astype(int)
+    indices = np.empty(n_out, dtype=np.int64)
+    indices[0] = 0
+    indices[-1] = n_samples - 1
+    for i in range(n_out - 2):
+        a, b = edges[i], edges[i + 1]
+        if i < n_out - 3:
+            next_x, next_y = x[b:edges[i + 2]].mean(), data[b:edges[i + 2]].mean()
+        else:
+            next_x, next_y = x[-1], data[-1]
+        prev_x, prev_y = x[indices[i]], data[indices[i]]
+        areas = np.abs((prev_x - next_x) * (data[a:b] - prev_y) - (prev_x - x[a:b]) * (next_y - prev_y))
+        indices[i + 1] = a + np.argmax(areas)
+    return indices
+
+
+def decimate_trace(data, n_pixels: int, method: str = 'minmax', x=None):
+    """
+    Return the indices of the samples of data to plot on n_pixels horizontal pixels.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Samples of the trace.
+    n_pixels : int
+        Width of the plot. About 2 * n_pixels samples are kept.
+    method : str
+        'minmax' for the min/max envelope of each pixel, or 'lttb'.
+    x : np.ndarray
+        Optional. Sample times, used by 'lttb'.
+    """
+    if method == 'minmax':
+        return get_minmax_indices(data, n_bins=n_pixels)
+    if method == 'lttb':
+        return get_lttb_indices(data, n_out=2 * n_pixels, x=x)
+    raise ValueError(f"Unknown decimation method '{method}', use 'minmax' or 'lttb'.")
+
+
+def get_minmax_pyramid(blocks, min_bin_size: int = 64, min_n_bins: int = 256):
+    """
+    Compute the min/max envelope of a trace at power-of-two resolutions.
+
+    Level k holds the minimum and maximum of every bin of min_bin_size * 2**k samples.
+    Levels are added until one has at most min_n_bins bins. The first level is computed
+    from the trace one block at a time, each coarser level from the previous one.
+
+    Parameters
+    ----------
+    blocks : iterable of np.ndarray
+        Consecutive blocks of the trace, along its first axis.
+    min_bin_size : int
+        Number of samples per bin of the finest level. Must be a power of two.
+
+    Returns
+    -------
+    dict
+        {bin size: (n bins, 2) array of the min and max of each bin}. The last bin of
+        a level may cover fewer samples. Empty if the trace has no more than min_bin_size samples.
+    """
+    mins, maxs = [], []
+    n_samples = 0
+    remainder = None
+    for block in blocks:
+        block = np.asarray(block)
+        n_samples += block.shape[0]
+        if remainder is not None:
+            block = np.concatenate([remainder, block])
+        n_full = block.shape[0] // min_bin_size * min_bin_size
+        bins = block[:n_full].reshape((-1, min_bin_size) + block.shape[1:])
+        mins.append(bins.min(axis=1))
+        maxs.append(bins.max(axis=1))
+        remainder = block[n_full:]
+    if n_samples <= min_bin_size:
+        return dict()
+    if remainder is not None and remainder.shape[0] > 0:
+        mins.append(remainder.min(axis=0)[np.newaxis])
+        maxs.append(remainder.max(axis=0)[np.newaxis])
+
+    bin_size = min_bin_size
+    level = np.stack([np.concatenate(mins), np.concatenate(maxs)], axis=1)
+    pyramid = {bin_size: level}
+    while level.shape[0] > min_n_bins:
+        if level.shape[0] % 2 == 1:
+            level = np.concatenate([level, level[-1:]])
+        level = np.stack([np.minimum(level[0::2, 0], level[1::2, 0]), np.maximum(level[0::2, 1], level[1::2, 1])], axis=1)
+        bin_size *= 2
+        pyramid[bin_size] = level
+    return pyramid
+
+
+def get_pyramid_level(bin_sizes, n_samples: int, n_pixels: int):
+    """
+    Return the largest of bin_sizes that still leaves at least n_pixels bins in n_samples samples,
+    or None if the samples themselves should be read.
+    """
+    bin_sizes = [b for b in bin_sizes if n_samples // b >= n_pixels]
+    return max(bin_sizes) if len(bin_sizes) > 0 else None
@@ -0,0 +1,240 @@
+from pathlib import Path
+import hashlib
+import json
+import os
+
+from .zoom_pairs import zoom_pairs
+
+INDEX_VERSION = 1
+
+
+def scan_directory(root):
+    """
+    Walk root once, returning its HDF5 and TIFF files and the mtime of every visited directory.
+
+    Returns
+    -------
+    files : list of str
+    dir_mtimes : dict
+        {directory path: st_mtime_ns}
+    """
+    files = []
+    dir_mtimes = {}
+    stack = [str(root)]
+    while stack:
+        directory = stack.pop()
+        try:
+            dir_mtimes[directory] = os.stat(directory).st_mtime_ns
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.name.lower().endswith(('.h5', '.tif', '.tiff')):
+                        files.append(entry.path)
+        except OSError as e:
+            print(f'Could not scan {directory}: {e}')
+    return files, dir_mtimes
+
+
+def directories_unchanged(dir_mtimes: dict):
+    """Check that every directory still exists with the recorded mtime"""
+    for directory, mtime in dir_mtimes.items():
+        try:
+            if os.stat(directory).st_mtime_ns != mtime:
+                return False
+        except OSError:
+            return False
+    return True
+
+
+def build_index(files_calibration: list, files_processed: list, files_raw: list,
+                green_channel: str = '2', red_channel: str = '1'):
+    """
+    Build the index {cell_id: session files} from the file lists of each root.
+
+    Parameters
+    ----------
+    files_calibration : list of str
+        Files under the calibration root. If not empty, only cells with a
+        '<cell_id>_*medium.h5' calibration file are indexed.
+    files_processed : list of str
+        Files under the processed root, '<cell_id>_processed.h5'.
+    files_raw : list of str
+        Files under the raw root, '<cell_id>.h5' and '<cell_id>_<channel>.tif'.
+    green_channel, red_channel : str
+        Channel suffixes of the green and red TIFF files.
+    """
+    calibration = dict()
+    for f in sorted(files_calibration):
+        name = Path(f).name
+        if name.endswith('medium.h5'):
+            calibration.setdefault(name.split('_')[0], f)
+
+    processed = dict()
+    for f in sorted(files_processed):
+        stem = Path(f).stem
+        if Path(f).suffix == '.h5' and stem.endswith('_processed'):
+            processed.setdefault(stem.split('_')[0], f)
+
+    raw = dict()
+    tiffs = dict()
+    for f in sorted(files_raw):
+        stem = Path(f).stem
+        cell_id = stem.split('_')[0]
+        if Path(f).suffix == '.h5':
+            # Prefer '<cell_id>.h5' over other h5 files of the same cell
+            if cell_id not in raw or stem == cell_id:
+                raw[cell_id] = f
+        elif '_' in stem:
+            channel = stem.rsplit('_', 1)[1]
+            tiffs.setdefault(cell_id, dict()).setdefault(channel, []).append(f)
+
+    cell_ids = calibration.keys() if len(calibration) > 0 else processed.keys()
+    index = dict()
+    for cell_id in sorted(cell_ids):
+        if cell_id not in processed:
+            continue
+        cell_tiffs = tiffs.get(cell_id, dict())
+        lowzoom_id = zoom_pairs.get(cell_id)
+        lowzoom_tiffs = tiffs.get(lowzoom_id, dict())
+        index[cell_id] = dict(
+            cell_id=cell_id,
+            group=Path(raw[cell_id]).parent.name if cell_id in raw else Path(processed[cell_id]).parent.name,
+            path_calibration=calibration.get(cell_id),
+            path_raw=raw.get(cell_id),
+            path_processed=processed[cell_id],
+            paths_tiff_green=cell_tiffs.get(green_channel, []),
+            paths_tiff_red=cell_tiffs.get(red_channel, []),
+            lowzoom_id=lowzoom_id,
+            paths_tiff_green_lowzoom=lowzoom_tiffs.get(green_channel, []),
+            paths_tiff_red_lowzoom=lowzoom_tiffs.get(red_channel, []),
+        )
+    return index
+
+
+def get_default_cache_path(roots: list):
+    """Cache file under ~/.cache, unique to the given roots"""
+    key = hashlib.sha1(json.dumps([str(r) for r in roots]).encode()).hexdigest()[:16]
+    return Path.home() / '.cache' / 'allen_oephys_to_nwb' / f'discovery_{key}.json'
+
+
+def discover_sessions(path_oephys_processed, path_oephys_raw, path_oephys_calibration=None,
+                      cache_path=None, use_cache: bool = True, green_channel: str = '2', red_channel: str = '1'):
+    """
+    Index the source files of every cell, walking each root directory only once.
+
+    The index is cached to disk and reused as long as the mtimes of all directories
+    under the roots are unchanged, i.e. no file or directory was added, removed or renamed.
+
+    Parameters
+    ----------
+    path_oephys_processed : str, Path
+        Path containing original processed data files and directories.
+    path_oephys_raw : str, Path
+        Path containing original raw data files and directories.
+    path_oephys_calibration : str, Path
+        Optional. Path containing quality selected data. If given, only cells found there are indexed.
+    cache_path : str, Path
+        Optional. Where to cache the index. Defaults to a file under ~/.cache.
+    use_cache : bool
+        Reuse the cached index if it is still valid.
+    green_channel, red_channel : str
+        Channel suffixes of the green and red TIFF files, '<cell_id>_<channel>.tif'.
+
+    Returns
+    -------
+    dict
+        {cell_id: dict(cell_id, group, path_calibration, path_raw, path_processed, paths_tiff_green,
+        paths_tiff_red, lowzoom_id, paths_tiff_green_lowzoom, paths_tiff_red_lowzoom)}
+    """
+    roots = dict(
+        calibration=str(Path(path_oephys_calibration).resolve()) if path_oephys_calibration is not None else None,
+        processed=str(Path(path_oephys_processed).resolve()),
+        raw=str(Path(path_oephys_raw).resolve()),
+    )
+    settings = dict(version=INDEX_VERSION, roots=roots, green_channel=green_channel, red_channel=red_channel)
+    if cache_path is None:
+        cache_path = get_default_cache_path(list(roots.values()))
+    cache_path = Path(cache_path)
+
+    if use_cache and cache_path.is_file():
+        try:
+            with open(cache_path, 'r') as f:
+                cache = json.load(f)
+            if cache['settings'] == settings and directories_unchanged(cache['dir_mtimes']):
+                return cache['index']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    # Identical roots (e.g. raw and processed files side by side) are walked only once
+    scans = dict()
+    for root in set(r for r in roots.values() if r is not None):
+        scans[root] = scan_directory(root)
+    files = {k: scans[r][0] if r is not None else [] for k, r in roots.items()}
+    dir_mtimes = dict()
+    for _, root_dir_mtimes in scans.values():
+        dir_mtimes.update(root_dir_mtimes)
+
+    index = build_index(
+        files_calibration=files['calibration'],
+        files_processed=files['processed'],
+        files_raw=files['raw'],
+        green_channel=green_channel,
+        red_channel=red_channel
+    )
+
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(dict(settings=settings, dir_mtimes=dir_mtimes, index=index), f)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f'Could not cache discovery index at {cache_path}: {e}')
+
+    return index
+
+
+def get_manifest_sessions(index: dict, path_subjects_info=None):
+    """
+    Convert a discovery index into session entries for batch_conversion.run_batch_conversion.
+
+    Each TIFF channel is converted from its first file; a message lists the other files
+    of channels with more than one. Sessions without a raw ecephys file or TIFF files
+    have the conversion of the missing streams turned off in their conversion_options.
+    """
+    sessions = []
+    for cell_id, cell in index.items():
+        ecephys_source = dict(path_ecephys_processed=cell['path_processed'])
+        ophys_source = dict(path_ophys_processed=cell['path_processed'])
+        conversion_options = dict()
+        if cell['path_raw'] is not None:
+            ecephys_source['path_ecephys_raw'] = cell['path_raw']
+        else:
+            print(f'No raw ecephys file found for cell {cell_id}, raw ecephys data will not be converted.')
+            conversion_options['AllenEcephysInterface'] = dict(add_ecephys_raw=False)
+        for path_key, paths_key in [('path_tiff_green_channel', 'paths_tiff_green'),
+                                    ('path_tiff_red_channel', 'paths_tiff_red')]:
+            paths_tiff = cell[paths_key]
+            if len(paths_tiff) > 0:
+                ophys_source[path_key] = paths_tiff[0]
+            if len(paths_tiff) > 1:
+                print(f'Found {len(paths_tiff)} TIFF files for {path_key} of cell {cell_id}, '
+                      f'converting only {paths_tiff[0]} and ignoring {", ".join(paths_tiff[1:])}.')
+        if len(cell['paths_tiff_green']) == 0 and len(cell['paths_tiff_red']) == 0:
+            print(f'No TIFF files found for cell {cell_id}, raw ophys data will not be converted.')
+            conversion_options['AllenOphysInterface'] = dict(add_ophys_raw=False)
+        if path_subjects_info is not None:
+            ecephys_source['path_subjects_info'] = str(path_subjects_info)
+            ophys_source['path_subjects_info'] = str(path_subjects_info)
+        session = dict(
+            session_id=cell_id,
+            source_data=dict(
+                AllenEcephysInterface=ecephys_source,
+                AllenOphysInterface=ophys_source
+            )
+        )
+        if len(conversion_options) > 0:
+            session['conversion_options'] = conversion_options
+        sessions.append(session)
+    return sessions
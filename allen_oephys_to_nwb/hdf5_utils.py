@@ -0,0 +1,472 @@
+from hdmf.data_utils import AbstractDataChunkIterator, DataChunk
+from hdmf.backends.hdf5 import H5DataIO
+from contextlib import contextmanager
+from pathlib import Path
+import numpy as np
+import threading
+import h5py
+
+from .profiling import ConversionProfiler
+
+
+class H5FileCache:
+    """
+    Reference-counted cache of read-only h5py.File handles, keyed on the resolved file path.
+
+    All readers of a session share one handle per source file through open() or
+    acquire()/release(). A handle is closed as soon as no reader holds it, unless a
+    session() is active, in which case it stays open until the outermost session ends.
+    Single-value datasets read through get_scalar are memoized.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._files = dict()
+        self._ref_counts = dict()
+        self._scalars = dict()
+        self._session_depth = 0
+
+    @staticmethod
+    def _get_key(file_path):
+        return str(Path(file_path).resolve())
+
+    def acquire(self, file_path):
+        """Return the shared handle of file_path, opening it if needed. Must be paired with release."""
+        key = self._get_key(file_path)
+        with self._lock:
+            if key not in self._files:
+                self._files[key] = h5py.File(key, 'r')
+                self._ref_counts[key] = 0
+            self._ref_counts[key] += 1
+            return self._files[key]
+
+    def release(self, file_path):
+        """Release a handle returned by acquire"""
+        key = self._get_key(file_path)
+        with self._lock:
+            self._ref_counts[key] -= 1
+            if self._ref_counts[key] == 0 and self._session_depth == 0:
+                self._close(key)
+
+    def _close(self, key):
+        self._files.pop(key).close()
+        self._ref_counts.pop(key)
+
+    @contextmanager
+    def open(self, file_path):
+        """Context manager yielding the shared handle of file_path"""
+        f = self.acquire(file_path)
+        try:
+            yield f
+        finally:
+            self.release(file_path)
+
+    @contextmanager
+    def session(self):
+        """Keep every handle opened within the context open until the outermost session ends"""
+        with self._lock:
+            self._session_depth += 1
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._session_depth -= 1
+                if self._session_depth == 0:
+                    for key in [k for k, count in self._ref_counts.items() if count == 0]:
+                        self._close(key)
+
+    def get_scalar(self, file_path, dataset_name: str):
+        """Return the first value of a small dataset, such as 'dte' or 'tid', as a float"""
+        key = (self._get_key(file_path), dataset_name)
+        if key not in self._scalars:
+            with self.open(file_path) as f:
+                self._scalars[key] = float(np.ravel(f[dataset_name][()])[0])
+        return self._scalars[key]
+
+    def get_n_samples(self, file_path, dataset_name: str):
+        """Return the length of the time (longest) axis of a MATLAB-style trace, without reading it"""
+        with self.open(file_path) as f:
+            return max(f[dataset_name].shape)
+
+
+class H5DatasetDataChunkIterator(AbstractDataChunkIterator):
+    """
+    Iterate over a MATLAB-style HDF5 dataset one buffer at a time.
+
+    Singleton axes of the source dataset (e.g. the leading axis of a 1 x N
+    MATLAB vector) are squeezed out, so the iterated data has the same shape
+    as np.squeeze(dataset). Only one buffer is held in memory at any time.
+    The source file is acquired from h5_files on the first read and released
+    once the iteration is exhausted or close() is called, so the iterator can outlive
+    the interface call that created it and be consumed later by the NWB writer.
+    Only samples [start, stop) along the time (first non-singleton) axis are read.
+    Reads are recorded by profiler as stage 'read <dataset_name>'.
+    """
+
+    def __init__(self, file_path, dataset_name: str, buffer_size: int = 1_000_000, h5_files: H5FileCache = None,
+                 start: int = 0, stop: int = None, profiler: ConversionProfiler = None):
+        self.file_path = str(file_path)
+        self.dataset_name = dataset_name
+        self.buffer_size = int(buffer_size)
+        self.h5_files = h5_files if h5_files is not None else H5FileCache()
+        self.profiler = profiler if profiler is not None else ConversionProfiler(enabled=False)
+        with self.h5_files.open(self.file_path) as f:
+            dset = f[dataset_name]
+            self._source_shape = dset.shape
+            self._dtype = dset.dtype
+        self._squeezed_axes = [i for i, s in enumerate(self._source_shape) if s == 1]
+        source_data_shape = tuple(s for s in self._source_shape if s != 1)
+        if len(source_data_shape) == 0:
+            raise ValueError(f'Dataset {dataset_name} in {self.file_path} holds a single value and cannot be iterated.')
+        self._time_axis = [i for i, s in enumerate(self._source_shape) if s != 1][0]
+        self._start = min(int(start), source_data_shape[0])
+        self._stop = source_data_shape[0] if stop is None else max(self._start, min(int(stop), source_data_shape[0]))
+        self._data_shape = (self._stop - self._start,) + source_data_shape[1:]
+        self._file = None
+        self._position = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._position >= self._data_shape[0]:
+            self.close()
+            raise StopIteration
+        if self._file is None:
+            self._file = self.h5_files.acquire(self.file_path)
+        start = self._position
+        stop = min(start + self.buffer_size, self._data_shape[0])
+        source_selection = tuple(
+            0 if i in self._squeezed_axes
+            else slice(self._start + start, self._start + stop) if i == self._time_axis
+            else slice(None)
+            for i in range(len(self._source_shape))
+        )
+        with self.profiler.stage(f'read {self.dataset_name}'):
+            data = self._file[self.dataset_name][source_selection]
+        self._position = stop
+        selection = (slice(start, stop),) + (slice(None),) * (len(self._data_shape) - 1)
+        return DataChunk(data=data, selection=selection)
+
+    def close(self):
+        """Stop iterating and release the source file. Calling it again has no effect"""
+        self._position = self._data_shape[0]
+        if self._file is not None:
+            self.h5_files.release(self.file_path)
+            self._file = None
+
+    def recommended_chunk_shape(self):
+        return None
+
+    def recommended_data_shape(self):
+        return self._data_shape
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    @property
+    def maxshape(self):
+        return self._data_shape
+
+
+class H5ChunkPassthroughIterator(H5DatasetDataChunkIterator):
+    """
+    Allocate an output dataset with the source chunk layout and filters, without reading any data.
+
+    HDMF creates the output dataset from this iterator but receives no data
+    from it. Once the NWB file has been written, write_chunks copies the
+    still-compressed source chunks into that dataset byte for byte. If the
+    filter pipelines of source and output turn out to differ, the data is
+    decompressed and written buffer by buffer instead.
+    """
+
+    def __init__(self, file_path, dataset_name: str, buffer_size: int = 1_000_000, h5_files: H5FileCache = None,
+                 profiler: ConversionProfiler = None):
+        super().__init__(
+            file_path=file_path,
+            dataset_name=dataset_name,
+            buffer_size=buffer_size,
+            h5_files=h5_files,
+            profiler=profiler
+        )
+        with self.h5_files.open(self.file_path) as f:
+            self._chunk_shape = tuple(
+                c for i, c in enumerate(f[dataset_name].chunks) if i not in self._squeezed_axes
+            )
+
+    def __next__(self):
+        raise StopIteration
+
+    def recommended_chunk_shape(self):
+        return self._chunk_shape
+
+    def write_chunks(self, dataset: h5py.Dataset):
+        """Copy the source chunks into the allocated output dataset"""
+        with self.h5_files.open(self.file_path) as f, self.profiler.stage(f'copy chunks {self.dataset_name}'):
+            source = f[self.dataset_name]
+            if source.dtype == dataset.dtype and get_filter_pipeline(source) == get_filter_pipeline(dataset):
+                for i in range(source.id.get_num_chunks()):
+                    source_offset = source.id.get_chunk_info(i).chunk_offset
+                    offset = tuple(o for j, o in enumerate(source_offset) if j not in self._squeezed_axes)
+                    filter_mask, chunk = source.id.read_direct_chunk(source_offset)
+                    dataset.id.write_direct_chunk(offset, chunk, filter_mask)
+                return
+        print(f'Filters of {self.dataset_name} differ from source, copying decompressed data...')
+        for data_chunk in H5DatasetDataChunkIterator(self.file_path, self.dataset_name, self.buffer_size, self.h5_files,
+                                                     profiler=self.profiler):
+            dataset[data_chunk.selection] = data_chunk.data
+
+
+def get_filter_pipeline(dataset: h5py.Dataset):
+    """Return (filter code, filter values) for each filter applied to the chunks of dataset"""
+    plist = dataset.id.get_create_plist()
+    return [tuple(plist.get_filter(i)[0:3:2]) for i in range(plist.get_nfilters())]
+
+
+def get_passthrough_io_settings(file_path, dataset_name: str, h5_files: H5FileCache = None):
+    """
+    Return H5DataIO settings reproducing the chunk layout and filters of a source dataset.
+
+    Returns None if raw chunks of the dataset cannot be copied to the squeezed
+    output dataset: contiguous or uncompressed storage, filters H5DataIO cannot
+    recreate, or chunks spanning more than one element along singleton axes.
+    """
+    h5_files = h5_files if h5_files is not None else H5FileCache()
+    with h5_files.open(file_path) as f:
+        dset = f[dataset_name]
+        if dset.chunks is None or dset.compression not in ('gzip', 'lzf') or dset.scaleoffset is not None:
+            return None
+        if all(s == 1 for s in dset.shape):
+            return None
+        for s, c in zip(dset.shape, dset.chunks):
+            if (s == 1 and c != 1) or c > s:
+                return None
+        io_settings = dict(
+            compression=dset.compression,
+            compression_opts=dset.compression_opts,
+            shuffle=dset.shuffle,
+            fletcher32=dset.fletcher32,
+        )
+    return io_settings
+
+
+def get_passthrough_datasets(io, nwbfile):
+    """
+    Find the datasets of a written NWB file that were allocated by H5ChunkPassthroughIterator.
+
+    Must be called after io.write(nwbfile), while io is still open.
+
+    Returns
+    -------
+    list of (str, H5ChunkPassthroughIterator)
+        Path of each dataset within the NWB file and the iterator holding its source.
+    """
+    passthrough_datasets = []
+    for container in nwbfile.objects.values():
+        data = getattr(container, 'data', None)
+        if isinstance(data, H5DataIO) and isinstance(data.data, H5ChunkPassthroughIterator):
+            dataset_path = io.manager.get_builder(container)['data'].path
+            passthrough_datasets.append((dataset_path.split('/', 1)[1], data.data))
+    return passthrough_datasets
+
+
+def write_passthrough_chunks(nwbfile_path, passthrough_datasets: list):
+    """Fill the datasets returned by get_passthrough_datasets with the raw source chunks"""
+    with h5py.File(nwbfile_path, 'r+') as f:
+        for dataset_path, iterator in passthrough_datasets:
+            iterator.write_chunks(f[dataset_path])
+
+
+def get_trace_data(file_path, dataset_name: str, stream_data: bool = True, chunk_size: int = 100_000,
+                   compression: str = 'gzip', compression_opts: int = 4, passthrough_chunks: bool = False,
+                   h5_files: H5FileCache = None, start: int = 0, stop: int = None,
+                   profiler: ConversionProfiler = None):
+    """
+    Wrap a MATLAB-style HDF5 trace so it is written to NWB chunked and compressed.
+
+    Parameters
+    ----------
+    file_path : str, Path
+        Path to the source HDF5 file.
+    dataset_name : str
+        Name of the dataset within the source file.
+    stream_data : bool
+        If True, the trace is read from source one buffer at a time while
+        the NWB file is written. If False, the whole trace is loaded into memory.
+    chunk_size : int
+        Number of samples per chunk along the time axis of the output dataset.
+    compression : str
+        Compression filter for the output dataset ('gzip', 'lzf' or None).
+    compression_opts : int
+        Compression level, used only with 'gzip'.
+    passthrough_chunks : bool
+        If True and the source dataset is chunked and compressed compatibly, the
+        output dataset takes the source chunk layout and filters, and is left
+        empty so that write_passthrough_chunks can fill it with the raw source
+        chunks after the NWB file is written. chunk_size and compression are
+        then ignored. Otherwise, or if only part of the trace is converted,
+        falls back to the path chosen by stream_data.
+    h5_files : H5FileCache
+        Optional. Cache sharing the source file handle with other readers of the session.
+    start, stop : int
+        Range of samples to convert. Defaults to the whole trace.
+    profiler : ConversionProfiler
+        Optional. Records the time spent reading the trace.
+    """
+    h5_files = h5_files if h5_files is not None else H5FileCache()
+    if passthrough_chunks and start == 0 and stop is None:
+        io_settings = get_passthrough_io_settings(file_path=file_path, dataset_name=dataset_name, h5_files=h5_files)
+        if io_settings is not None:
+            data = H5ChunkPassthroughIterator(
+                file_path=file_path,
+                dataset_name=dataset_name,
+                buffer_size=chunk_size * 16,
+                h5_files=h5_files,
+                profiler=profiler
+            )
+            return H5DataIO(data=data, chunks=data.recommended_chunk_shape(), **io_settings)
+
+    if stream_data:
+        data = H5DatasetDataChunkIterator(
+            file_path=file_path,
+            dataset_name=dataset_name,
+            buffer_size=chunk_size * 16,
+            h5_files=h5_files,
+            start=start,
+            stop=stop,
+            profiler=profiler
+        )
+        data_shape = data.recommended_data_shape()
+    else:
+        with h5_files.open(file_path) as f:
+            dset = f[dataset_name]
+            time_axis = [i for i, s in enumerate(dset.shape) if s != 1][0]
+            selection = tuple(slice(start, stop) if i == time_axis else slice(None) for i in range(dset.ndim))
+            data = np.squeeze(dset[selection])
+        data_shape = data.shape
+
+    io_kwargs = dict(
+        chunks=(min(chunk_size, data_shape[0]),) + tuple(data_shape[1:]),
+    )
+    if compression is not None:
+        io_kwargs['compression'] = compression
+        if compression == 'gzip':
+            io_kwargs['compression_opts'] = compression_opts
+    return H5DataIO(data=data, **io_kwargs)
+
+
+def get_allocated_chunks(dataset: h5py.Dataset):
+    """
+    Return (chunk offset, storage size) of every allocated chunk of dataset, sorted by offset.
+
+    Only chunk metadata is read. Chunks never written are not allocated, and read as the fill value.
+    """
+    chunks = []
+    if hasattr(dataset.id, 'chunk_iter'):
+        try:
+            dataset.id.chunk_iter(lambda info: chunks.append((info.chunk_offset, info.size)))
+            return sorted(chunks)
+        except (RuntimeError, NotImplementedError):
+            # chunk_iter needs HDF5 >= 1.12.3
+            chunks = []
+    for i in range(dataset.id.get_num_chunks()):
+        info = dataset.id.get_chunk_info(i)
+        chunks.append((info.chunk_offset, info.size))
+    return sorted(chunks)
+
+
+def find_nonzero_samples(file_path, dataset_name: str, start: int = 0, stop: int = None,
+                         buffer_size: int = 1_000_000, h5_files: H5FileCache = None,
+                         profiler: ConversionProfiler = None):
+    """
+    Return the indices of nonzero samples of a sparse MATLAB-style HDF5 vector, such as 'spk'.
+
+    The vector is scanned one buffer at a time, so memory does not grow with its length.
+    If it is chunked, chunks are listed from metadata first: unallocated chunks, which read
+    as a zero fill value, are not read at all. Once a chunk has been found all zero, full
+    chunks with the same storage size are compared to it still compressed, and skipped
+    without being decompressed if identical.
+
+    Parameters
+    ----------
+    file_path : str, Path
+        Path to the source HDF5 file.
+    dataset_name : str
+        Name of the dataset, with a single non-singleton axis.
+    start, stop : int
+        Range of samples to scan. Defaults to the whole vector.
+    buffer_size : int
+        Maximum number of samples decompressed at once.
+    h5_files : H5FileCache
+        Optional. Cache sharing the source file handle with other readers of the session.
+    profiler : ConversionProfiler
+        Optional. Records the scan as stage 'scan <dataset_name>'.
+
+    Returns
+    -------
+    np.ndarray
+        Sample indices within the whole vector, in increasing order.
+    """
+    h5_files = h5_files if h5_files is not None else H5FileCache()
+    profiler = profiler if profiler is not None else ConversionProfiler(enabled=False)
+    with h5_files.open(file_path) as f, profiler.stage(f'scan {dataset_name}'):
+        dset = f[dataset_name]
+        time_axes = [i for i, s in enumerate(dset.shape) if s != 1]
+        if len(time_axes) != 1:
+            raise ValueError(f'Dataset {dataset_name} in {file_path} is not a vector.')
+        time_axis = time_axes[0]
+        n_samples = dset.shape[time_axis]
+        start = min(int(start), n_samples)
+        stop = n_samples if stop is None else max(start, min(int(stop), n_samples))
+
+        def get_selection(a, b):
+            return tuple(slice(a, b) if i == time_axis else 0 for i in range(dset.ndim))
+
+        # Ranges of samples that have to be read, with the offset of their chunk if they are a full chunk
+        if dset.chunks is None or np.any(dset.fillvalue != 0):
+            ranges = [(a, min(a + buffer_size, stop), None) for a in range(start, stop, buffer_size)]
+            chunk_sizes = dict()
+        else:
+            chunk_length = dset.chunks[time_axis]
+            allocated_chunks = get_allocated_chunks(dset)
+            chunk_sizes = dict(allocated_chunks)
+            ranges = []
+            for offset, _ in allocated_chunks:
+                a = max(offset[time_axis], start)
+                b = min(offset[time_axis] + chunk_length, stop)
+                if a < b:
+                    is_full = a == offset[time_axis] and b - a == chunk_length
+                    ranges.append((a, b, offset if is_full else None))
+
+        indices = []
+        zero_chunk = None
+        buffer = []
+
+        def read_buffer():
+            # Adjacent ranges are decompressed together, up to buffer_size samples
+            nonlocal zero_chunk
+            buffer_start, buffer_stop = buffer[0][0], buffer[-1][1]
+            data = dset[get_selection(buffer_start, buffer_stop)]
+            indices.append(np.flatnonzero(data) + buffer_start)
+            if zero_chunk is None:
+                for a, b, offset in buffer:
+                    if offset is not None and not np.any(data[a - buffer_start:b - buffer_start]):
+                        zero_chunk = dset.id.read_direct_chunk(offset)
+                        break
+            buffer.clear()
+
+        for a, b, offset in ranges:
+            if zero_chunk is not None and offset is not None and chunk_sizes[offset] == len(zero_chunk[1]):
+                if dset.id.read_direct_chunk(offset) == zero_chunk:
+                    if len(buffer) > 0:
+                        read_buffer()
+                    continue
+            if len(buffer) > 0 and (buffer[-1][1] != a or b - buffer[0][0] > buffer_size):
+                read_buffer()
+            buffer.append((a, b, offset))
+        if len(buffer) > 0:
+            read_buffer()
+    if len(indices) == 0:
+        return np.array([], dtype=np.int64)
+    return np.concatenate(indices).astype(np.int64)
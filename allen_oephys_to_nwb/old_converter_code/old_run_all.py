@@ -1,5 +1,5 @@
 from allen_oephys_to_nwb import AllenOephysNWBConverter
-from .zoom_pairs import zoom_pairs
+from allen_oephys_to_nwb.zoom_pairs import zoom_pairs
 from pathlib import Path
 import yaml
 import argparse
@@ -0,0 +1,177 @@
+from contextlib import contextmanager
+from pathlib import Path
+import threading
+import resource
+import json
+import time
+import os
+
+
+def read_process_io():
+    """
+    Return the I/O counters of this process from /proc/self/io, or None where unavailable.
+
+    read_bytes and write_bytes count all bytes passed through read and write calls,
+    storage_read_bytes and storage_write_bytes only those that reached the storage device.
+    """
+    try:
+        with open('/proc/self/io', 'r') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+    except (OSError, ValueError):
+        return None
+    return dict(
+        read_bytes=int(counters['rchar']),
+        write_bytes=int(counters['wchar']),
+        storage_read_bytes=int(counters['read_bytes']),
+        storage_write_bytes=int(counters['write_bytes']),
+    )
+
+
+def read_rss():
+    """Return the resident set size of this process in bytes"""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        # Peak, rather than current, RSS; in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class ConversionProfiler:
+    """
+    Record wall time, CPU time, bytes read and written and peak RSS of conversion stages.
+
+    Stages are opened with stage(name) and nest per thread; a nested stage is recorded
+    as 'parent/child'. All calls of a stage are aggregated into one entry. CPU time,
+    I/O and RSS are counters of the whole process, so stages running concurrently in
+    other threads (e.g. reading ahead) are included, and worker processes are not.
+    A disabled profiler records nothing and costs next to nothing.
+    """
+
+    def __init__(self, enabled: bool = True, rss_interval: float = 0.02):
+        self.enabled = enabled
+        self.rss_interval = rss_interval
+        self.stages = dict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # Peak RSS of each open stage, keyed on id so that equal peaks of different stages are kept apart
+        self._open_peaks = dict()
+        self._sampler = None
+        self._n_open = 0
+        self._t0 = time.perf_counter()
+
+    def _get_stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def _sample_rss(self):
+        while True:
+            with self._lock:
+                if self._n_open == 0:
+                    self._sampler = None
+                    return
+                rss = read_rss()
+                for peak in self._open_peaks.values():
+                    peak[0] = max(peak[0], rss)
+            time.sleep(self.rss_interval)
+
+    @contextmanager
+    def stage(self, name: str):
+        """Record the enclosed block as stage name"""
+        if not self.enabled:
+            yield
+            return
+        stack = self._get_stack()
+        full_name = '/'.join([frame['name'] for frame in stack] + [name])
+        frame = dict(name=name, child_wall_time=0.)
+        peak = [read_rss()]
+        with self._lock:
+            self._open_peaks[id(peak)] = peak
+            self._n_open += 1
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample_rss, daemon=True)
+                self._sampler.start()
+        stack.append(frame)
+        io_start = read_process_io()
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            wall_time = time.perf_counter() - wall_start
+            cpu_time = time.process_time() - cpu_start
+            io_stop = read_process_io()
+            stack.pop()
+            if len(stack) > 0:
+                stack[-1]['child_wall_time'] += wall_time
+            peak[0] = max(peak[0], read_rss())
+            with self._lock:
+                self._open_peaks.pop(id(peak))
+                self._n_open -= 1
+                record = self.stages.setdefault(full_name, dict(
+                    calls=0,
+                    wall_time=0.,
+                    self_wall_time=0.,
+                    cpu_time=0.,
+                    read_bytes=None,
+                    write_bytes=None,
+                    storage_read_bytes=None,
+                    storage_write_bytes=None,
+                    peak_rss=0,
+                ))
+                record['calls'] += 1
+                record['wall_time'] += wall_time
+                record['self_wall_time'] += wall_time - frame['child_wall_time']
+                record['cpu_time'] += cpu_time
+                if io_start is not None and io_stop is not None:
+                    for key in io_start:
+                        record[key] = (record[key] or 0) + io_stop[key] - io_start[key]
+                record['peak_rss'] = max(record['peak_rss'], peak[0])
+
+    def get_report(self):
+        """Return the recorded stages, with the total wall time and peak RSS of the process"""
+        with self._lock:
+            stages = {name: dict(record) for name, record in self.stages.items()}
+        return dict(
+            wall_time=time.perf_counter() - self._t0,
+            peak_rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            stages=stages,
+        )
+
+    def save_report(self, path_report):
+        """Write the report as JSON"""
+        with open(path_report, 'w') as f:
+            json.dump(self.get_report(), f, indent=4)
+
+
+def aggregate_reports(reports: list):
+    """
+    Aggregate the reports of many sessions, e.g. from a batch conversion.
+
+    Returns
+    -------
+    dict
+        n_sessions and, for each stage, the number of sessions it ran in and the
+        total, mean and max over sessions of each measure.
+    """
+    stages = dict()
+    for report in reports:
+        for name, record in report['stages'].items():
+            stages.setdefault(name, []).append(record)
+    aggregated = dict()
+    for name, records in stages.items():
+        aggregated[name] = dict(n_sessions=len(records))
+        for key in ['wall_time', 'self_wall_time', 'cpu_time', 'read_bytes', 'write_bytes',
+                    'storage_read_bytes', 'storage_write_bytes', 'peak_rss']:
+            values = [r[key] for r in records if r.get(key) is not None]
+            if len(values) == 0:
+                continue
+            aggregated[name][key] = dict(total=sum(values), mean=sum(values) / len(values), max=max(values))
+    return dict(n_sessions=len(reports), stages=aggregated)
+
+
+def get_profile_path(nwbfile_path):
+    """Report path of a session, '<nwb file stem>.profile.json' next to the NWB file"""
+    nwbfile_path = Path(nwbfile_path)
+    return nwbfile_path.with_name(nwbfile_path.stem + '.profile.json')
@@ -0,0 +1,153 @@
+from pathlib import Path
+from tifffile import TiffWriter
+import numpy as np
+import json
+import h5py
+
+
+def _create_matlab_vector(f: h5py.File, name: str, n_samples: int, fill, chunk_size: int = 8192,
+                          block_size: int = 1_000_000):
+    """
+    Write a (1, n_samples) MATLAB-style row vector block by block, so that long sessions
+    are generated in constant memory. fill(start, stop) returns the samples [start, stop).
+    """
+    dset = f.create_dataset(
+        name,
+        shape=(1, n_samples),
+        dtype='float64',
+        chunks=(1, min(chunk_size, n_samples)),
+        compression='gzip',
+        compression_opts=3
+    )
+    for start in range(0, n_samples, block_size):
+        stop = min(start + block_size, n_samples)
+        dset[0, start:stop] = fill(start, stop)
+
+
+def generate_session(path_output, cell_id: str = '100', duration: float = 20., ecephys_rate: float = 10_000.,
+                     imaging_rate: float = 30., frame_shape: tuple = (64, 64), spike_rate: float = 5.,
+                     sweep_duration: float = 2., n_roi_pixels: int = 100, red_channel: bool = False,
+                     compress_tiff: bool = False, seed: int = 0):
+    """
+    Generate a synthetic session with the file layout of the Allen oephys source data.
+
+    Writes to path_output:
+        <cell_id>.h5 : raw ecephys file, with 'Voltage' and 'dte'.
+        <cell_id>_processed.h5 : processed file, with 'Vmfd', 'spk', 'f_cell', 'dte', 'dto',
+            'pixel_list', 'linesPerFrame', 'pixelsPerLine', 'iStimOn', 'iStimOff',
+            'sweep_table', 'sweep_order', 'tid' and 'aid'.
+        <cell_id>_2.tif : green channel, one page per frame.
+        <cell_id>_1.tif : red channel, if red_channel.
+        subjects_info.json : subject of the session, keyed on 'aid'.
+    Vectors are stored as (1, n) datasets, as MATLAB writes row vectors.
+
+    Parameters
+    ----------
+    path_output : str, Path
+        Directory where the files are written.
+    cell_id : str
+        Cell id, used as file name prefix and as 'tid'.
+    duration : float
+        Session duration, in seconds.
+    ecephys_rate : float
+        Voltage sampling rate, in Hz.
+    imaging_rate : float
+        Frame rate, in Hz.
+    frame_shape : tuple
+        (lines per frame, pixels per line).
+    spike_rate : float
+        Mean firing rate, in Hz.
+    sweep_duration : float
+        Duration of each drifting grating sweep, in seconds. Stimulus is on for the first half.
+    n_roi_pixels : int
+        Number of pixels of the ROI.
+    red_channel : bool
+        Also write the red channel TIFF file.
+    compress_tiff : bool
+        Compress TIFF pages with zlib, so they have to be decoded instead of memory-mapped.
+    seed : int
+        Seed of the random generator.
+
+    Returns
+    -------
+    dict
+        source_data for AllenOephysNWBConverter.
+    """
+    path_output = Path(path_output)
+    path_output.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    dte = 1 / ecephys_rate
+    dto = 1 / imaging_rate
+    n_samples = int(duration * ecephys_rate)
+    n_frames = int(duration * imaging_rate)
+    aid = 200000 + seed
+
+    spike_samples = np.sort(rng.choice(n_samples, size=min(int(duration * spike_rate), n_samples), replace=False))
+
+    def voltage(start, stop):
+        data = rng.normal(scale=0.1, size=stop - start)
+        in_block = spike_samples[(spike_samples >= start) & (spike_samples < stop)]
+        data[in_block - start] += 1.
+        return data
+
+    def spikes(start, stop):
+        data = np.zeros(stop - start)
+        data[spike_samples[(spike_samples >= start) & (spike_samples < stop)] - start] = 1.
+        return data
+
+    path_raw = path_output / f'{cell_id}.h5'
+    with h5py.File(path_raw, 'w') as f:
+        _create_matlab_vector(f, 'Voltage', n_samples, voltage)
+        f['dte'] = np.array([[dte]])
+
+    n_sweeps = int(duration / sweep_duration)
+    n_conditions = 8
+    stim_on = np.arange(n_sweeps) * sweep_duration * ecephys_rate + 1
+    path_processed = path_output / f'{cell_id}_processed.h5'
+    with h5py.File(path_processed, 'w') as f:
+        _create_matlab_vector(f, 'Vmfd', n_samples, voltage)
+        _create_matlab_vector(f, 'spk', n_samples, spikes)
+        f['f_cell'] = rng.normal(size=(1, n_frames))
+        f['dte'] = np.array([[dte]])
+        f['dto'] = np.array([[dto]])
+        f['tid'] = np.array([[float(cell_id)]])
+        f['aid'] = np.array([[float(aid)]])
+        f['linesPerFrame'] = np.array([[float(frame_shape[0])]])
+        f['pixelsPerLine'] = np.array([[float(frame_shape[1])]])
+        n_pixels = int(np.prod(frame_shape))
+        f['pixel_list'] = np.sort(rng.choice(n_pixels, size=min(n_roi_pixels, n_pixels), replace=False))[
+            np.newaxis].astype(float)
+        f['iStimOn'] = stim_on[np.newaxis]
+        f['iStimOff'] = (stim_on + sweep_duration / 2 * ecephys_rate)[np.newaxis]
+        # orientation, phase, spatial frequency and contrast of each condition; -1 is a blank sweep
+        f['sweep_table'] = rng.random((4, n_conditions))
+        f['sweep_order'] = rng.integers(-1, n_conditions, size=(1, n_sweeps)).astype(float)
+
+    paths_tiff = dict(path_tiff_green_channel=path_output / f'{cell_id}_2.tif')
+    if red_channel:
+        paths_tiff['path_tiff_red_channel'] = path_output / f'{cell_id}_1.tif'
+    frame_nbytes = int(np.prod(frame_shape)) * 2
+    block_size = max(1, 2 ** 26 // frame_nbytes)
+    for path_tiff in paths_tiff.values():
+        with TiffWriter(path_tiff, bigtiff=n_frames * frame_nbytes > 2 ** 31) as tif:
+            for start in range(0, n_frames, block_size):
+                stop = min(start + block_size, n_frames)
+                frames = rng.integers(0, 4096, size=(stop - start,) + tuple(frame_shape), dtype=np.uint16)
+                for frame in frames:
+                    tif.write(frame, contiguous=not compress_tiff, compression='zlib' if compress_tiff else None)
+
+    path_subjects_info = path_output / 'subjects_info.json'
+    with open(path_subjects_info, 'w') as f:
+        json.dump({str(aid): dict(line='Emx1-IRES-Cre', age='P60D', anesthesia='isoflurane')}, f)
+
+    ecephys_source = dict(
+        path_ecephys_raw=str(path_raw),
+        path_ecephys_processed=str(path_processed),
+        path_subjects_info=str(path_subjects_info)
+    )
+    ophys_source = dict(
+        path_ophys_processed=str(path_processed),
+        path_subjects_info=str(path_subjects_info),
+        **{k: str(v) for k, v in paths_tiff.items()}
+    )
+    return dict(AllenEcephysInterface=ecephys_source, AllenOphysInterface=ophys_source)
@@ -0,0 +1,706 @@
+from hdmf.data_utils import AbstractDataChunkIterator, DataChunk
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from collections import deque, OrderedDict
+from tifffile import TiffFile, TiffPage
+from pathlib import Path
+import numpy as np
+import threading
+import queue
+import hashlib
+import struct
+import json
+import os
+
+from .profiling import ConversionProfiler
+
+
+FRAME_INDEX_VERSION = 1
+
+# TIFF tag codes and (struct format, size) of the TIFF field types read by build_frame_index
+_TAG_IMAGE_WIDTH = 256
+_TAG_IMAGE_LENGTH = 257
+_TAG_BITS_PER_SAMPLE = 258
+_TAG_COMPRESSION = 259
+_TAG_FILL_ORDER = 266
+_TAG_STRIP_OFFSETS = 273
+_TAG_SAMPLES_PER_PIXEL = 277
+_TAG_STRIP_BYTE_COUNTS = 279
+_TAG_PLANAR_CONFIGURATION = 284
+_TAG_PREDICTOR = 317
+_TAG_SAMPLE_FORMAT = 339
+_FIELD_TYPES = {1: ('B', 1), 3: ('H', 2), 4: ('I', 4), 6: ('b', 1), 8: ('h', 2), 9: ('i', 4), 13: ('I', 4),
+                16: ('Q', 8), 17: ('q', 8), 18: ('Q', 8)}
+_SAMPLE_FORMATS = {1: 'u', 2: 'i', 3: 'f'}
+
+
+def _read_ifd(f, offset: int, byteorder: str, bigtiff: bool):
+    """Read the tags of interest of the IFD at offset, returning (tags, offset of the next IFD)"""
+    count_format, entry_size, value_size = ('Q', 20, 8) if bigtiff else ('H', 12, 4)
+    count_size = struct.calcsize(count_format)
+    # A single read covers the whole IFD of a typical microscope page
+    f.seek(offset)
+    block = f.read(4096)
+    n_entries = struct.unpack_from(byteorder + count_format, block)[0]
+    ifd_size = count_size + n_entries * entry_size + value_size
+    if len(block) < ifd_size:
+        f.seek(offset)
+        block = f.read(ifd_size)
+    tags = dict()
+    for i in range(n_entries):
+        entry_offset = count_size + i * entry_size
+        tag, field_type = struct.unpack_from(byteorder + 'HH', block, entry_offset)
+        if tag not in (_TAG_IMAGE_WIDTH, _TAG_IMAGE_LENGTH, _TAG_BITS_PER_SAMPLE, _TAG_COMPRESSION,
+                       _TAG_FILL_ORDER, _TAG_STRIP_OFFSETS, _TAG_SAMPLES_PER_PIXEL, _TAG_STRIP_BYTE_COUNTS,
+                       _TAG_PLANAR_CONFIGURATION, _TAG_PREDICTOR, _TAG_SAMPLE_FORMAT):
+            continue
+        if field_type not in _FIELD_TYPES:
+            continue
+        value_format, item_size = _FIELD_TYPES[field_type]
+        n_values = struct.unpack_from(byteorder + ('Q' if bigtiff else 'I'), block, entry_offset + 4)[0]
+        values_format = f'{byteorder}{n_values}{value_format}'
+        value_offset = entry_offset + (12 if bigtiff else 8)
+        if n_values * item_size <= value_size:
+            tags[tag] = struct.unpack_from(values_format, block, value_offset)
+        else:
+            pointer = struct.unpack_from(byteorder + ('Q' if bigtiff else 'I'), block, value_offset)[0]
+            f.seek(pointer)
+            tags[tag] = struct.unpack(values_format, f.read(n_values * item_size))
+    next_offset = struct.unpack_from(byteorder + ('Q' if bigtiff else 'I'), block, count_size + n_entries * entry_size)[0]
+    return tags, next_offset
+
+
+def build_frame_index(file_path):
+    """
+    Index the pages of a TIFF file by walking its IFD chain, reading only the IFDs.
+
+    Returns
+    -------
+    dict
+        n_frames, frame_shape, dtype, compression, ifd_offsets (offset of the IFD of each page)
+        and data_offsets (offset of the pixel data of each page, -1 where the page is compressed
+        or not stored as a single uncompressed block).
+    """
+    ifd_offsets = []
+    data_offsets = []
+    frame_shape = None
+    dtype = None
+    compression = None
+    with open(file_path, 'rb') as f:
+        header = f.read(16)
+        byteorder = {b'II': '<', b'MM': '>'}.get(header[:2])
+        if byteorder is None:
+            raise ValueError(f'{file_path} is not a TIFF file')
+        version = struct.unpack_from(byteorder + 'H', header, 2)[0]
+        bigtiff = version == 43
+        offset = struct.unpack_from(byteorder + ('Q' if bigtiff else 'I'), header, 8 if bigtiff else 4)[0]
+        while offset != 0:
+            tags, next_offset = _read_ifd(f, offset, byteorder, bigtiff)
+            samples_per_pixel = tags.get(_TAG_SAMPLES_PER_PIXEL, (1,))[0]
+            page_shape = (tags[_TAG_IMAGE_LENGTH][0], tags[_TAG_IMAGE_WIDTH][0])
+            if samples_per_pixel > 1:
+                page_shape += (samples_per_pixel,)
+            bits = tags.get(_TAG_BITS_PER_SAMPLE, (1,))[0]
+            page_dtype = np.dtype(f'{byteorder}{_SAMPLE_FORMATS.get(tags.get(_TAG_SAMPLE_FORMAT, (1,))[0], "u")}'
+                                  f'{max(bits // 8, 1)}')
+            page_compression = tags.get(_TAG_COMPRESSION, (1,))[0]
+            if frame_shape is None:
+                frame_shape, dtype, compression = page_shape, page_dtype, page_compression
+
+            data_offset = -1
+            strip_offsets = tags.get(_TAG_STRIP_OFFSETS)
+            strip_byte_counts = tags.get(_TAG_STRIP_BYTE_COUNTS)
+            frame_nbytes = int(np.prod(page_shape)) * page_dtype.itemsize
+            if page_compression == 1 and strip_offsets is not None and strip_byte_counts is not None and \
+                    bits in (8, 16, 32, 64) and tags.get(_TAG_FILL_ORDER, (1,))[0] == 1 and \
+                    tags.get(_TAG_PREDICTOR, (1,))[0] == 1 and \
+                    (samples_per_pixel == 1 or tags.get(_TAG_PLANAR_CONFIGURATION, (1,))[0] == 1) and \
+                    sum(strip_byte_counts) == frame_nbytes and \
+                    all(o + c == n for o, c, n in zip(strip_offsets, strip_byte_counts, strip_offsets[1:])):
+                data_offset = strip_offsets[0]
+            if page_shape != frame_shape or page_dtype != dtype:
+                raise ValueError(f'Pages of {file_path} do not all have the same shape and data type')
+
+            ifd_offsets.append(offset)
+            data_offsets.append(data_offset)
+            if next_offset in ifd_offsets[-1:]:
+                break
+            offset = next_offset
+
+    return dict(
+        n_frames=len(ifd_offsets),
+        frame_shape=tuple(int(s) for s in frame_shape) if frame_shape is not None else (),
+        dtype=dtype.str if dtype is not None else None,
+        compression=compression,
+        ifd_offsets=np.array(ifd_offsets, dtype=np.int64),
+        data_offsets=np.array(data_offsets, dtype=np.int64),
+    )
+
+
+def get_frame_index_cache_path(file_path):
+    """Frame index cache file under ~/.cache, where frame indexes are saved unless sidecars are used"""
+    key = hashlib.sha1(str(Path(file_path).resolve()).encode()).hexdigest()[:16]
+    return Path.home() / '.cache' / 'allen_oephys_to_nwb' / 'frame_index' / f'{key}.npz'
+
+
+def get_frame_index_sidecar_path(file_path):
+    """Frame index sidecar file, '<file name>.frameindex.npz' next to the TIFF file"""
+    file_path = Path(file_path)
+    return file_path.with_name(file_path.name + '.frameindex.npz')
+
+
+def _load_frame_index_file(index_path, file_version: dict):
+    try:
+        with np.load(index_path) as data:
+            info = json.loads(str(data['info']))
+            if info['version'] != FRAME_INDEX_VERSION or info['file_version'] != file_version:
+                return None
+            info.update(ifd_offsets=data['ifd_offsets'], data_offsets=data['data_offsets'])
+    except (OSError, ValueError, KeyError):
+        return None
+    info.pop('version')
+    info.pop('file_version')
+    info['frame_shape'] = tuple(info['frame_shape'])
+    return info
+
+
+def _save_frame_index_file(index_path, frame_index: dict, file_version: dict):
+    index_path = Path(index_path)
+    index_path.parent.mkdir(parents=True, exist_ok=True)
+    info = {k: v for k, v in frame_index.items() if k not in ('ifd_offsets', 'data_offsets')}
+    info.update(version=FRAME_INDEX_VERSION, file_version=file_version)
+    tmp_path = index_path.with_name(index_path.name + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        np.savez(
+            f,
+            info=np.array(json.dumps(info)),
+            ifd_offsets=frame_index['ifd_offsets'],
+            data_offsets=frame_index['data_offsets']
+        )
+    os.replace(tmp_path, index_path)
+
+
+_frame_indexes = dict()
+_frame_indexes_lock = threading.Lock()
+
+
+def get_frame_index(file_path, use_cache: bool = True, use_sidecar: bool = False):
+    """
+    Return the frame index of a TIFF file, see build_frame_index.
+
+    The index is persisted under ~/.cache and kept in memory for the lifetime of
+    the process. It is rebuilt when the size or mtime of the TIFF file changes.
+    An existing sidecar file next to the TIFF file is used too, but sidecars are only
+    written if use_sidecar, falling back to ~/.cache if that directory is not writable:
+    writing into the source data directory changes its mtime, which invalidates the
+    session index of discovery.discover_sessions.
+    """
+    file_path = str(Path(file_path).resolve())
+    stat = os.stat(file_path)
+    file_version = dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+    index_paths = [get_frame_index_sidecar_path(file_path), get_frame_index_cache_path(file_path)]
+    save_paths = index_paths if use_sidecar else index_paths[1:]
+
+    with _frame_indexes_lock:
+        cached = _frame_indexes.get(file_path)
+        if use_cache and cached is not None and cached[0] == file_version:
+            return cached[1]
+
+    frame_index = None
+    if use_cache:
+        for index_path in index_paths:
+            if index_path.is_file():
+                frame_index = _load_frame_index_file(index_path, file_version)
+                if frame_index is not None:
+                    break
+    if frame_index is None:
+        frame_index = build_frame_index(file_path)
+        for index_path in save_paths:
+            try:
+                _save_frame_index_file(index_path, frame_index, file_version)
+                break
+            except OSError:
+                continue
+        else:
+            print(f'Could not save frame index of {file_path}')
+
+    with _frame_indexes_lock:
+        _frame_indexes[file_path] = (file_version, frame_index)
+    return frame_index
+
+
+def get_n_frames(file_path):
+    """Return the number of pages of a TIFF file"""
+    return get_frame_index(file_path)['n_frames']
+
+
+class TiffFrameReader:
+    """
+    Random access to the frames of a multi-page TIFF file, located through its frame index.
+
+    Uncompressed pages are memory-mapped and returned as views of the file, without
+    decoding or copying. If all pages are stored back to back the whole stack is a
+    single view, so blocks of frames are views too. Compressed or otherwise not
+    memory-mappable pages are decoded with tifffile, seeking directly to their IFD.
+    """
+
+    def __init__(self, file_path, frame_index: dict = None):
+        self.file_path = str(file_path)
+        self.frame_index = frame_index if frame_index is not None else get_frame_index(self.file_path)
+        self.n_frames = self.frame_index['n_frames']
+        self.frame_shape = tuple(self.frame_index['frame_shape'])
+        self.dtype = np.dtype(self.frame_index['dtype'])
+        self._tiff = None
+        self._tiff_lock = threading.Lock()
+        self._stack = None
+        self._frames = None
+
+        offsets = self.frame_index['data_offsets']
+        self.is_memmapped = self.n_frames > 0 and bool(np.all(offsets >= 0))
+        if not self.is_memmapped:
+            return
+
+        frame_nbytes = int(np.prod(self.frame_shape)) * self.dtype.itemsize
+        if np.all(np.diff(offsets) == frame_nbytes):
+            self._stack = np.memmap(
+                self.file_path,
+                dtype=self.dtype,
+                mode='r',
+                offset=int(offsets[0]),
+                shape=(self.n_frames,) + self.frame_shape
+            )
+        else:
+            # Pages interleaved with their IFDs, e.g. Bruker files written one page at a time
+            file_map = np.memmap(self.file_path, dtype=np.uint8, mode='r')
+            self._frames = [
+                np.ndarray(shape=self.frame_shape, dtype=self.dtype, buffer=file_map, offset=int(offset))
+                for offset in offsets
+            ]
+
+    @property
+    def is_contiguous(self):
+        """True if the whole stack is memory-mapped as a single array"""
+        return self._stack is not None
+
+    def get_frame(self, frame_number: int):
+        """Return a single frame"""
+        if self._stack is not None:
+            return self._stack[frame_number]
+        if self._frames is not None:
+            return self._frames[frame_number]
+        if frame_number < 0:
+            frame_number += self.n_frames
+        with self._tiff_lock:
+            if self._tiff is None:
+                self._tiff = TiffFile(self.file_path)
+            self._tiff.filehandle.seek(int(self.frame_index['ifd_offsets'][frame_number]))
+            return TiffPage(self._tiff, index=frame_number).asarray()
+
+    def get_frames(self, start: int, stop: int):
+        """Return frames [start, stop) as a (n_frames, n_y, n_x) array, a view of the file if possible"""
+        if self._stack is not None:
+            return self._stack[start:stop]
+        if self._frames is not None:
+            return np.stack(self._frames[start:stop])
+        return np.stack([self.get_frame(i) for i in range(start, stop)])
+
+    def close(self):
+        self._stack = None
+        self._frames = None
+        with self._tiff_lock:
+            if self._tiff is not None:
+                self._tiff.close()
+                self._tiff = None
+
+
+class CachedFrameReader:
+    """
+    TiffFrameReader keeping recently read frames in memory, for interactive viewers.
+
+    Frames are kept in a bounded LRU cache of cache_size frames. After each request,
+    a background thread reads the prefetch_radius frames on either side of it, nearest
+    first, into the cache; a new request restarts prefetching around the new frame.
+    """
+
+    def __init__(self, reader: TiffFrameReader, cache_size: int = 64, prefetch_radius: int = 8):
+        self.reader = reader
+        self.n_frames = reader.n_frames
+        self.frame_shape = reader.frame_shape
+        self.dtype = reader.dtype
+        self.cache_size = max(int(cache_size), 2 * int(prefetch_radius) + 1)
+        self.prefetch_radius = int(prefetch_radius)
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._cursor = None
+        self._request = threading.Event()
+        self._closed = False
+        self._thread = None
+
+    def _get_cached(self, frame_number: int):
+        with self._lock:
+            frame = self._cache.get(frame_number)
+            if frame is not None:
+                self._cache.move_to_end(frame_number)
+            return frame
+
+    def _read(self, frame_number: int):
+        # A copy, so that cached memory-mapped frames are resident
+        frame = np.array(self.reader.get_frame(frame_number))
+        with self._lock:
+            self._cache[frame_number] = frame
+            self._cache.move_to_end(frame_number)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return frame
+
+    def get_frame(self, frame_number: int):
+        """Return a single frame, from the cache if possible, and prefetch its neighbours"""
+        frame_number = int(frame_number)
+        if frame_number < 0:
+            frame_number += self.n_frames
+        frame = self._get_cached(frame_number)
+        if frame is None:
+            frame = self._read(frame_number)
+        self._cursor = frame_number
+        if self.prefetch_radius > 0:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._prefetch, daemon=True)
+                self._thread.start()
+            self._request.set()
+        return frame
+
+    def _prefetch(self):
+        while True:
+            self._request.wait()
+            self._request.clear()
+            if self._closed:
+                return
+            cursor = self._cursor
+            for distance in range(1, self.prefetch_radius + 1):
+                for frame_number in (cursor + distance, cursor - distance):
+                    if self._closed or self._request.is_set():
+                        break
+                    if 0 <= frame_number < self.n_frames and self._get_cached(frame_number) is None:
+                        self._read(frame_number)
+
+    def close(self):
+        self._closed = True
+        self._request.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            self._cache.clear()
+        self.reader.close()
+
+
+class TiffFrameDataChunkIterator(AbstractDataChunkIterator):
+    """
+    Iterate over the frames of one or more TIFF files, in order, for writing to NWB.
+
+    Memory-mapped files are handed to the writer as views of the file: blocks of
+    buffer_size frames for back-to-back pages, single frames otherwise. Other files
+    are decoded buffer_size frames at a time, over a pool of n_workers processes
+    if n_workers > 1, see iter_decoded_frames. Only frames [start, stop) of the
+    files, counted across all of them, are read. Reads are recorded by profiler as
+    stage 'read <file name>'.
+
+    Decoded frames, when n_workers > 1, are views of a shared memory ring buffer slot
+    that is reused once the next chunk is requested, see reuses_buffers.
+    """
+
+    def __init__(self, file_paths: list, buffer_size: int = 100, n_workers: int = 1, ring_size: int = None,
+                 start: int = 0, stop: int = None, profiler: ConversionProfiler = None):
+        self.file_paths = [str(f) for f in file_paths]
+        self.profiler = profiler if profiler is not None else ConversionProfiler(enabled=False)
+        self.buffer_size = int(buffer_size)
+        self.n_workers = int(n_workers)
+        self.ring_size = ring_size
+        self._readers = [TiffFrameReader(f) for f in self.file_paths]
+        self._n_frames = [r.n_frames for r in self._readers]
+        self._frame_shape = self._readers[0].frame_shape
+        self._dtype = self._readers[0].dtype
+        for r in self._readers:
+            if r.frame_shape != self._frame_shape:
+                raise ValueError(f'Frame shape of {r.file_path} differs from {self.file_paths[0]}')
+        n_frames = sum(self._n_frames)
+        self._start = min(int(start), n_frames)
+        self._stop = n_frames if stop is None else max(self._start, min(int(stop), n_frames))
+        self._chunks = self._iter_chunks()
+
+    @property
+    def is_memmapped(self):
+        """Whether all files are memory-mapped, so chunks are views of the files that cost nothing to read"""
+        return all(r.is_memmapped for r in self._readers)
+
+    @property
+    def reuses_buffers(self):
+        """Whether a chunk may be overwritten once the next one is requested, and must be copied to be kept"""
+        return self.n_workers > 1 and not self.is_memmapped
+
+    def close(self):
+        """Stop iterating, shutting down the decoding workers and closing the files"""
+        self._chunks.close()
+        for reader in self._readers:
+            reader.close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._chunks)
+
+    def _iter_chunks(self):
+        # Frame of the output at which each file starts
+        position = -self._start
+        for reader in self._readers:
+            # Range of frames of this file within [start, stop)
+            first = min(max(-position, 0), reader.n_frames)
+            last = min(max(self._stop - self._start - position, 0), reader.n_frames)
+            if reader.is_memmapped and not reader.is_contiguous:
+                blocks = ((i, i + 1, reader.get_frame(i)[np.newaxis]) for i in range(first, last))
+            elif reader.is_memmapped or self.n_workers <= 1:
+                blocks = (
+                    (i, min(i + self.buffer_size, last), reader.get_frames(i, min(i + self.buffer_size, last)))
+                    for i in range(first, last, self.buffer_size)
+                )
+            else:
+                blocks = iter_decoded_frames(
+                    file_path=reader.file_path,
+                    n_frames=reader.n_frames,
+                    frame_shape=reader.frame_shape,
+                    dtype=reader.dtype,
+                    block_size=self.buffer_size,
+                    n_workers=self.n_workers,
+                    ring_size=self.ring_size,
+                    start=first,
+                    stop=last
+                )
+            blocks = iter(blocks)
+            try:
+                while True:
+                    with self.profiler.stage(f'read {Path(reader.file_path).name}'):
+                        block = next(blocks, None)
+                    if block is None:
+                        break
+                    start, stop, data = block
+                    selection = (slice(position + start, position + stop),) + (slice(None),) * len(self._frame_shape)
+                    yield DataChunk(data=data, selection=selection)
+            finally:
+                # Shut down the decoding workers if iteration stops early
+                if hasattr(blocks, 'close'):
+                    blocks.close()
+            position += reader.n_frames
+            reader.close()
+
+    def recommended_chunk_shape(self):
+        return (1,) + self._frame_shape
+
+    def recommended_data_shape(self):
+        return (self._stop - self._start,) + self._frame_shape
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    @property
+    def maxshape(self):
+        return self.recommended_data_shape()
+
+
+class PrefetchDataChunkIterator(AbstractDataChunkIterator):
+    """
+    Read the chunks of another iterator ahead of the writer, in a background thread.
+
+    Up to n_prefetch chunks are read while the writer is busy with the previous
+    ones, so reading overlaps writing. When the NWB file is written with
+    exhaust_dci=False, HDMF writes the chunks of all iterators round-robin, and
+    the prefetched channels are read concurrently. Chunks are copied only if the
+    iterator reuses their buffers, see TiffFrameDataChunkIterator.reuses_buffers;
+    iterators without that attribute are assumed to.
+
+    close() must be called if iteration stops before the end, e.g. if writing
+    fails, to stop the reading thread and close the iterator.
+    """
+
+    def __init__(self, iterator: AbstractDataChunkIterator, n_prefetch: int = 2, profiler: ConversionProfiler = None):
+        self.iterator = iterator
+        self.profiler = profiler if profiler is not None else ConversionProfiler(enabled=False)
+        self._queue = queue.Queue(maxsize=max(1, int(n_prefetch)))
+        self._stop = threading.Event()
+        self._thread = None
+        self._copy = getattr(iterator, 'reuses_buffers', True)
+
+    def _read(self):
+        try:
+            while not self._stop.is_set():
+                with self.profiler.stage('read ahead'):
+                    chunk = next(self.iterator, None)
+                    if chunk is None:
+                        break
+                    # Copy chunks that are views of a buffer the iterator refills for the next chunk
+                    item = DataChunk(data=np.array(chunk.data), selection=chunk.selection) if self._copy else chunk
+                if not self._put(item):
+                    return
+        except Exception as e:
+            self._put(e)
+            return
+        self._put(None)
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._read, daemon=True)
+            self._thread.start()
+        item = self._queue.get()
+        if item is None:
+            self._queue.put(None)
+            raise StopIteration
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    def close(self):
+        """Stop reading ahead and close the iterator"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        close = getattr(self.iterator, 'close', None)
+        if close is not None:
+            close()
+
+    def recommended_chunk_shape(self):
+        return self.iterator.recommended_chunk_shape()
+
+    def recommended_data_shape(self):
+        return self.iterator.recommended_data_shape()
+
+    @property
+    def dtype(self):
+        return self.iterator.dtype
+
+    @property
+    def maxshape(self):
+        return self.iterator.maxshape
+
+
+# Readers and shared memory blocks of a decoding worker process, reused across its tasks
+_worker_readers = dict()
+_worker_shared_memory = dict()
+
+
+def _decode_frames_into_shared_memory(file_path: str, start: int, stop: int, shm_name: str, offset: int):
+    """Decode pages [start, stop) of file_path into a slot of the shared memory block shm_name"""
+    if file_path not in _worker_readers:
+        _worker_readers[file_path] = TiffFrameReader(file_path)
+    if shm_name not in _worker_shared_memory:
+        for shm in _worker_shared_memory.values():
+            shm.close()
+        _worker_shared_memory.clear()
+        _worker_shared_memory[shm_name] = shared_memory.SharedMemory(name=shm_name)
+    reader = _worker_readers[file_path]
+    out = np.ndarray(
+        shape=(stop - start,) + reader.frame_shape,
+        dtype=reader.dtype,
+        buffer=_worker_shared_memory[shm_name].buf,
+        offset=offset
+    )
+    for i in range(start, stop):
+        out[i - start] = reader.get_frame(i)
+    del out
+
+
+def iter_decoded_frames(file_path, n_frames: int, frame_shape: tuple, dtype, block_size: int = 100,
+                        n_workers: int = None, ring_size: int = None, start: int = 0, stop: int = None):
+    """
+    Decode the pages of a TIFF file over a pool of worker processes, yielding blocks of frames in order.
+
+    Workers decode blocks of block_size frames into the slots of a shared memory ring
+    buffer, so decoded frames are never pickled back to the parent process. Each yielded
+    block is a view of its slot, valid until the next block is requested, at which point
+    the slot is handed back to the workers. Memory use is bounded by ring_size blocks.
+
+    Parameters
+    ----------
+    file_path : str, Path
+        Path to the TIFF file.
+    n_frames : int
+        Number of pages of the file.
+    frame_shape : tuple
+        Shape of a single page.
+    dtype : np.dtype
+        Data type of the pages.
+    block_size : int
+        Number of frames decoded by a worker per task.
+    n_workers : int
+        Number of worker processes. Defaults to the number of CPUs.
+    ring_size : int
+        Number of blocks in the ring buffer. Defaults to twice the number of workers.
+    start, stop : int
+        Range of frames to decode. Defaults to all frames.
+
+    Yields
+    ------
+    start, stop, data : int, int, np.ndarray
+        Frames [start, stop) of the file.
+    """
+    dtype = np.dtype(dtype)
+    frame_shape = tuple(frame_shape)
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    if ring_size is None:
+        ring_size = 2 * n_workers
+    stop = n_frames if stop is None else min(stop, n_frames)
+    blocks = [(i, min(i + block_size, stop)) for i in range(start, stop, block_size)]
+    if len(blocks) == 0:
+        return
+    ring_size = max(1, min(ring_size, len(blocks)))
+    slot_nbytes = block_size * int(np.prod(frame_shape)) * dtype.itemsize
+
+    shm = shared_memory.SharedMemory(create=True, size=ring_size * slot_nbytes)
+    executor = ProcessPoolExecutor(max_workers=min(n_workers, ring_size))
+    try:
+        def submit(block_index):
+            start, stop = blocks[block_index]
+            return executor.submit(
+                _decode_frames_into_shared_memory,
+                file_path=str(file_path),
+                start=start,
+                stop=stop,
+                shm_name=shm.name,
+                offset=(block_index % ring_size) * slot_nbytes
+            )
+
+        pending = deque(submit(i) for i in range(ring_size))
+        for block_index, (start, stop) in enumerate(blocks):
+            pending.popleft().result()
+            data = np.ndarray(
+                shape=(stop - start,) + frame_shape,
+                dtype=dtype,
+                buffer=shm.buf,
+                offset=(block_index % ring_size) * slot_nbytes
+            )
+            yield start, stop, data
+            # The consumer is done with this slot, refill it
+            del data
+            if block_index + ring_size < len(blocks):
+                pending.append(submit(block_index + ring_size))
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        try:
+            shm.close()
+        except BufferError:
+            # A view of the last block is still referenced by the writer, the mapping is freed along with it
+            pass
+        shm.unlink()
@@ -1,22 +1,79 @@
+from nwb_conversion_tools.utils import get_schema_from_hdmf_class
+from hdmf.backends.hdf5 import H5DataIO
+from hdmf.data_utils import AbstractDataChunkIterator
+from pynwb import NWBFile, TimeSeries
+from pynwb.ecephys import ElectricalSeries
+from pynwb.ophys import Fluorescence, ImageSegmentation, TwoPhotonSeries
 from datetime import datetime
 from pathlib import Path
+from functools import lru_cache
+from copy import deepcopy
+import importlib.resources as pkg_resources
 import numpy as np
+import threading
 import json
 import uuid
-import h5py
 import pytz
 import random
 import string
 
+from . import schema
+from .hdf5_utils import H5FileCache, H5DatasetDataChunkIterator
+from .decimation import get_minmax_pyramid
+from .profiling import ConversionProfiler
 
-def get_basic_metadata(source_data):
+
+@lru_cache(maxsize=None)
+def _load_source_schema(file_name: str):
+    with pkg_resources.open_text(schema, file_name) as f:
+        return json.load(f)
+
+
+def load_source_schema(file_name: str):
+    """Return a copy of a packaged source schema, read from disk only on the first call"""
+    return deepcopy(_load_source_schema(file_name))
+
+
+@lru_cache(maxsize=None)
+def _get_hdmf_class_schema(hdmf_class):
+    return get_schema_from_hdmf_class(hdmf_class)
+
+
+def get_hdmf_class_schema(hdmf_class):
+    """Return a copy of the metadata schema of an hdmf class, built only on the first call"""
+    return deepcopy(_get_hdmf_class_schema(hdmf_class))
+
+
+_subjects_info_cache = dict()
+_subjects_info_lock = threading.Lock()
+
+
+def load_subjects_info(subjects_info_path):
+    """
+    Return a copy of the subjects info JSON file.
+
+    The parsed file is cached and read again only when its mtime or size changes.
+    """
+    path = str(Path(subjects_info_path).resolve())
+    stat = Path(path).stat()
+    file_version = (stat.st_mtime_ns, stat.st_size)
+    with _subjects_info_lock:
+        cached = _subjects_info_cache.get(path)
+        if cached is None or cached[0] != file_version:
+            with open(path, 'r') as inp:
+                cached = (file_version, json.load(inp))
+            _subjects_info_cache[path] = cached
+    return deepcopy(cached[1])
+
+
+def get_basic_metadata(source_data, h5_files: H5FileCache = None):
     """Get basic metadata info from files"""
 
+    all_subjects_info = dict()
     if 'path_subjects_info' in source_data:
         subjects_info_path = source_data['path_subjects_info']
         if Path(subjects_info_path).is_file():
-            with open(subjects_info_path, 'r') as inp:
-                all_subjects_info = json.load(inp)
+            all_subjects_info = load_subjects_info(subjects_info_path)
 
     subject_info = {
         'subject_id': ''.join(random.choices(string.ascii_uppercase + string.digits, k=5)),
@@ -32,14 +89,18 @@ def get_basic_metadata(source_data):
     elif 'path_ophys_processed' in source_data and Path(source_data['path_ophys_processed']).is_file():
         fname = source_data['path_ophys_processed']
     if fname:
-        with h5py.File(fname, 'r') as f:
-            session_identifier = str(int(f['tid'][0]))
-            if np.isnan(f['aid'][0]):
-                print(f"File {fname} does not have 'aid' key. Skipping it...")
-            else:
-                subject_id = str(int(f['aid'][0]))
+        h5_files = h5_files if h5_files is not None else H5FileCache()
+        session_identifier = str(int(h5_files.get_scalar(fname, 'tid')))
+        aid = h5_files.get_scalar(fname, 'aid')
+        if np.isnan(aid):
+            print(f"File {fname} does not have 'aid' key. Skipping it...")
+        else:
+            subject_id = str(int(aid))
+            if subject_id in all_subjects_info:
                 subject_info = all_subjects_info[subject_id]
                 subject_info['subject_id'] = subject_id
+            else:
+                print(f"Subject {subject_id} not found in subjects info. Skipping it...")
 
     # initiate metadata
     session_start_time = datetime.strptime('1900-01-01 00:00:00', '%Y-%m-%d %H:%M:%S')
@@ -60,3 +121,277 @@ def get_basic_metadata(source_data):
     )
 
     return metadata
+
+
+# Duration of the window converted by stub_test, in seconds
+STUB_DURATION = 10.
+
+
+def get_time_window(stub_test: bool = False, t_start: float = None, t_stop: float = None):
+    """
+    Return the (t_start, t_stop) window to convert, in seconds, or None to convert whole sessions.
+
+    With stub_test, the window is cut to its first STUB_DURATION seconds.
+    """
+    if not stub_test and t_start is None and t_stop is None:
+        return None
+    t_start = 0. if t_start is None else float(t_start)
+    t_stop = np.inf if t_stop is None else float(t_stop)
+    if stub_test:
+        t_stop = min(t_stop, t_start + STUB_DURATION)
+    if t_stop <= t_start:
+        raise ValueError(f't_stop ({t_stop}) must be greater than t_start ({t_start})')
+    return t_start, t_stop
+
+
+def get_sample_range(time_window, rate: float, n_samples: int = None):
+    """
+    Return the [start, stop) range of the samples of a series sampled at rate, starting at 0 s,
+    that fall within time_window. stop is None when the window runs to the end of the series.
+
+    If the series has n_samples samples, raises ValueError when none of them are in the window,
+    e.g. when t_start is past the end of the recording.
+    """
+    if time_window is None:
+        return 0, None
+    t_start, t_stop = time_window
+    start = int(np.ceil(t_start * rate))
+    stop = int(np.ceil(t_stop * rate)) if np.isfinite(t_stop) else None
+    if n_samples is not None and start >= (n_samples if stop is None else min(stop, n_samples)):
+        raise ValueError(
+            f'The time window ({t_start} s, {t_stop} s) holds no samples of a series of {n_samples} '
+            f'samples at {rate} Hz, which ends at {n_samples / rate} s'
+        )
+    return start, stop
+
+
+PIXEL_MASK_DTYPE = np.dtype([('x', 'uint32'), ('y', 'uint32'), ('weight', 'float32')])
+
+
+def get_pixel_mask(pixel_list, n_rows: int):
+    """
+    Build a PlaneSegmentation pixel mask from MATLAB linear pixel indices.
+
+    Parameters
+    ----------
+    pixel_list : array-like
+        Linear pixel indices of the ROI, as stored in 'pixel_list' of the processed file.
+        MATLAB indices are column-major, so consecutive indices run down the lines of a frame.
+    n_rows : int
+        Number of lines per frame.
+
+    Returns
+    -------
+    np.ndarray
+        Structured array with fields 'x' (line of the frame, i.e. row), 'y' (pixel within
+        the line, i.e. column) and 'weight', the orientation of get_image_mask.
+    """
+    col, row = np.divmod(np.ravel(pixel_list), int(n_rows))
+    pixel_mask = np.empty(row.size, dtype=PIXEL_MASK_DTYPE)
+    pixel_mask['x'] = row
+    pixel_mask['y'] = col
+    pixel_mask['weight'] = 1
+    return pixel_mask
+
+
+def get_image_mask(pixel_mask, image_shape: tuple):
+    """
+    Build a dense image mask from a pixel mask of (x, y, weight) entries.
+
+    The mask is indexed [x, y], as NWB image masks, so image_shape is (n_x, n_y). For
+    pixel masks from get_pixel_mask, x runs over the lines of a frame and y over the
+    pixels of a line, so image_shape is the frame shape (lines per frame, pixels per line)
+    and the image mask lines up with the frames.
+    """
+    pixel_mask = np.asarray(pixel_mask)
+    if pixel_mask.dtype.names is None:
+        pixel_mask = np.reshape(pixel_mask, (-1, 3))
+        x, y = pixel_mask[:, 0].astype(int), pixel_mask[:, 1].astype(int)
+    else:
+        x, y = pixel_mask['x'].astype(int), pixel_mask['y'].astype(int)
+    image_mask = np.zeros(image_shape)
+    image_mask[x, y] = 1
+    return image_mask
+
+
+PYRAMID_MODULE_NAME = 'trace_pyramids'
+
+
+def get_pyramid_series_name(series_name: str, bin_size: int):
+    """Name of the level of bin_size of the min/max pyramid of series_name"""
+    return f'{series_name}_minmax_{bin_size}'
+
+
+def add_trace_pyramid(nwbfile, series, file_path, dataset_name: str, start: int = 0, stop: int = None,
+                      h5_files: H5FileCache = None, profiler: ConversionProfiler = None):
+    """
+    Add the min/max envelope pyramid of a regularly sampled series to the 'trace_pyramids' processing module.
+
+    The pyramid is computed from the source dataset of the series, read one buffer at a time.
+    Each level is a TimeSeries '<series name>_minmax_<bin size>', with one row of [min, max]
+    per bin of bin size samples of the series, so dashboards can show zoomed out views of
+    long traces from a few kilobytes instead of reading every sample.
+    """
+    profiler = profiler if profiler is not None else ConversionProfiler(enabled=False)
+    with profiler.stage(f'pyramid {series.name}'):
+        blocks = (
+            chunk.data for chunk in H5DatasetDataChunkIterator(
+                file_path=file_path,
+                dataset_name=dataset_name,
+                h5_files=h5_files,
+                start=start,
+                stop=stop,
+                profiler=profiler
+            )
+        )
+        pyramid = get_minmax_pyramid(blocks)
+    if PYRAMID_MODULE_NAME in nwbfile.processing:
+        module = nwbfile.processing[PYRAMID_MODULE_NAME]
+    else:
+        module = nwbfile.create_processing_module(
+            name=PYRAMID_MODULE_NAME,
+            description='min/max envelopes of traces at power-of-two resolutions'
+        )
+    for bin_size, level in pyramid.items():
+        module.add(TimeSeries(
+            name=get_pyramid_series_name(series.name, bin_size),
+            description=f'min and max of {series.name} in bins of {bin_size} samples',
+            data=H5DataIO(level, compression='gzip'),
+            unit=series.unit,
+            conversion=series.conversion,
+            starting_time=series.starting_time,
+            rate=series.rate / bin_size,
+        ))
+
+
+def get_pyramid_levels(nwbfile: NWBFile, series):
+    """Return the levels of the min/max pyramid of series stored in nwbfile, as {bin size: TimeSeries}"""
+    if PYRAMID_MODULE_NAME not in nwbfile.processing:
+        return dict()
+    prefix = get_pyramid_series_name(series.name, '')
+    return {
+        int(name[len(prefix):]): level
+        for name, level in nwbfile.processing[PYRAMID_MODULE_NAME].data_interfaces.items()
+        if name.startswith(prefix) and name[len(prefix):].isdigit()
+    }
+
+
+def read_pyramid_window(level, start: int, stop: int, bin_size: int):
+    """
+    Return times and values of the bins of a pyramid level covering samples [start, stop) of
+    its series, as one vertical segment from min to max per bin.
+    """
+    bin_start, bin_stop = start // bin_size, -(-stop // bin_size)
+    yy = np.asarray(level.data[bin_start:bin_stop]).ravel() * level.conversion
+    xx = np.repeat(level.starting_time + np.arange(bin_start, bin_stop) / level.rate, 2)
+    return xx, yy
+
+
+def _find_data_interface(data_interfaces, neurodata_type, location: str):
+    for data_interface in data_interfaces.values():
+        if isinstance(data_interface, neurodata_type):
+            return data_interface
+    raise KeyError(f'No {neurodata_type.__name__} found in {location}')
+
+
+def get_processed_voltage_series(nwbfile: NWBFile):
+    """Return the filtered membrane voltage ElectricalSeries of a converted NWB file, found by type"""
+    return _find_data_interface(nwbfile.processing['ecephys'].data_interfaces, ElectricalSeries, 'ecephys module')
+
+
+def get_fluorescence_series(nwbfile: NWBFile):
+    """Return the RoiResponseSeries of the Fluorescence of a converted NWB file, found by type"""
+    fluorescence = _find_data_interface(nwbfile.processing['ophys'].data_interfaces, Fluorescence, 'ophys module')
+    return next(iter(fluorescence.roi_response_series.values()))
+
+
+def get_two_photon_series(nwbfile: NWBFile):
+    """Return the first TwoPhotonSeries of the acquisition of a converted NWB file, found by type"""
+    return _find_data_interface(nwbfile.acquisition, TwoPhotonSeries, 'acquisition')
+
+
+def get_plane_segmentation(nwbfile: NWBFile):
+    """Return the PlaneSegmentation of the ImageSegmentation of a converted NWB file, found by type"""
+    image_segmentation = _find_data_interface(
+        nwbfile.processing['ophys'].data_interfaces, ImageSegmentation, 'ophys module'
+    )
+    return next(iter(image_segmentation.plane_segmentations.values()))
+
+
+def get_plane_segmentation_outline(plane_segmentation, image_shape: tuple):
+    """
+    Return the outline of the first ROI of plane_segmentation, see get_roi_outline, read from
+    its 'outline' column if stored at conversion time, or else traced from its pixel mask
+    on frames of image_shape.
+    """
+    if 'outline' in plane_segmentation.colnames:
+        return np.asarray(plane_segmentation['outline'][0])
+    image_mask = get_image_mask(pixel_mask=plane_segmentation['pixel_mask'][0], image_shape=image_shape)
+    return get_roi_outline(image_mask)
+
+
+def get_roi_outline(image_mask):
+    """
+    Trace the outline of the pixels of a dense image mask.
+
+    Coordinates are those of the mask drawn as an image: x along its second axis and y
+    along its first. The outline follows pixel edges, pixel [i, j] spanning [j - 0.5, j + 0.5]
+    in x and [i - 0.5, i + 0.5] in y. Each connected region, and each hole, is one closed
+    loop; loops are separated by a row of NaN, so the outline can be drawn as a single trace.
+
+    Returns
+    -------
+    np.ndarray
+        (n_points, 2) array of the x and y of the outline vertices.
+    """
+    mask = np.pad(np.asarray(image_mask) > 0, 1)
+    rows, cols = np.nonzero(mask)
+    # Edges of mask pixels facing pixels outside the mask, all oriented clockwise around their pixel
+    sides = [
+        (~mask[rows - 1, cols], (rows, cols), (rows, cols + 1)),
+        (~mask[rows, cols + 1], (rows, cols + 1), (rows + 1, cols + 1)),
+        (~mask[rows + 1, cols], (rows + 1, cols + 1), (rows + 1, cols)),
+        (~mask[rows, cols - 1], (rows + 1, cols), (rows, cols)),
+    ]
+    edges = dict()
+    for is_boundary, (start_row, start_col), (stop_row, stop_col) in sides:
+        for start in zip(start_row[is_boundary].tolist(), start_col[is_boundary].tolist(),
+                         stop_row[is_boundary].tolist(), stop_col[is_boundary].tolist()):
+            edges.setdefault(start[:2], []).append(start[2:])
+
+    loops = []
+    while len(edges) > 0:
+        start = next(iter(edges))
+        loop = [start]
+        vertex = start
+        while True:
+            stops = edges[vertex]
+            stop = stops.pop()
+            if len(stops) == 0:
+                del edges[vertex]
+            if stop == start:
+                break
+            loop.append(stop)
+            vertex = stop
+        loop = np.array(loop + [start], dtype=float)
+        # Keep only the corners
+        direction = np.diff(loop, axis=0)
+        is_corner = np.concatenate([[True], np.any(direction[1:] != direction[:-1], axis=1), [True]])
+        loops.append(loop[is_corner])
+
+    if len(loops) == 0:
+        return np.empty((0, 2))
+    separator = np.full((1, 2), np.nan)
+    outline = np.concatenate([part for loop in loops for part in (loop, separator)][:-1])
+    # (row, col) corners of the padded mask to (x, y) in pixel coordinates
+    return outline[:, ::-1] - 1.5
+
+
+def close_data_chunk_iterators(nwbfile: NWBFile):
+    """Close the data chunk iterators of nwbfile that can be closed, e.g. to stop their reading threads"""
+    for container in nwbfile.objects.values():
+        data = getattr(container, 'data', None)
+        if isinstance(data, H5DataIO):
+            data = data.data
+        if isinstance(data, AbstractDataChunkIterator) and hasattr(data, 'close'):
+            data.close()
@@ -0,0 +1,49 @@
+from allen_oephys_to_nwb import AllenOephysNWBConverter
+from pynwb import NWBFile
+from datetime import datetime
+
+from .common import DURATIONS, ALL_STREAMS, generate_sessions, convert
+
+
+class WholeConversion:
+    """All streams and trials of a session, as converted in production"""
+    params = DURATIONS
+    param_names = ['duration']
+    timeout = 1200
+
+    def setup_cache(self):
+        return generate_sessions()
+
+    def time_conversion(self, sessions, duration):
+        convert(sessions[duration], ALL_STREAMS, include_trials=True)
+
+    def time_stub_conversion(self, sessions, duration):
+        convert(sessions[duration], ALL_STREAMS, include_trials=True, stub_test=True)
+
+    def peakmem_conversion(self, sessions, duration):
+        convert(sessions[duration], ALL_STREAMS, include_trials=True)
+
+
+class Metadata:
+    """Metadata fetched from source files, and the trials table"""
+    params = DURATIONS
+    param_names = ['duration']
+
+    def setup_cache(self):
+        return generate_sessions()
+
+    def setup(self, sessions, duration):
+        self.converter = AllenOephysNWBConverter(source_data=sessions[duration])
+        self.metadata = self.converter.get_metadata()
+
+    def time_get_metadata(self, sessions, duration):
+        AllenOephysNWBConverter(source_data=sessions[duration]).get_metadata()
+
+    def time_add_trials(self, sessions, duration):
+        # A trials table can only be added once, so each call gets a new file
+        nwbfile = NWBFile(
+            session_description='benchmark',
+            identifier=self.metadata['NWBFile']['identifier'],
+            session_start_time=datetime.fromisoformat(self.metadata['NWBFile']['session_start_time'])
+        )
+        self.converter.add_trials(nwbfile=nwbfile)
@@ -0,0 +1,33 @@
+from .common import DURATIONS, generate_sessions, convert
+
+
+class EcephysStages:
+    """Each AllenEcephysInterface stage on its own, written to a new file"""
+    params = DURATIONS
+    param_names = ['duration']
+    timeout = 600
+
+    def setup_cache(self):
+        return generate_sessions()
+
+    def _convert(self, sessions, duration, **options):
+        source_data = dict(AllenEcephysInterface=sessions[duration]['AllenEcephysInterface'])
+        convert(source_data, dict(AllenEcephysInterface=options))
+
+    def time_raw(self, sessions, duration):
+        self._convert(sessions, duration, add_ecephys_raw=True)
+
+    def time_raw_recompressed(self, sessions, duration):
+        self._convert(sessions, duration, add_ecephys_raw=True, passthrough_chunks=False)
+
+    def time_processed(self, sessions, duration):
+        self._convert(sessions, duration, add_ecephys_processed=True)
+
+    def time_spiking(self, sessions, duration):
+        self._convert(sessions, duration, add_ecephys_spiking=True)
+
+    def peakmem_raw_recompressed(self, sessions, duration):
+        self._convert(sessions, duration, add_ecephys_raw=True, passthrough_chunks=False)
+
+    def peakmem_spiking(self, sessions, duration):
+        self._convert(sessions, duration, add_ecephys_spiking=True)
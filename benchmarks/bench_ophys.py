@@ -0,0 +1,36 @@
+from .common import DURATIONS, generate_sessions, convert
+
+
+class OphysStages:
+    """Each AllenOphysInterface stage on its own, written to a new file"""
+    params = [DURATIONS, [False, True]]
+    param_names = ['duration', 'compress_tiff']
+    timeout = 600
+
+    def setup_cache(self):
+        return {
+            compress_tiff: generate_sessions(
+                label='compressed' if compress_tiff else 'uncompressed',
+                red_channel=True,
+                compress_tiff=compress_tiff
+            )
+            for compress_tiff in [False, True]
+        }
+
+    def _convert(self, sessions, duration, compress_tiff, red_channel=False, **options):
+        ophys_source = dict(sessions[compress_tiff][duration]['AllenOphysInterface'])
+        if not red_channel:
+            ophys_source.pop('path_tiff_red_channel')
+        convert(dict(AllenOphysInterface=ophys_source), dict(AllenOphysInterface=options))
+
+    def time_processed(self, sessions, duration, compress_tiff):
+        self._convert(sessions, duration, compress_tiff, add_ophys_processed=True)
+
+    def time_raw(self, sessions, duration, compress_tiff):
+        self._convert(sessions, duration, compress_tiff, add_ophys_raw=True)
+
+    def time_raw_two_channels(self, sessions, duration, compress_tiff):
+        self._convert(sessions, duration, compress_tiff, red_channel=True, add_ophys_raw=True)
+
+    def peakmem_raw(self, sessions, duration, compress_tiff):
+        self._convert(sessions, duration, compress_tiff, add_ophys_raw=True)
@@ -0,0 +1,35 @@
+from pathlib import Path
+
+from allen_oephys_to_nwb import AllenOephysNWBConverter
+from allen_oephys_to_nwb.synthetic_data import generate_session
+
+# Session durations benchmarked, in seconds
+DURATIONS = [10., 60., 300.]
+
+ALL_STREAMS = dict(
+    AllenEcephysInterface=dict(add_ecephys_raw=True, add_ecephys_processed=True, add_ecephys_spiking=True),
+    AllenOphysInterface=dict(add_ophys_processed=True, add_ophys_raw=True),
+)
+
+
+def generate_sessions(durations: list = None, label: str = 'default', **kwargs):
+    """Generate one synthetic session per duration under ./sessions/<label>, returning {duration: source_data}"""
+    durations = DURATIONS if durations is None else durations
+    return {
+        duration: generate_session(Path('sessions') / label / f'{int(duration)}s', duration=duration, **kwargs)
+        for duration in durations
+    }
+
+
+def convert(source_data: dict, conversion_options: dict, nwbfile_path='benchmark.nwb', **kwargs):
+    """Convert a session to nwbfile_path, overwriting it"""
+    converter = AllenOephysNWBConverter(source_data=source_data)
+    metadata = converter.get_metadata()
+    converter.run_conversion(
+        metadata=metadata,
+        nwbfile_path=str(nwbfile_path),
+        save_to_file=True,
+        overwrite=True,
+        conversion_options=conversion_options,
+        **kwargs
+    )
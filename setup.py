@@ -17,11 +17,14 @@ setup(
     long_description_content_type='text/markdown',
     author='Luiz Tauffer and Ben Dichter',
     email='ben.dichter@gmail.com',
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks']),
     include_package_data=True,
     package_data={'': ['*.yml', '*.json']},
     install_requires=install_requires,
     entry_points={
-        'console_scripts': ['nwbgui-oephys=allen_oephys_to_nwb.cmd_line:cmd_line_shortcut'],
+        'console_scripts': [
+            'nwbgui-oephys=allen_oephys_to_nwb.cmd_line:cmd_line_shortcut',
+            'nwb-oephys-batch=allen_oephys_to_nwb.batch_conversion:cmd_line_shortcut',
+        ],
     }
 )
@@ -0,0 +1,46 @@
+import pytest
+from pynwb import NWBHDF5IO
+
+from allen_oephys_to_nwb import AllenOephysNWBConverter
+from allen_oephys_to_nwb.synthetic_data import generate_session
+
+
+@pytest.fixture
+def session(tmp_path):
+    """Generate a short synthetic session, returning its source_data"""
+    def _session(**kwargs):
+        kwargs.setdefault('duration', 4.)
+        return generate_session(tmp_path / 'session', **kwargs)
+    return _session
+
+
+@pytest.fixture
+def convert(tmp_path):
+    """Convert a session to tmp_path / 'session.nwb', returning the path of the NWB file"""
+    def _convert(source_data: dict, conversion_options: dict, nwbfile_path=None, **kwargs):
+        nwbfile_path = str(tmp_path / 'session.nwb') if nwbfile_path is None else str(nwbfile_path)
+        converter = AllenOephysNWBConverter(source_data=source_data)
+        converter.run_conversion(
+            metadata=converter.get_metadata(),
+            nwbfile_path=nwbfile_path,
+            save_to_file=True,
+            overwrite=True,
+            conversion_options=conversion_options,
+            **kwargs
+        )
+        return nwbfile_path
+    return _convert
+
+
+@pytest.fixture
+def read_nwbfile():
+    """Open NWB files for reading, closing them at teardown"""
+    ios = []
+
+    def _read(nwbfile_path):
+        io = NWBHDF5IO(str(nwbfile_path), mode='r')
+        ios.append(io)
+        return io.read()
+    yield _read
+    for io in ios:
+        io.close()
@@ -0,0 +1,109 @@
+import json
+import os
+
+from allen_oephys_to_nwb.batch_conversion import run_batch_conversion
+from allen_oephys_to_nwb.synthetic_data import generate_session
+
+CONVERSION_OPTIONS = dict(AllenOphysInterface=dict(add_ophys_processed=True))
+
+
+def run_batch(sessions, path_output, **kwargs):
+    results = run_batch_conversion(
+        sessions=sessions,
+        path_output=path_output,
+        conversion_options=CONVERSION_OPTIONS,
+        n_workers=1,
+        **kwargs
+    )
+    return {r['session_id']: r for r in results}
+
+
+def test_existing_file_is_not_overwritten(session, tmp_path):
+    source_data = session()
+    path_output = tmp_path / 'batch'
+    path_output.mkdir()
+    user_file = path_output / 'a.nwb'
+    user_file.write_bytes(b'not written by the batch')
+    sessions = [dict(session_id='a', source_data=source_data)]
+
+    for _ in range(2):
+        results = run_batch(sessions, path_output)
+        assert results['a']['status'] == 'failed'
+        assert 'FileExistsError' in results['a']['error']
+        assert user_file.read_bytes() == b'not written by the batch'
+
+    results = run_batch(sessions, path_output, overwrite=True)
+    assert results['a']['status'] == 'success'
+    assert user_file.read_bytes() != b'not written by the batch'
+
+
+def test_interrupted_session_is_converted_again(session, tmp_path):
+    source_data = session()
+    path_output = tmp_path / 'batch'
+    sessions = [dict(session_id='a', source_data=source_data)]
+    run_batch(sessions, path_output)
+
+    # The batch died after writing the NWB file, before recording it
+    path_journal = path_output / 'conversion_journal.json'
+    with open(path_journal, 'r') as f:
+        journal = json.load(f)
+    journal['sessions']['a']['status'] = 'running'
+    with open(path_journal, 'w') as f:
+        json.dump(journal, f)
+    (path_output / 'a.part.nwb').write_bytes(b'partial')
+
+    results = run_batch(sessions, path_output)
+    assert results['a']['status'] == 'success'
+    assert not (path_output / 'a.part.nwb').exists()
+
+
+def test_converted_session_is_converted_again_when_settings_change(session, tmp_path):
+    source_data = session()
+    path_output = tmp_path / 'batch'
+    sessions = [dict(session_id='a', source_data=source_data)]
+    run_batch(sessions, path_output)
+    results = run_batch(sessions, path_output, metadata=dict(NWBFile=dict(session_description='changed')))
+    assert results['a']['status'] == 'success'
+
+
+def test_resume_skips_converted_sessions(session, tmp_path):
+    source_data = session()
+    path_output = tmp_path / 'batch'
+    sessions = [dict(session_id='a', source_data=source_data)]
+    results = run_batch(sessions, path_output)
+    assert results['a']['status'] == 'success'
+    mtime_ns = os.stat(path_output / 'a.nwb').st_mtime_ns
+
+    results = run_batch(sessions, path_output)
+    assert results['a']['status'] == 'skipped'
+    assert os.stat(path_output / 'a.nwb').st_mtime_ns == mtime_ns
+
+    # A changed source file is converted again
+    path_processed = source_data['AllenOphysInterface']['path_ophys_processed']
+    stat = os.stat(path_processed)
+    os.utime(path_processed, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    results = run_batch(sessions, path_output)
+    assert results['a']['status'] == 'success'
+
+    results = run_batch(sessions, path_output, resume=False)
+    assert results['a']['status'] == 'success'
+
+
+def test_resume_retries_failed_sessions(session, tmp_path):
+    path_output = tmp_path / 'batch'
+    sessions = [
+        dict(session_id='a', source_data=session()),
+        dict(session_id='b', source_data=generate_session(tmp_path / 'b', cell_id='200', duration=4.)),
+    ]
+    os.rename(tmp_path / 'b', tmp_path / 'b_moved')
+    results = run_batch(sessions, path_output)
+    assert results['a']['status'] == 'success'
+    assert results['b']['status'] == 'failed'
+
+    os.rename(tmp_path / 'b_moved', tmp_path / 'b')
+    results = run_batch(sessions, path_output)
+    assert results['a']['status'] == 'skipped'
+    assert results['b']['status'] == 'success'
+    with open(path_output / 'conversion_journal.json', 'r') as f:
+        journal = json.load(f)
+    assert {k: v['status'] for k, v in journal['sessions'].items()} == dict(a='success', b='success')
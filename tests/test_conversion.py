@@ -0,0 +1,186 @@
+from datetime import datetime
+
+import h5py
+import numpy as np
+import pytest
+import tifffile
+from hdmf.backends.hdf5 import H5DataIO
+from pynwb import NWBFile, NWBHDF5IO
+
+from allen_oephys_to_nwb import AllenOephysNWBConverter, utils
+from allen_oephys_to_nwb.decimation import get_pyramid_level
+from allen_oephys_to_nwb.hdf5_utils import H5DatasetDataChunkIterator
+from allen_oephys_to_nwb.utils import (get_pyramid_levels, read_pyramid_window, get_processed_voltage_series,
+                                       get_fluorescence_series)
+
+ALL_STREAMS = dict(
+    AllenEcephysInterface=dict(add_ecephys_raw=True, add_ecephys_processed=True, add_ecephys_spiking=True),
+    AllenOphysInterface=dict(add_ophys_processed=True, add_ophys_raw=True),
+)
+
+
+def read_source(source_data: dict):
+    """Read the traces, spike samples and frames of a synthetic session"""
+    source = dict()
+    with h5py.File(source_data['AllenEcephysInterface']['path_ecephys_raw'], 'r') as f:
+        source['voltage'] = np.ravel(f['Voltage'][:])
+        source['ecephys_rate'] = 1 / float(np.ravel(f['dte'][:])[0])
+    with h5py.File(source_data['AllenEcephysInterface']['path_ecephys_processed'], 'r') as f:
+        source['voltage_processed'] = np.ravel(f['Vmfd'][:])
+        source['spike_samples'] = np.flatnonzero(np.ravel(f['spk'][:]))
+        source['fluorescence'] = np.ravel(f['f_cell'][:])
+        source['imaging_rate'] = 1 / float(np.ravel(f['dto'][:])[0])
+    with tifffile.TiffFile(source_data['AllenOphysInterface']['path_tiff_green_channel']) as tif:
+        source['frames'] = np.stack([page.asarray() for page in tif.pages])
+    return source
+
+
+def get_series(nwbfile):
+    return dict(
+        voltage=nwbfile.acquisition['ElectricalSeries_raw'],
+        voltage_processed=nwbfile.processing['ecephys']['ElectricalSeries_processed'],
+        fluorescence=nwbfile.processing['ophys']['Fluorescence']['roi_response_series'],
+        frames=nwbfile.acquisition['TwoPhotonSeries_green'],
+    )
+
+
+@pytest.mark.parametrize('passthrough_chunks', [True, False])
+@pytest.mark.parametrize('compress_tiff', [False, True])
+def test_round_trip(session, convert, read_nwbfile, passthrough_chunks, compress_tiff):
+    source_data = session(compress_tiff=compress_tiff)
+    source = read_source(source_data)
+    conversion_options = {
+        name: dict(options, passthrough_chunks=passthrough_chunks) for name, options in ALL_STREAMS.items()
+    }
+    nwbfile = read_nwbfile(convert(source_data=source_data, conversion_options=conversion_options))
+
+    for name, series in get_series(nwbfile).items():
+        assert series.starting_time == 0.
+        np.testing.assert_array_equal(np.squeeze(series.data[:]), source[name])
+    spike_times = nwbfile.units['spike_times'][0]
+    np.testing.assert_allclose(spike_times, source['spike_samples'] / source['ecephys_rate'])
+
+    # Passthrough datasets keep the chunk layout and filters of the source dataset
+    with h5py.File(source_data['AllenEcephysInterface']['path_ecephys_raw'], 'r') as f:
+        source_dataset = f['Voltage']
+        dataset = nwbfile.acquisition['ElectricalSeries_raw'].data
+        if passthrough_chunks:
+            assert dataset.chunks == source_dataset.chunks[1:]
+            assert dataset.compression_opts == source_dataset.compression_opts
+        else:
+            assert dataset.chunks != source_dataset.chunks[1:]
+
+
+@pytest.mark.parametrize('window_options, time_window', [
+    (dict(stub_test=True), (0., 1.)),
+    (dict(t_start=1., t_stop=3.), (1., 3.)),
+    (dict(t_start=1.5), (1.5, np.inf)),
+    (dict(t_start=1.5, t_stop=3., stub_test=True), (1.5, 2.5)),
+])
+def test_time_window(session, convert, read_nwbfile, monkeypatch, window_options, time_window):
+    monkeypatch.setattr(utils, 'STUB_DURATION', 1.)
+    # Sweeps start every 2 s, so every window holds at least one trial
+    source_data = session()
+    source = read_source(source_data)
+    nwbfile = read_nwbfile(convert(
+        source_data=source_data,
+        conversion_options=ALL_STREAMS,
+        include_trials=True,
+        **window_options
+    ))
+
+    t_start, t_stop = time_window
+    for name, series in get_series(nwbfile).items():
+        rate = source['imaging_rate'] if name in ('fluorescence', 'frames') else source['ecephys_rate']
+        start = int(np.ceil(t_start * rate))
+        stop = int(np.ceil(t_stop * rate)) if np.isfinite(t_stop) else None
+        assert series.starting_time == pytest.approx(start / rate)
+        np.testing.assert_array_equal(np.squeeze(series.data[:]), source[name][start:stop])
+
+    spike_times = source['spike_samples'] / source['ecephys_rate']
+    spike_times = spike_times[(spike_times >= t_start) & (spike_times < t_stop)]
+    np.testing.assert_allclose(nwbfile.units['spike_times'][0], spike_times)
+
+    trial_start_times = nwbfile.trials['start_time'][:]
+    assert len(trial_start_times) > 0
+    assert np.all((trial_start_times >= t_start) & (trial_start_times < t_stop))
+
+
+def test_append_to_nwbfile(session):
+    source_data = session()
+    converter = AllenOephysNWBConverter(source_data=source_data)
+    metadata = converter.get_metadata()
+    nwbfile = NWBFile(
+        session_description='existing file',
+        identifier='existing',
+        session_start_time=datetime.now().astimezone()
+    )
+    returned = converter.run_conversion(
+        metadata=metadata,
+        save_to_file=False,
+        nwbfile=nwbfile,
+        conversion_options=dict(AllenEcephysInterface=dict(add_ecephys_processed=True)),
+        include_trials=True
+    )
+    assert returned is nwbfile
+    assert nwbfile.identifier == 'existing'
+    assert 'ElectricalSeries_processed' in nwbfile.processing['ecephys'].data_interfaces
+    assert len(nwbfile.trials) > 0
+
+
+def test_read_trace_pyramids(session, convert, read_nwbfile):
+    source_data = session()
+    source = read_source(source_data)
+    conversion_options = dict(
+        AllenEcephysInterface=dict(add_ecephys_processed=True, add_trace_pyramids=True),
+        AllenOphysInterface=dict(add_ophys_processed=True, add_trace_pyramids=True),
+    )
+    nwbfile = read_nwbfile(convert(source_data=source_data, conversion_options=conversion_options))
+    assert len(get_pyramid_levels(nwbfile, get_fluorescence_series(nwbfile))) > 0
+
+    series = get_processed_voltage_series(nwbfile)
+    levels = get_pyramid_levels(nwbfile, series)
+    n_samples = len(source['voltage_processed'])
+    bin_size = get_pyramid_level(bin_sizes=levels.keys(), n_samples=n_samples, n_pixels=100)
+    assert bin_size is not None
+
+    start, stop = 3 * bin_size, 10 * bin_size
+    xx, yy = read_pyramid_window(levels[bin_size], start=start, stop=stop, bin_size=bin_size)
+    bins = source['voltage_processed'][start:stop].reshape(-1, bin_size)
+    np.testing.assert_allclose(yy, np.stack([bins.min(axis=1), bins.max(axis=1)], axis=1).ravel())
+    np.testing.assert_allclose(xx[::2], np.arange(start, stop, bin_size) / source['ecephys_rate'])
+
+
+@pytest.mark.parametrize('conversion_options', [
+    dict(AllenEcephysInterface=dict(add_ecephys_raw=True)),
+    dict(AllenEcephysInterface=dict(add_ecephys_processed=True)),
+    dict(AllenEcephysInterface=dict(add_ecephys_spiking=True)),
+    dict(AllenOphysInterface=dict(add_ophys_processed=True)),
+    dict(AllenOphysInterface=dict(add_ophys_raw=True)),
+])
+def test_time_window_past_the_end(session, convert, conversion_options):
+    source_data = session()
+    with pytest.raises(ValueError, match='holds no samples'):
+        convert(source_data=source_data, conversion_options=conversion_options, t_start=5., t_stop=6.)
+
+
+def test_failed_write_releases_source_files(session, tmp_path, monkeypatch):
+    source_data = session()
+    converter = AllenOephysNWBConverter(source_data=source_data)
+    metadata = converter.get_metadata()
+
+    def write(self, nwbfile, **kwargs):
+        for container in nwbfile.objects.values():
+            data = getattr(container, 'data', None)
+            if isinstance(data, H5DataIO) and isinstance(data.data, H5DatasetDataChunkIterator):
+                next(data.data)
+        raise RuntimeError('write failed')
+
+    monkeypatch.setattr(NWBHDF5IO, 'write', write)
+    with pytest.raises(RuntimeError, match='write failed'):
+        converter.run_conversion(
+            metadata=metadata,
+            nwbfile_path=str(tmp_path / 'session.nwb'),
+            conversion_options=dict(AllenEcephysInterface=dict(add_ecephys_raw=True, passthrough_chunks=False)),
+        )
+    assert len(converter.h5_files._files) == 0
@@ -0,0 +1,46 @@
+import shutil
+
+import pytest
+
+from allen_oephys_to_nwb import AllenOephysNWBConverter
+from allen_oephys_to_nwb.discovery import discover_sessions, get_manifest_sessions
+
+
+@pytest.fixture
+def discover(tmp_path):
+    """Index a session generated in tmp_path / 'session', its processed file moved to tmp_path / 'processed'"""
+    def _discover():
+        (tmp_path / 'processed').mkdir(exist_ok=True)
+        shutil.move(tmp_path / 'session' / '100_processed.h5', tmp_path / 'processed' / '100_processed.h5')
+        return discover_sessions(
+            path_oephys_processed=tmp_path / 'processed',
+            path_oephys_raw=tmp_path / 'session',
+            cache_path=tmp_path / 'index.json'
+        )
+    return _discover
+
+
+def test_manifest_sessions_without_raw_ecephys(session, discover, convert, tmp_path):
+    source_data = session()
+    (tmp_path / 'session' / '100.h5').unlink()
+    index = discover()
+    sessions = get_manifest_sessions(index, path_subjects_info=source_data['AllenEcephysInterface']['path_subjects_info'])
+    assert len(sessions) == 1
+    assert sessions[0]['conversion_options'] == dict(AllenEcephysInterface=dict(add_ecephys_raw=False))
+
+    converter = AllenOephysNWBConverter(source_data=sessions[0]['source_data'])
+    assert 'rate' not in converter.get_metadata()['Ecephys']['ElectricalSeries_raw']
+    convert(
+        source_data=sessions[0]['source_data'],
+        conversion_options=dict(AllenEcephysInterface=dict(add_ecephys_processed=True)),
+    )
+
+
+def test_manifest_sessions_with_extra_tiff_files(session, discover, tmp_path, capsys):
+    session()
+    shutil.copy(tmp_path / 'session' / '100_2.tif', tmp_path / 'session' / '100_extra_2.tif')
+    index = discover()
+    sessions = get_manifest_sessions(index)
+    assert sessions[0]['source_data']['AllenOphysInterface']['path_tiff_green_channel'].endswith('100_2.tif')
+    assert 'conversion_options' not in sessions[0]
+    assert '100_extra_2.tif' in capsys.readouterr().out
@@ -0,0 +1,99 @@
+import h5py
+import numpy as np
+import pytest
+import tifffile
+from pynwb import NWBHDF5IO
+
+from allen_oephys_to_nwb import allen_ophys_interface
+from allen_oephys_to_nwb.tiff_utils import PrefetchDataChunkIterator
+from allen_oephys_to_nwb.utils import (get_image_mask, get_roi_outline, get_two_photon_series, get_plane_segmentation,
+                                       get_plane_segmentation_outline)
+
+
+def test_image_mask_matches_pixel_mask(session, convert, read_nwbfile):
+    frame_shape = (32, 64)
+    source_data = session(frame_shape=frame_shape)
+    nwbfile_path = convert(
+        source_data=source_data,
+        conversion_options=dict(AllenOphysInterface=dict(add_ophys_processed=True, add_ophys_raw=True)),
+    )
+    nwbfile = read_nwbfile(nwbfile_path)
+    plane_segmentation = nwbfile.processing['ophys']['ImageSegmentation']['PlaneSegmentation']
+    pixel_mask = plane_segmentation['pixel_mask'][0]
+    image_mask = np.asarray(plane_segmentation['image_mask'][0])
+    assert image_mask.shape == frame_shape
+    assert nwbfile.acquisition['TwoPhotonSeries_green'].data.shape[1:] == frame_shape
+
+    expected = np.zeros(frame_shape, dtype=image_mask.dtype)
+    expected[pixel_mask['x'], pixel_mask['y']] = 1
+    np.testing.assert_array_equal(image_mask, expected)
+    assert image_mask.sum() == len(pixel_mask)
+
+    # pixel_list holds column-major linear indices into a frame
+    with h5py.File(source_data['AllenOphysInterface']['path_ophys_processed'], 'r') as f:
+        pixel_list = np.ravel(f['pixel_list'][:]).astype(int)
+    np.testing.assert_array_equal(np.flatnonzero(image_mask.ravel(order='F')), np.sort(pixel_list))
+
+    outline = np.asarray(plane_segmentation['outline'][0])
+    vertices = outline[~np.isnan(outline).any(axis=1)]
+    assert vertices[:, 0].min() >= -0.5 and vertices[:, 0].max() <= frame_shape[1] - 0.5
+    assert vertices[:, 1].min() >= -0.5 and vertices[:, 1].max() <= frame_shape[0] - 0.5
+
+
+def test_read_stored_outline(session, convert, read_nwbfile):
+    frame_shape = (32, 64)
+    source_data = session(frame_shape=frame_shape)
+    nwbfile_path = convert(
+        source_data=source_data,
+        conversion_options=dict(AllenOphysInterface=dict(add_ophys_processed=True, add_ophys_raw=True)),
+    )
+    nwbfile = read_nwbfile(nwbfile_path)
+    assert get_two_photon_series(nwbfile).name == 'TwoPhotonSeries_green'
+    plane_segmentation = get_plane_segmentation(nwbfile)
+    assert 'outline' in plane_segmentation.colnames
+
+    outline = get_plane_segmentation_outline(plane_segmentation, image_shape=frame_shape)
+    image_mask = get_image_mask(pixel_mask=plane_segmentation['pixel_mask'][0], image_shape=frame_shape)
+    np.testing.assert_array_equal(outline, get_roi_outline(image_mask))
+
+
+def test_failed_write_stops_reading_ahead(session, convert, monkeypatch):
+    source_data = session(compress_tiff=True)
+    iterators = []
+
+    def write(self, nwbfile, **kwargs):
+        for container in nwbfile.objects.values():
+            if isinstance(getattr(container, 'data', None), PrefetchDataChunkIterator):
+                iterators.append(container.data)
+                next(container.data)
+        raise RuntimeError('write failed')
+
+    monkeypatch.setattr(NWBHDF5IO, 'write', write)
+    with pytest.raises(RuntimeError, match='write failed'):
+        convert(
+            source_data=source_data,
+            conversion_options=dict(AllenOphysInterface=dict(add_ophys_raw=True, n_decode_workers=2)),
+        )
+    assert len(iterators) == 1
+    assert not iterators[0]._thread.is_alive()
+
+
+def test_link_raw_data_without_reading_tiff(session, convert, read_nwbfile, monkeypatch):
+    source_data = session(red_channel=True)
+
+    def get_frame_index(*args, **kwargs):
+        raise AssertionError('linked TIFF files should not be indexed')
+
+    monkeypatch.setattr(allen_ophys_interface, 'get_frame_index', get_frame_index)
+    nwbfile_path = convert(
+        source_data=source_data,
+        conversion_options=dict(AllenOphysInterface=dict(add_ophys_raw=True, link_ophys_raw=True)),
+    )
+    nwbfile = read_nwbfile(nwbfile_path)
+    for name, path_key in [('TwoPhotonSeries_green', 'path_tiff_green_channel'),
+                           ('TwoPhotonSeries_red', 'path_tiff_red_channel')]:
+        two_photon_series = nwbfile.acquisition[name]
+        assert list(two_photon_series.external_file[:]) == [source_data['AllenOphysInterface'][path_key]]
+        assert list(two_photon_series.starting_frame[:]) == [0]
+        with tifffile.TiffFile(source_data['AllenOphysInterface'][path_key]) as tif:
+            assert two_photon_series.num_samples == len(tif.pages)
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+import tifffile
+
+from allen_oephys_to_nwb.tiff_utils import (TiffFrameDataChunkIterator, PrefetchDataChunkIterator, get_frame_index,
+                                            get_frame_index_cache_path, get_frame_index_sidecar_path)
+
+
+@pytest.mark.parametrize('compress_tiff, n_workers', [(False, 1), (True, 1), (True, 2)])
+def test_prefetch_reads_all_frames(session, compress_tiff, n_workers):
+    source_data = session(compress_tiff=compress_tiff)
+    path_tiff = source_data['AllenOphysInterface']['path_tiff_green_channel']
+    iterator = TiffFrameDataChunkIterator(file_paths=[path_tiff], buffer_size=16, n_workers=n_workers)
+    assert iterator.is_memmapped == (not compress_tiff)
+    assert iterator.reuses_buffers == (n_workers > 1)
+
+    prefetch = PrefetchDataChunkIterator(iterator)
+    chunks = list(prefetch)
+    prefetch.close()
+    data = np.empty(iterator.recommended_data_shape(), dtype=iterator.dtype)
+    for chunk in chunks:
+        data[chunk.selection] = chunk.data
+    with tifffile.TiffFile(path_tiff) as tif:
+        np.testing.assert_array_equal(data, np.stack([page.asarray() for page in tif.pages]))
+
+
+def test_prefetch_close_stops_reading(session):
+    source_data = session(compress_tiff=True)
+    path_tiff = source_data['AllenOphysInterface']['path_tiff_green_channel']
+    prefetch = PrefetchDataChunkIterator(
+        TiffFrameDataChunkIterator(file_paths=[path_tiff], buffer_size=4, n_workers=2)
+    )
+    next(prefetch)
+    prefetch.close()
+    assert not prefetch._thread.is_alive()
+
+
+@pytest.mark.parametrize('use_sidecar', [False, True])
+def test_frame_index_location(session, tmp_path, monkeypatch, use_sidecar):
+    monkeypatch.setenv('HOME', str(tmp_path / 'home'))
+    source_data = session()
+    path_tiff = source_data['AllenOphysInterface']['path_tiff_green_channel']
+    frame_index = get_frame_index(path_tiff, use_cache=False, use_sidecar=use_sidecar)
+    with tifffile.TiffFile(path_tiff) as tif:
+        assert frame_index['n_frames'] == len(tif.pages)
+    assert get_frame_index_sidecar_path(path_tiff).is_file() == use_sidecar
+    assert get_frame_index_cache_path(path_tiff).is_file() != use_sidecar